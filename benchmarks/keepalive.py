@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Compares requests/s of SnsServer with and without HTTP keep-alive.
+
+    python benchmarks/keepalive.py --requests 2000 --concurrency 4 --engine threaded
+
+The notifications are signed with the test key in tests/test-data, and delivery is disabled.
+"""
+import argparse
+import http.client
+import re
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+from cryptography import x509
+
+from sns_email.sns import SnsServer
+from sns_email.sns_async import AsyncSnsServer
+
+test_data_dir = Path(__file__).parent.parent / "tests" / "test-data"
+
+
+def post_notifications(server_address, body: bytes, count: int, keep_alive: bool):
+    connection = None
+    try:
+        for i in range(count):
+            if connection is None:
+                connection = http.client.HTTPConnection(*server_address, timeout=30)
+            connection.request("POST", "/", body=body,
+                               headers={"Connection": "keep-alive" if keep_alive else "close"})
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                raise Exception("unexpected response. status=%d" % response.status)
+            if response.will_close:
+                connection.close()
+                connection = None
+    finally:
+        if connection is not None:
+            connection.close()
+
+
+def run(server: SnsServer, body: bytes, requests: int, concurrency: int, keep_alive: bool) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(post_notifications, server.server_address, body, requests // concurrency,
+                                   keep_alive) for i in range(concurrency)]
+        for f in futures:
+            f.result()
+    return (requests // concurrency * concurrency) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded")
+    args = parser.parse_args()
+
+    server_class = AsyncSnsServer if args.engine == "asyncio" else SnsServer
+    with open(test_data_dir / "signing-key.pem", "rb") as f:
+        certificate = x509.load_pem_x509_certificate(f.read())
+    with open(test_data_dir / "sns-notification", "rb") as f:
+        body = f.read()
+
+    with mock.patch("sns_email.sns_signature._valid_sns_url", new=re.compile("https://.*")), \
+            mock.patch("sns_email.sns_signature._load_certificate", return_value=certificate), \
+            server_class(None, ("127.0.0.1", 0), workers=args.concurrency, queue_size=args.concurrency,
+                         max_requests=args.requests) as server:
+        with ThreadPoolExecutor(max_workers=1) as serving:
+            serving.submit(server.serve_forever)
+            try:
+                for keep_alive in (False, True):
+                    rate = run(server, body, args.requests, args.concurrency, keep_alive)
+                    print("engine=%s keep_alive=%-5s requests=%d concurrency=%d requests/s=%.1f" % (
+                        args.engine, keep_alive, args.requests, args.concurrency, rate))
+            finally:
+                server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+"""Measures requests/s, latency and memory of SnsServer receiving signed SNS notifications end to end.
+
+    python benchmarks/throughput.py --variants inline,s3 --sizes 1024,65536,1048576 --requests 500 \\
+        --concurrency 8 --delivery null --output results.json --baseline previous.json
+
+Notifications are signed with the test key in tests/test-data, and its certificate is seeded in an offline
+certificate cache directory standing in for the SNS certificate URL. The server runs in its own process and
+delivers to a null sink, to a fake SMTP server or to a fake ``sendmail -bs``; S3 objects are served by moto in
+that process. Each variant and size reports requests/s, p50/p99 latency and the RSS of the server process, and
+``--output`` saves them as JSON to be compared with ``--baseline`` by a later run.
+"""
+import argparse
+import base64
+import datetime
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures.thread import ThreadPoolExecutor
+from pathlib import Path
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+from cryptography.hazmat.primitives.hashes import SHA1
+
+from sns_email import sns_signature
+from sns_email.receive import MessageReceiver
+from sns_email.smtp import SmtpPool, SendmailPool
+from sns_email.sns import SnsServer
+from sns_email.sns_async import AsyncSnsServer
+from sns_email.sns_signature import CertificateCache, _signed_data
+
+root_dir = Path(__file__).parent.parent
+test_data_dir = root_dir / "tests" / "test-data"
+
+SIGNING_CERT_URL = "https://sns.eu-west-1.amazonaws.com/SimpleNotificationService-benchmark.pem"
+TOPIC_ARN = "arn:aws:sns:eu-west-1:123456789012:sns-email-benchmark"
+BUCKET = "sns-email-benchmark"
+RECIPIENT = "recipient@example.com"
+
+
+def mail_content(size: int) -> str:
+    headers = ("From: sender@example.com\r\nTo: %s\r\nSubject: benchmark\r\nMIME-Version: 1.0\r\n"
+               "Content-Type: text/plain; charset=UTF-8\r\n\r\n" % RECIPIENT)
+    line = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789abcdef\r\n"
+    body_size = max(0, size - len(headers))
+    return headers + (line * (body_size // len(line) + 1))[:body_size]
+
+
+def s3_key(size: int) -> str:
+    return "mail-%d" % size
+
+
+class NotificationSigner:
+    def __init__(self, key_path: Path):
+        with open(key_path, "rb") as f:
+            self.key = serialization.load_pem_private_key(f.read(), password=None)
+
+    def notification(self, variant: str, size: int) -> bytes:
+        message_id = uuid.uuid4().hex
+        receipt = {'recipients': [RECIPIENT], 'action': {'type': "SNS", 'topicArn': TOPIC_ARN}}
+        mail = {'source': "sender@example.com", 'messageId': message_id, 'destination': [RECIPIENT],
+                'commonHeaders': {'from': ["sender@example.com"], 'to': [RECIPIENT], 'subject': "benchmark"}}
+        message = {'notificationType': "Received", 'receipt': receipt, 'mail': mail}
+        if variant == "s3":
+            receipt['action'] = {'type': "S3", 'topicArn': TOPIC_ARN, 'bucketName': BUCKET,
+                                 'objectKey': s3_key(size)}
+        else:
+            message['content'] = mail_content(size)
+        body = {
+            'Type': "Notification",
+            'MessageId': str(uuid.uuid4()),
+            'TopicArn': TOPIC_ARN,
+            'Subject': "Amazon SES Email Receipt Notification",
+            'Message': json.dumps(message),
+            'Timestamp': datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+            'SignatureVersion': "1",
+            'Signature': "",
+            'SigningCertURL': SIGNING_CERT_URL,
+            'UnsubscribeURL': "https://sns.eu-west-1.amazonaws.com/?Action=Unsubscribe",
+        }
+        _, data = _signed_data(body)
+        body['Signature'] = base64.b64encode(self.key.sign(data, PKCS1v15(), SHA1())).decode()
+        return json.dumps(body).encode()
+
+
+class null_deliver:
+    """Delivery discarding the mail. """
+
+    def __init__(self, source, recipients):
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def write(self, data):
+        self.size += len(data)
+
+
+def serve(options: dict, addresses):
+    """Runs the server in its own process, putting its address in ``addresses`` once listening. """
+    if "s3" in options['variants']:
+        import boto3
+        import moto
+
+        os.environ.update(AWS_ACCESS_KEY_ID="benchmark", AWS_SECRET_ACCESS_KEY="benchmark",
+                          AWS_DEFAULT_REGION="eu-west-1")
+        moto.mock_aws().start()
+        s3 = boto3.client('s3', region_name="eu-west-1")
+        s3.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': "eu-west-1"})
+        for size in options['sizes']:
+            s3.put_object(Bucket=BUCKET, Key=s3_key(size), Body=mail_content(size).encode())
+
+    sns_signature.configure(cache_dir=options['certificate_dir'], offline=True)
+
+    if options['delivery'] == "smtp":
+        sys.path.insert(0, str(root_dir / "tests"))
+        from fake_smtp import FakeSmtpServer
+        smtp_server = FakeSmtpServer()
+        smtp_server.deliver = lambda mail_from, recipients, data: None  # keep the messages out of the RSS
+        smtp_server.__enter__()
+        deliver = SmtpPool(*smtp_server.server_address, size=options['workers'] or 1)
+    elif options['delivery'] == "sendmail-bs":
+        sendmail_path = os.path.join(options['work_dir'], "sendmail")
+        out_path = os.path.join(options['work_dir'], "out")
+        os.makedirs(out_path, exist_ok=True)
+        with open(sendmail_path, "w") as f:
+            f.write("#!/bin/sh\nexec '%s' '%s' '%s'\n" % (sys.executable, root_dir / "tests" / "fake_smtp.py",
+                                                          out_path))
+        os.chmod(sendmail_path, 0o755)
+        deliver = SendmailPool(sendmail_path=sendmail_path, size=options['workers'] or 1)
+    else:
+        deliver = null_deliver
+
+    server_class = AsyncSnsServer if options['engine'] == "asyncio" else SnsServer
+    with MessageReceiver(deliver=deliver) as receiver, \
+            server_class(receiver, ("127.0.0.1", 0), workers=options['workers'], queue_size=options['concurrency'],
+                         max_requests=1000000) as server:
+        addresses.put(server.server_address)
+        server.serve_forever()
+
+
+def memory(pid: int) -> dict:
+    """Returns the current and peak RSS of a process in bytes, on Linux. """
+    result = {'rss_bytes': None, 'peak_rss_bytes': None}
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name == "VmRSS":
+                    result['rss_bytes'] = int(value.split()[0]) * 1024
+                elif name == "VmHWM":
+                    result['peak_rss_bytes'] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return result
+
+
+def post_notifications(server_address, bodies, next_index, latencies: list) -> int:
+    """Posts bodies on one keep-alive connection until none is left, returning the number of errors. """
+    errors = 0
+    connection = http.client.HTTPConnection(*server_address, timeout=60)
+    try:
+        while True:
+            index = next_index()
+            if index >= len(bodies):
+                return errors
+            start = time.perf_counter()
+            try:
+                connection.request("POST", "/", body=bodies[index])
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            if response.status != 200:
+                errors += 1
+            if response.will_close:
+                connection.close()
+    finally:
+        connection.close()
+
+
+def run(server_address, bodies, concurrency: int) -> dict:
+    lock = threading.Lock()
+    counter = iter(range(len(bodies) + concurrency))
+
+    def next_index():
+        with lock:
+            return next(counter)
+
+    latencies = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        errors = sum(executor.map(lambda _: post_notifications(server_address, bodies, next_index, latencies),
+                                  range(concurrency)))
+    elapsed = time.perf_counter() - start
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        'requests': len(bodies),
+        'errors': errors,
+        'seconds': elapsed,
+        'requests_per_second': len(bodies) / elapsed,
+        'latency_p50_ms': quantiles[49] * 1000 if quantiles else None,
+        'latency_p99_ms': quantiles[98] * 1000 if quantiles else None,
+    }
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=root_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result: dict):
+    return result['variant'], result['size'], result['delivery'], result['engine'], result['concurrency']
+
+
+def compare(results: list, baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = {result_key(result): result for result in json.load(f)['results']}
+    for result in results:
+        previous = baseline.get(result_key(result))
+        if previous is None:
+            continue
+        print("variant=%s size=%d requests/s=%+.1f%% p99=%+.1f%% peak_rss=%+.1f%%" % (
+            result['variant'], result['size'],
+            *(100.0 * (result[name] / previous[name] - 1) if result[name] and previous[name] else float("nan")
+              for name in ('requests_per_second', 'latency_p99_ms', 'peak_rss_bytes'))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--variants", default="inline,s3", help="comma separated: inline, s3")
+    parser.add_argument("--sizes", default="1024,65536,1048576", help="comma separated mail sizes in bytes")
+    parser.add_argument("--requests", type=int, default=500, help="notifications for each variant and size")
+    parser.add_argument("--warmup", type=int, default=20, help="notifications sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=8, help="workers of the server")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--delivery", choices=["null", "smtp", "sendmail-bs"], default="null")
+    parser.add_argument("--output", help="file saving the results as JSON")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare to")
+    args = parser.parse_args()
+
+    variants = args.variants.split(",")
+    sizes = [int(size) for size in args.sizes.split(",")]
+    signer = NotificationSigner(test_data_dir / "signing-key.rsa")
+    work_dir = tempfile.mkdtemp(prefix="sns-email-benchmark-")
+    certificate_dir = os.path.join(work_dir, "certificates")
+    os.makedirs(certificate_dir)
+    shutil.copy(test_data_dir / "signing-key.pem", os.path.join(certificate_dir,
+                                                                CertificateCache.file_name(SIGNING_CERT_URL)))
+
+    context = multiprocessing.get_context("spawn")
+    addresses = context.Queue()
+    server = context.Process(target=serve, name="sns-email-benchmark", daemon=True, args=(dict(
+        variants=variants, sizes=sizes, certificate_dir=certificate_dir, work_dir=work_dir,
+        delivery=args.delivery, engine=args.engine, workers=args.workers, concurrency=args.concurrency),
+        addresses))
+    server.start()
+    results = []
+    try:
+        server_address = addresses.get(timeout=60)
+        for variant in variants:
+            for size in sizes:
+                bodies = [signer.notification(variant, size) for _ in range(args.warmup + args.requests)]
+                run(server_address, bodies[:args.warmup], args.concurrency)
+                result = dict(variant=variant, size=size, delivery=args.delivery, engine=args.engine,
+                              concurrency=args.concurrency, workers=args.workers)
+                result.update(run(server_address, bodies[args.warmup:], args.concurrency))
+                result.update(memory(server.pid))
+                results.append(result)
+                print("variant=%s size=%d requests/s=%.1f p50_ms=%.2f p99_ms=%.2f errors=%d rss_mb=%s" % (
+                    variant, size, result['requests_per_second'], result['latency_p50_ms'] or 0,
+                    result['latency_p99_ms'] or 0, result['errors'],
+                    "%.1f" % (result['rss_bytes'] / 2 ** 20) if result['rss_bytes'] else "n/a"))
+    finally:
+        server.terminate()
+        server.join(timeout=10)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                'version': git_version(),
+                'python': platform.python_version(),
+                'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'options': vars(args),
+                'results': results,
+            }, f, indent=2)
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
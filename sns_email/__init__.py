@@ -2,6 +2,7 @@ import logging
 import threading
 
 import boto3
+import botocore.config
 import prometheus_client
 
 logger = logging.getLogger("sns-email")
@@ -10,6 +11,10 @@ _counter_errors = prometheus_client.Counter('sns_email_errors_total', 'Errors to
 
 _local = threading.local()
 
+_clients_lock = threading.Lock()
+_clients = {}
+_clients_session = None
+
 
 def boto_session():
     try:
@@ -17,3 +22,29 @@ def boto_session():
     except AttributeError:
         _local.session = boto3.session.Session()
         return _local.session
+
+
+def boto_client(service: str, region: str = None, endpoint_url: str = None, max_pool_connections: int = 10):
+    """Returns a client shared by all threads, created once for each service, region, credentials and pool size. """
+    global _clients_session
+    with _clients_lock:
+        if _clients_session is None:
+            _clients_session = boto3.session.Session()
+        credentials = _clients_session.get_credentials()
+        key = (service, region, endpoint_url, max_pool_connections, id(credentials))
+        client = _clients.get(key)
+        if client is None:
+            logger.getChild('boto').debug("creating client. service=%s, region=%s, max_pool_connections=%d",
+                                          service, region, max_pool_connections)
+            client = _clients_session.client(service, region_name=region, endpoint_url=endpoint_url,
+                                             config=botocore.config.Config(max_pool_connections=max_pool_connections))
+            _clients[key] = client
+        return client
+
+
+def clear_clients():
+    """Forgets the shared clients and their session, picking up changed credentials or configuration. """
+    global _clients_session
+    with _clients_lock:
+        _clients.clear()
+        _clients_session = None
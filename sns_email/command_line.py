@@ -1,12 +1,28 @@
 import contextlib
+import functools
 import logging
+import os
 import re
+import sys
+import tempfile
 
 import configargparse
+import prometheus_client
 
-from sns_email import logger
+from sns_email import logger, counter, sns_signature, stages
+from sns_email.deliver import sendmail_deliver
+from sns_email.dynamodb import DynamoDbDedup
+from sns_email.journal import DedupJournal, SqliteDedup
+from sns_email.maildir import MaildirDelivery, load_mapping
+from sns_email.prefork import Supervisor, MULTIPROC_DIR, CREATED_MULTIPROC_DIR, metrics_registry
 from sns_email.receive import MessageReceiver
+from sns_email.retry import RetryQueue
+from sns_email.s3 import S3Fetcher
+from sns_email.smtp import SmtpPool, SendmailPool
+from sns_email.spool import Spool
+from sns_email.status import StatusServer
 from sns_email.sns import SnsServer
+from sns_email.sns_async import AsyncSnsServer
 from sns_email.sqs import SqsPoller
 
 argument_parser = configargparse.ArgParser(auto_env_var_prefix="SNS_EMAIL_",
@@ -17,15 +33,147 @@ argument_parser.add_argument('--address', dest="address", action="store", defaul
                              help='the IP address for HTTP server')
 argument_parser.add_argument('--port', dest="port", action="store", default=10000, type=int,
                              help='the port for HTTP server')
+argument_parser.add_argument('--engine', dest="engine", action="store", default="threaded",
+                             choices=["threaded", "asyncio"],
+                             help='the implementation of the HTTP server')
+argument_parser.add_argument('--metrics-address', dest="metrics_address", action="store",
+                             help='the IP address for the metrics and health HTTP server, by default --address')
+argument_parser.add_argument('--metrics-port', dest="metrics_port", action="store", type=int,
+                             help='the port for a HTTP server of metrics, health and readiness, separate from the '
+                                  'SNS requests; with --processes, worker N listens on this port + N and reports its '
+                                  'own readiness, and the metrics of all workers')
+argument_parser.add_argument('--ready-saturation', dest="ready_saturation", action="store", default=1.0,
+                             type=float, help='fraction of the HTTP workers and queue in use from which the '
+                                              'readiness endpoint answers 503')
+argument_parser.add_argument('--admin', dest="admin", action="store_true",
+                             help='serve profiling and allocation tracing endpoints under /admin/ of --metrics-port, '
+                                  'only to be reachable by administrators')
+argument_parser.add_argument('--processes', dest="processes", action="store", default=0, type=int,
+                             help='number of worker processes sharing the HTTP port, restarted when they exit; '
+                                  'needs --state-dir or --dedup-dynamodb-table, 0 to serve in a single process')
+argument_parser.add_argument('--workers', dest="workers", action="store", default=0, type=int,
+                             help='number of threads handling HTTP requests, 0 to handle them one at a time')
+argument_parser.add_argument('--queue-size', dest="queue_size", action="store", default=32, type=int,
+                             help='number of HTTP requests waiting for a worker before answering 503, 0 to answer '
+                                  '503 as soon as all workers are busy')
+argument_parser.add_argument('--keep-alive-timeout', dest="keep_alive_timeout", action="store", default=15,
+                             type=float, help='seconds to keep an idle HTTP connection open')
+argument_parser.add_argument('--keep-alive-requests', dest="keep_alive_requests", action="store", default=100,
+                             type=int, help='number of requests served on a HTTP connection before closing it')
 
 argument_parser.add_argument('--accept-destination', dest="rex", action="store", type=re.compile, default=".*",
                              help='Regex to match destination email addresses')
+argument_parser.add_argument('--dedup-size', dest="dedup_size", action="store", default=10000, type=int,
+                             help='number of message ids remembered to ignore duplicate notifications')
+argument_parser.add_argument('--dedup-ttl', dest="dedup_ttl", action="store", default=86400, type=float,
+                             help='seconds a message id is remembered after its last notification')
+argument_parser.add_argument('--dedup-lease', dest="dedup_lease", action="store", default=600, type=float,
+                             help='seconds a delivery holds its message id before duplicates may be delivered')
+argument_parser.add_argument('--dedup-wait', dest="dedup_wait", action="store", default=0, type=float,
+                             help='seconds a duplicate waits for the delivery of its message, before answering to '
+                                  'retry it later')
+argument_parser.add_argument('--dedup-dynamodb-table', dest="dedup_dynamodb_table", action="store",
+                             help='DynamoDB table sharing the ids of messages between several nodes')
+argument_parser.add_argument('--dedup-dynamodb-region', dest="dedup_dynamodb_region", action="store",
+                             help='Region of the DynamoDB table')
+argument_parser.add_argument('--state-dir', dest="state_dir", action="store",
+                             help='directory keeping the ids of delivered messages across restarts, unless '
+                                  '--dedup-dynamodb-table keeps them')
+argument_parser.add_argument('--certificate-dir', dest="certificate_dir", action="store",
+                             help='directory caching the SNS signing certificates, by default "certificates" in '
+                                  '--state-dir')
+argument_parser.add_argument('--certificate-url', dest="certificate_urls", action="append", default=[],
+                             help='URL of a SNS signing certificate to load at startup, can be repeated')
+argument_parser.add_argument('--offline-certificates', dest="offline_certificates", action="store_true",
+                             help='only use the certificates in --certificate-dir, never fetching them')
+argument_parser.add_argument('--verified-cache-size', dest="verified_cache_size", action="store", default=1024,
+                             type=int, help='number of verified SNS signatures remembered to skip verifying retries')
+argument_parser.add_argument('--verify-processes', dest="verify_processes", action="store", default=0, type=int,
+                             help='number of processes verifying SNS signatures, 0 to verify them in the thread '
+                                  'handling the request')
+argument_parser.add_argument('--verify-batch-size', dest="verify_batch_size", action="store", default=16, type=int,
+                             help='maximum number of SNS signatures sent together to a verifying process')
+
+argument_parser.add_argument('--delivery', dest="delivery", action="store", default="sendmail",
+                             choices=["sendmail", "sendmail-bs", "smtp", "lmtp", "maildir"],
+                             help='how emails are delivered to the local MTA: a sendmail process for each email, '
+                                  'long-lived "sendmail -bs" sessions, SMTP/LMTP connections, or directly into '
+                                  'Maildir directories')
+argument_parser.add_argument('--sendmail-path', dest="sendmail_path", action="store", default="/usr/bin/sendmail",
+                             help='the path of the sendmail binary')
+argument_parser.add_argument('--smtp-host', dest="smtp_host", action="store", default="localhost",
+                             help='the host of the SMTP/LMTP server, or the path of the LMTP unix socket')
+argument_parser.add_argument('--smtp-port', dest="smtp_port", action="store", default=0, type=int,
+                             help='the port of the SMTP/LMTP server, 0 for the protocol default')
+argument_parser.add_argument('--smtp-pool-size', dest="smtp_pool_size", action="store", default=4, type=int,
+                             help='the maximum number of SMTP/LMTP connections or sendmail sessions')
+argument_parser.add_argument('--smtp-session-messages', dest="smtp_session_messages", action="store", default=100,
+                             type=int, help='number of emails sent through a connection or sendmail session before '
+                                            'replacing it, 0 for no limit')
+argument_parser.add_argument('--maildir-path', dest="maildir_path", action="store",
+                             help='the Maildir of a recipient, expanded with the groups matched by '
+                                  '--accept-destination, e.g. /srv/mail/\\1/Maildir')
+argument_parser.add_argument('--maildir-map', dest="maildir_map", action="store",
+                             help='file of "recipient maildir" lines, taking precedence over --maildir-path')
+argument_parser.add_argument('--maildir-fsync-interval', dest="maildir_fsync_interval", action="store", default=0,
+                             type=float, help='seconds to batch Maildir directory syncs of concurrent deliveries, '
+                                              '0 to sync after each email')
+argument_parser.add_argument('--maildir-no-fsync', dest="maildir_fsync", action="store_false",
+                             help='do not sync Maildir files and directories to disk')
+argument_parser.add_argument('--s3-part-size', dest="s3_part_size", action="store", default=8 * 1024 * 1024,
+                             type=int, help='bytes fetched by each ranged GET of mails stored in S3')
+argument_parser.add_argument('--s3-window', dest="s3_window", action="store", default=4, type=int,
+                             help='number of ranged GETs in flight for each mail stored in S3')
+argument_parser.add_argument('--s3-message-memory', dest="s3_message_memory", action="store",
+                             default=32 * 1024 * 1024, type=int,
+                             help='bytes buffered in memory for each mail fetched from S3, beyond them on disk')
+argument_parser.add_argument('--s3-max-memory', dest="s3_max_memory", action="store", default=256 * 1024 * 1024,
+                             type=int, help='bytes buffered in memory for all mails fetched from S3, 0 for no limit')
+argument_parser.add_argument('--s3-workers', dest="s3_workers", action="store", default=8, type=int,
+                             help='number of threads fetching mails stored in S3')
+argument_parser.add_argument('--max-attempts', dest="max_attempts", action="store", default=2, type=int,
+                             help='number of deliveries of a message before refusing its duplicates, 0 for no limit; '
+                                  'not applied with --retry-dir')
+argument_parser.add_argument('--retry-dir', dest="retry_dir", action="store",
+                             help='directory keeping failed deliveries to retry them locally')
+argument_parser.add_argument('--retry-dead-letter-dir', dest="retry_dead_letter_dir", action="store",
+                             help='directory of deliveries failing too many times, by default "dead-letter" in '
+                                  '--retry-dir')
+argument_parser.add_argument('--retry-max-attempts', dest="retry_max_attempts", action="store", default=10,
+                             type=int, help='number of delivery attempts before moving to the dead letter directory')
+argument_parser.add_argument('--retry-backoff-min', dest="retry_backoff_min", action="store", default=30,
+                             type=float, help='seconds before the first retry, doubling with each attempt')
+argument_parser.add_argument('--retry-backoff-max', dest="retry_backoff_max", action="store", default=3600,
+                             type=float, help='maximum seconds between retries')
+argument_parser.add_argument('--spool-dir', dest="spool_dir", action="store",
+                             help='directory spooling notifications, acknowledged once written and delivered by '
+                                  'separate workers')
+argument_parser.add_argument('--spool-workers', dest="spool_workers", action="store", default=2, type=int,
+                             help='number of threads delivering spooled notifications')
+argument_parser.add_argument('--spool-size', dest="spool_size", action="store", default=10000, type=int,
+                             help='number of spooled notifications before answering 503')
+argument_parser.add_argument('--spool-max-attempts', dest="spool_max_attempts", action="store", default=10,
+                             type=int, help='number of delivery attempts of a spooled notification before moving it '
+                                            'to "dead-letter" in --spool-dir, 0 for no limit')
 
 argument_parser.add_argument('--sqs-queue-url', dest="sqs_queue_url", action="store",
                              help='URL of the SQS Queue where mail notification are delivered')
 argument_parser.add_argument('--sqs-region', dest="sqs_region", action="store",
                              help='Region of the SQS Queue where mail notification are delivered')
+argument_parser.add_argument('--sqs-workers', dest="sqs_workers", action="store", default=4, type=int,
+                             help='number of threads processing SQS messages')
+argument_parser.add_argument('--sqs-pollers', dest="sqs_pollers", action="store", default=1, type=int,
+                             help='number of parallel SQS long-poll loops')
+argument_parser.add_argument('--sqs-visibility-timeout', dest="sqs_visibility_timeout", action="store", default=60,
+                             type=int, help='seconds SQS messages are hidden while processing, extended for slow '
+                                            'deliveries')
+argument_parser.add_argument('--sqs-max-backoff', dest="sqs_max_backoff", action="store", default=600,
+                             type=float, help='maximum seconds between SQS polls while the queue is empty')
+argument_parser.add_argument('--sqs-poll-on-error', dest="sqs_poll_on_error", action="store_true",
+                             help='poll SQS right away when the SNS endpoint fails handling a notification')
 
+argument_parser.add_argument('--trace', dest="trace", action="store_true",
+                             help='log the time of each stage of receiving every notification')
 argument_parser.add_argument('--verbose', '-v',
                              action="count", default=0,
                              help='verbose logging',
@@ -44,14 +192,113 @@ def main(args=None):
     if _args.logging_level >= 2:
         logging.root.setLevel(logging.DEBUG)
 
-    receiver = MessageReceiver(rex=_args.rex)
+    if _args.admin and not _args.metrics_port:
+        argument_parser.error("--admin needs --metrics-port")
+    if not _args.processes:
+        serve(_args)
+        return
+
+    if not (_args.state_dir or _args.dedup_dynamodb_table):
+        argument_parser.error("--processes needs --state-dir or --dedup-dynamodb-table to share message ids")
+    if MULTIPROC_DIR not in os.environ:
+        # metrics are created on import, start again with the multiprocess mode of prometheus_client
+        os.environ[MULTIPROC_DIR] = os.environ[CREATED_MULTIPROC_DIR] = tempfile.mkdtemp(prefix="sns-email-metrics-")
+        os.execv(sys.executable, [sys.executable, "-m", "sns_email.command_line"] +
+                 list(args if args is not None else sys.argv[1:]))
+    logger.info("starting worker processes. processes=%d", _args.processes)
+    Supervisor(functools.partial(serve, _args), processes=_args.processes,
+               remove_multiproc_dir=os.environ.get(CREATED_MULTIPROC_DIR) == os.environ[MULTIPROC_DIR]).run()
+    logger.info("shut down.")
+
+
+def serve(_args, index: int = None):
+    """Serves notifications in this process, as the worker process ``index`` if started by a ``Supervisor``. """
+    def worker_dir(path):
+        return path if index is None else os.path.join(path, str(index))
+
+    stages.configure(trace=_args.trace)
     with contextlib.ExitStack() as ctx:
-        if _args.sqs_queue_url:
-            ctx.enter_context(
-                SqsPoller(receiver=receiver, queue_url=_args.sqs_queue_url, region=_args.sqs_region))
+        journal = None
+        backend = None
+        if _args.dedup_dynamodb_table:
+            backend = DynamoDbDedup(table_name=_args.dedup_dynamodb_table, region=_args.dedup_dynamodb_region,
+                                    ttl=_args.dedup_ttl)
+        if _args.state_dir:
+            os.makedirs(_args.state_dir, exist_ok=True)
+            if backend is not None:
+                logger.info("keeping message ids in dynamodb, not in the state directory. table=%s",
+                            _args.dedup_dynamodb_table)
+            elif index is None:
+                journal = DedupJournal(os.path.join(_args.state_dir, "dedup.sqlite"), ttl=_args.dedup_ttl)
+                ctx.callback(journal.close)
+            else:
+                # worker processes share the claims of message ids
+                backend = SqliteDedup(os.path.join(_args.state_dir, "dedup.sqlite"), ttl=_args.dedup_ttl)
+                ctx.callback(backend.close)
+        certificate_dir = _args.certificate_dir
+        if certificate_dir is None and _args.state_dir:
+            certificate_dir = os.path.join(_args.state_dir, "certificates")
+        sns_signature.configure(cache_dir=certificate_dir, offline=_args.offline_certificates,
+                                prefetch=_args.certificate_urls, verified_size=_args.verified_cache_size,
+                                processes=_args.verify_processes, batch_size=_args.verify_batch_size)
+        ctx.callback(sns_signature.close)
+
+        counter.configure(size=_args.dedup_size, ttl=_args.dedup_ttl, journal=journal, backend=backend,
+                          lease=_args.dedup_lease, wait=_args.dedup_wait)
+
+        if _args.delivery in ("smtp", "lmtp"):
+            deliver = SmtpPool(host=_args.smtp_host, port=_args.smtp_port, size=_args.smtp_pool_size,
+                               lmtp=_args.delivery == "lmtp", max_messages=_args.smtp_session_messages)
+            ctx.callback(deliver.close)
+        elif _args.delivery == "sendmail-bs":
+            deliver = SendmailPool(sendmail_path=_args.sendmail_path, size=_args.smtp_pool_size,
+                                   max_messages=_args.smtp_session_messages)
+            ctx.callback(deliver.close)
+        elif _args.delivery == "maildir":
+            deliver = MaildirDelivery(template=_args.maildir_path, rex=_args.rex,
+                                      mapping=load_mapping(_args.maildir_map) if _args.maildir_map else None,
+                                      fsync=_args.maildir_fsync, fsync_interval=_args.maildir_fsync_interval)
+        else:
+            deliver = functools.partial(sendmail_deliver, sendmail_path=_args.sendmail_path)
+        s3_fetcher = ctx.enter_context(
+            S3Fetcher(part_size=_args.s3_part_size, window=_args.s3_window, workers=_args.s3_workers,
+                      message_memory=_args.s3_message_memory, max_memory=_args.s3_max_memory))
+        receiver = MessageReceiver(rex=_args.rex, deliver=deliver,
+                                   max_attempts=0 if _args.retry_dir else _args.max_attempts, s3_fetcher=s3_fetcher)
+        if _args.retry_dir:
+            receiver = ctx.enter_context(
+                RetryQueue(receiver=receiver, path=worker_dir(_args.retry_dir),
+                           dead_letter_dir=_args.retry_dead_letter_dir, max_attempts=_args.retry_max_attempts,
+                           backoff_min=_args.retry_backoff_min, backoff_max=_args.retry_backoff_max))
+        if _args.spool_dir:
+            receiver = ctx.enter_context(
+                Spool(receiver=receiver, path=worker_dir(_args.spool_dir), workers=_args.spool_workers,
+                      max_size=_args.spool_size, max_attempts=_args.spool_max_attempts))
+
+        poller = None
+        if _args.sqs_queue_url and not index:
+            poller = ctx.enter_context(
+                SqsPoller(receiver=receiver, queue_url=_args.sqs_queue_url, region=_args.sqs_region,
+                          workers=_args.sqs_workers, pollers=_args.sqs_pollers,
+                          visibility_timeout=_args.sqs_visibility_timeout, backoff_max=_args.sqs_max_backoff))
 
-        httpd = SnsServer(receiver=receiver, server_address=(_args.address, _args.port))
+        registry = prometheus_client.REGISTRY if index is None else metrics_registry()
+        server_class = AsyncSnsServer if _args.engine == "asyncio" else SnsServer
+        httpd = server_class(receiver=receiver, server_address=(_args.address, _args.port),
+                             workers=_args.workers, queue_size=_args.queue_size,
+                             idle_timeout=_args.keep_alive_timeout, max_requests=_args.keep_alive_requests,
+                             registry=registry, reuse_port=index is not None)
         ctx.enter_context(httpd)
+        if _args.metrics_port:
+            # a port for each worker, so that its readiness and profiling are not those of a random worker
+            metrics_port = _args.metrics_port + (index or 0)
+            status = ctx.enter_context(
+                StatusServer(server_address=(_args.metrics_address or _args.address, metrics_port),
+                             load=httpd.load, registry=registry, saturation=_args.ready_saturation,
+                             admin=_args.admin))
+            logger.info("serving metrics on %s", status.server_address)
+        if poller is not None and _args.sqs_poll_on_error:
+            httpd.on_error = poller.trigger
 
         logger.info("listening on %s", httpd.server_address)
         try:
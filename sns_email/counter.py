@@ -1,45 +1,246 @@
-import functools
+import abc
+import collections
 import threading
+import time
+import uuid
 
+import prometheus_client
 
-class Counter:
-    def __init__(self, initial=0):
+from sns_email import logger, stages
+
+_logger = logger.getChild('counter')
+
+_gauge_entries = prometheus_client.Gauge('sns_email_dedup_entries', 'Message ids in the deduplication table')
+_counter_evictions = prometheus_client.Counter('sns_email_dedup_evictions_total',
+                                               'Message ids evicted from the deduplication table', ['reason'])
+_counter_coalesced = prometheus_client.Counter('sns_email_dedup_coalesced_total',
+                                               'Duplicates arriving while their message was being delivered',
+                                               ['outcome'])
+
+CLAIMED = "claimed"
+COMPLETED = "completed"
+IN_PROGRESS = "in_progress"
+
+Claim = collections.namedtuple('Claim', ['state', 'attempts', 'token'], defaults=(None,))
+
+_POLL_INTERVAL = 0.5
+
+
+class DuplicateInProgressException(Exception):
+    pass
+
+
+class _Flights:
+    """Events of the claims held in this process, set when they are released. """
+
+    def __init__(self):
         self._lock = threading.Lock()
-        self._value = initial
-        self._success = False
+        self._events = {}
 
-    def __bool__(self):
+    def start(self, message_id):
         with self._lock:
-            return self._success
+            self._events[message_id] = threading.Event()
 
-    def inc(self, amount=1):
+    def finish(self, message_id):
         with self._lock:
-            self._value += amount
-            return self._value
+            event = self._events.pop(message_id, None)
+        if event is not None:
+            event.set()
 
-    def set_success(self):
+    def wait(self, message_id, timeout: float):
         with self._lock:
-            self._success = True
-            self._value = 0
+            event = self._events.get(message_id)
+        if event is not None:
+            event.wait(timeout)
+        else:
+            # claimed by another process, poll the backend
+            time.sleep(min(timeout, _POLL_INTERVAL))
+
+
+_flights = _Flights()
+
+
+class DedupBackend(abc.ABC):
+    """Store of message ids, deciding which delivery of a message may proceed.
+
+    ``claim`` atomically takes a lease of ``lease`` seconds on a message id and counts the attempt, unless the message
+    was completed or another claim holds an unexpired lease. The holder of the claim calls ``complete`` after
+    delivering the message, or ``fail`` to release it for retries, with the ``token`` of its claim. They return False
+    and change nothing when the lease expired and was taken by another claim.
+    """
+
+    @abc.abstractmethod
+    def claim(self, message_id, lease: float) -> Claim:
+        pass
+
+    @abc.abstractmethod
+    def complete(self, message_id, token) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def fail(self, message_id, token) -> bool:
+        pass
+
+
+class Counter:
+    """Claim of a message id, taken when entering the context and completed or failed when leaving it.
+
+    It is true when the message was already delivered, ``value`` is the number of attempts including this one, and
+    ``in_progress`` tells that another delivery holds the claim. A claim held by another delivery is waited for up
+    to ``wait`` seconds, never delivering the same message in parallel.
+    """
+    __slots__ = ('_backend', '_message_id', '_lease', '_wait', '_claim')
+
+    def __init__(self, backend: DedupBackend, message_id, lease: float, wait: float = 0):
+        self._backend = backend
+        self._message_id = message_id
+        self._lease = lease
+        self._wait = wait
+        self._claim = None
+
+    def __bool__(self):
+        return self._claim.state == COMPLETED
 
     @property
     def value(self):
-        with self._lock:
-            return self._value
+        return self._claim.attempts
+
+    @property
+    def in_progress(self):
+        return self._claim.state == IN_PROGRESS
 
     def __enter__(self):
-        self.inc()
+        with stages.stage("dedup"):
+            self._claim = self._backend.claim(self._message_id, self._lease)
+        if self._claim.state == IN_PROGRESS:
+            deadline = time.monotonic() + self._wait
+            while self._claim.state == IN_PROGRESS and time.monotonic() < deadline:
+                _flights.wait(self._message_id, deadline - time.monotonic())
+                self._claim = self._backend.claim(self._message_id, self._lease)
+            _counter_coalesced.labels('rejected' if self.in_progress else self._claim.state).inc()
+        if self._claim.state == CLAIMED:
+            _flights.start(self._message_id)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_val is None:
-            self.set_success()
+        if self._claim.state == CLAIMED:
+            try:
+                if exc_val is None:
+                    released = self._backend.complete(self._message_id, self._claim.token)
+                else:
+                    released = self._backend.fail(self._message_id, self._claim.token)
+                if not released:
+                    _logger.warning("lease expired and was taken by another delivery. message_id=%s",
+                                    self._message_id)
+            finally:
+                _flights.finish(self._message_id)
+
+
+class _Entry:
+    __slots__ = ('attempts', 'completed', 'lease_expires', 'expires', 'token')
+
+    def __init__(self, completed=False):
+        self.attempts = 0
+        self.completed = completed
+        self.lease_expires = 0.0
+        self.expires = 0.0
+        self.token = None
+
+
+class DedupTable(DedupBackend):
+    """Bounded in-memory backend, forgetting ids unused for ``ttl`` seconds.
+
+    Ids are spread over ``stripes`` insertion-ordered maps, each guarded by one lock, and the least recently used id
+    of a stripe is evicted when it holds more than its share of ``size``. Ids missing from the table are looked up in
+    the optional ``journal`` of completed ids.
+    """
+
+    def __init__(self, size: int = 10000, ttl: float = 86400, stripes: int = 16, journal=None):
+        self.size = size
+        self.ttl = ttl
+        self.journal = journal
+        self._stripe_size = max(1, -(-size // stripes))
+        self._stripes = [(threading.Lock(), collections.OrderedDict()) for _ in range(stripes)]
+
+    def __len__(self):
+        return sum(len(entries) for _, entries in self._stripes)
+
+    def claim(self, message_id, lease: float) -> Claim:
+        lock, entries = self._stripe(message_id)
+        now = time.monotonic()
+        with lock:
+            entry = entries.get(message_id)
+            if entry is None or entry.expires <= now:
+                entry = _Entry(completed=self.journal is not None and message_id in self.journal)
+                entries[message_id] = entry
+            entries.move_to_end(message_id)
+            entry.expires = now + self.ttl
+            self._evict(entries, now)
+
+            if entry.completed:
+                return Claim(COMPLETED, entry.attempts)
+            if entry.lease_expires > now:
+                return Claim(IN_PROGRESS, entry.attempts)
+            entry.attempts += 1
+            entry.lease_expires = now + lease
+            entry.token = uuid.uuid4().hex
+            return Claim(CLAIMED, entry.attempts, entry.token)
+
+    def complete(self, message_id, token) -> bool:
+        released = self._release(message_id, token, completed=True)
+        if released and self.journal is not None:
+            self.journal.add(message_id)
+        return released
+
+    def fail(self, message_id, token) -> bool:
+        return self._release(message_id, token, completed=False)
+
+    def _release(self, message_id, token, completed: bool) -> bool:
+        lock, entries = self._stripe(message_id)
+        with lock:
+            entry = entries.get(message_id)
+            if entry is None or entry.token != token:
+                return False
+            entry.token = None
+            entry.lease_expires = 0.0
+            entry.completed = completed
+            return True
+
+    def _stripe(self, message_id):
+        return self._stripes[hash(message_id) % len(self._stripes)]
+
+    @staticmethod
+    def _expired(entries, now) -> bool:
+        return bool(entries) and next(iter(entries.values())).expires <= now
+
+    def _evict(self, entries: collections.OrderedDict, now: float):
+        while self._expired(entries, now):
+            entries.popitem(last=False)
+            _counter_evictions.labels('expired').inc()
+        while len(entries) > self._stripe_size:
+            entries.popitem(last=False)
+            _counter_evictions.labels('capacity').inc()
+
+    def clear(self):
+        for lock, entries in self._stripes:
+            with lock:
+                entries.clear()
+
+
+_backend = DedupTable()
+_lease = 600.0
+_wait = 0.0
+_gauge_entries.set_function(lambda: len(_backend) if isinstance(_backend, DedupTable) else 0)
 
 
-@functools.lru_cache
-def _counter(m_id):
-    return Counter()
+def configure(size: int = 10000, ttl: float = 86400, journal=None, backend: DedupBackend = None,
+              lease: float = 600, wait: float = 0):
+    """Sets the backend of ``count``, by default a ``DedupTable`` of the given ``size``, ``ttl`` and ``journal``. """
+    global _backend, _lease, _wait
+    _backend = backend if backend is not None else DedupTable(size=size, ttl=ttl, journal=journal)
+    _lease = lease
+    _wait = wait
 
 
 def count(message_id) -> Counter:
-    return _counter(message_id)
+    return Counter(_backend, message_id, _lease, _wait)
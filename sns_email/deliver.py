@@ -3,21 +3,38 @@ import subprocess
 
 import prometheus_client
 
-from sns_email import logger
+from sns_email import logger, stages
 
 _logger = logger.getChild('deliver')
 
 _counter_received = prometheus_client.Counter('sns_email_received_total', 'Received total')
 
 
+class encoding_writer:
+    """Binary file wrapper also accepting str, as written by receive_mail for inline content. """
+
+    def __init__(self, f, encoding="utf-8"):
+        self.f = f
+        self.encoding = encoding
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode(self.encoding)
+        return self.f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
 class sendmail_deliver:
     def __init__(self, source, recipients, sendmail_path="/usr/bin/sendmail"):
-        self.p = subprocess.Popen([sendmail_path, "-r", source, "-i"] + recipients,
-                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with stages.stage("sendmail_spawn"):
+            self.p = subprocess.Popen([sendmail_path, "-r", source, "-i"] + recipients,
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         self.recipients = recipients
 
     def __enter__(self):
-        return self.p.stdin
+        return encoding_writer(self.p.stdin)
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
         if exc_value:
@@ -28,7 +45,8 @@ class sendmail_deliver:
                 _logger.warning("failed aborting delivery process.", exc_info=True)
             return
         try:
-            outs, errs = self.p.communicate(timeout=15)
+            with stages.stage("sendmail_communicate"):
+                outs, errs = self.p.communicate(timeout=15)
         except subprocess.TimeoutExpired:
             self.p.kill()
             outs, errs = self.p.communicate()
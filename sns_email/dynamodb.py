@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+import time
+import uuid
+
+import botocore.exceptions
+
+import sns_email
+from sns_email import logger
+from sns_email.counter import DedupBackend, Claim, CLAIMED, COMPLETED, IN_PROGRESS
+
+_logger = logger.getChild('dynamodb')
+
+
+class DynamoDbDedup(DedupBackend):
+    """Dedup backend shared by several nodes in a DynamoDB table, using conditional writes.
+
+    The table has the string hash key ``message_id``; enabling DynamoDB TTL on the ``expires`` attribute removes ids
+    completed more than ``ttl`` seconds ago. A claim expires after its lease, so that the message of a crashed node
+    can be delivered by another one.
+    """
+
+    def __init__(self, table_name: str, region: str = None, ttl: float = 86400,
+                 boto_session=None, endpoint_url: str = None):
+        self.table_name = table_name
+        self.ttl = ttl
+        if boto_session is not None:
+            self.client = boto_session().client('dynamodb', region_name=region, endpoint_url=endpoint_url)
+        else:
+            self.client = sns_email.boto_client('dynamodb', region=region, endpoint_url=endpoint_url)
+
+    def claim(self, message_id, lease: float) -> Claim:
+        now = time.time()
+        token = uuid.uuid4().hex
+        try:
+            response = self.client.update_item(
+                TableName=self.table_name,
+                Key={'message_id': {'S': str(message_id)}},
+                UpdateExpression="SET #state = :claimed, lease_expires = :lease, expires = :expires, #token = :token "
+                                 "ADD attempts :one",
+                ConditionExpression="attribute_not_exists(message_id) OR expires < :now "
+                                    "OR (#state <> :completed AND lease_expires < :now)",
+                ExpressionAttributeNames={'#state': 'state', '#token': 'token'},
+                ExpressionAttributeValues={
+                    ':claimed': {'S': CLAIMED},
+                    ':token': {'S': token},
+                    ':completed': {'S': COMPLETED},
+                    ':lease': {'N': repr(now + lease)},
+                    ':expires': {'N': repr(now + self.ttl)},
+                    ':now': {'N': repr(now)},
+                    ':one': {'N': '1'},
+                },
+                ReturnValues='ALL_NEW')
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        else:
+            return Claim(CLAIMED, int(response['Attributes']['attempts']['N']), token)
+
+        item = self.client.get_item(TableName=self.table_name, Key={'message_id': {'S': str(message_id)}},
+                                    ConsistentRead=True).get('Item', {})
+        attempts = int(item.get('attempts', {}).get('N', 0))
+        if item.get('state', {}).get('S') == COMPLETED:
+            return Claim(COMPLETED, attempts)
+        return Claim(IN_PROGRESS, attempts)
+
+    def complete(self, message_id, token) -> bool:
+        return self._release(message_id, token,
+                             "SET #state = :completed, expires = :expires REMOVE lease_expires, #token",
+                             {':completed': {'S': COMPLETED}, ':expires': {'N': repr(time.time() + self.ttl)}})
+
+    def fail(self, message_id, token) -> bool:
+        return self._release(message_id, token, "SET lease_expires = :zero REMOVE #token", {':zero': {'N': '0'}})
+
+    def _release(self, message_id, token, update_expression: str, values: dict) -> bool:
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={'message_id': {'S': str(message_id)}},
+                UpdateExpression=update_expression,
+                ConditionExpression="#state = :claimed AND #token = :token",
+                ExpressionAttributeNames={'#state': 'state', '#token': 'token'},
+                ExpressionAttributeValues={':claimed': {'S': CLAIMED}, ':token': {'S': token}, **values})
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            _logger.debug("claim was already released or taken over. message_id=%s", message_id)
+            return False
+        return True
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+import abc
+import sqlite3
+import threading
+import time
+import uuid
+
+from sns_email import logger
+from sns_email.counter import DedupBackend, Claim, CLAIMED, COMPLETED, IN_PROGRESS
+
+_logger = logger.getChild('journal')
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+class _Compacting(abc.ABC):
+    """Deletes expired rows every ``compact_interval`` seconds in a thread, never if 0.
+
+    Compaction uses its own connection and deletes in small transactions, so that deliveries only wait for one
+    batch at a time.
+    """
+    path: str
+    compact_interval: float
+    batch_size = 1000
+
+    def _start_compaction(self):
+        self._closing = threading.Event()
+        self._compactor = None
+        if self.compact_interval > 0:
+            self._compactor = threading.Thread(target=self._run_compaction, name="journal-compact", daemon=True)
+            self._compactor.start()
+
+    def _stop_compaction(self):
+        self._closing.set()
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+
+    def _run_compaction(self):
+        while not self._closing.wait(self.compact_interval):
+            try:
+                self.compact()
+            except sqlite3.Error:
+                _logger.warning("failed compacting. path=%s", self.path, exc_info=True)
+
+    def compact(self):
+        db = _connect(self.path)
+        try:
+            deleted = 0
+            while not self._closing.is_set():
+                count = self._delete_expired(db, time.time())
+                deleted += count
+                if count < self.batch_size:
+                    break
+            db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        finally:
+            db.close()
+        _logger.debug("compacted. path=%s, deleted=%d", self.path, deleted)
+
+    @abc.abstractmethod
+    def _delete_expired(self, db: sqlite3.Connection, now: float) -> int:
+        """Deletes at most ``batch_size`` rows expired at ``now``, returning how many were deleted. """
+
+
+class DedupJournal(_Compacting):
+    """SQLite journal of completed message ids, so that duplicates are still recognized after a restart.
+
+    The database uses WAL mode and is opened without loading its content, each id is looked up by primary key.
+    Ids completed more than ``ttl`` seconds ago are deleted every ``compact_interval`` seconds.
+    """
+
+    def __init__(self, path: str, ttl: float = 86400, compact_interval: float = 3600):
+        self.path = path
+        self.ttl = ttl
+        self.compact_interval = compact_interval
+        self._lock = threading.Lock()
+        self._db = _connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS completed "
+                         "(message_id TEXT PRIMARY KEY, completed REAL NOT NULL) WITHOUT ROWID")
+        self._db.execute("CREATE INDEX IF NOT EXISTS completed_time ON completed (completed)")
+        self._start_compaction()
+
+    def __contains__(self, message_id) -> bool:
+        with self._lock:
+            row = self._db.execute("SELECT completed FROM completed WHERE message_id = ?",
+                                   (str(message_id),)).fetchone()
+        return row is not None and row[0] > time.time() - self.ttl
+
+    def add(self, message_id):
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO completed (message_id, completed) VALUES (?, ?)",
+                             (str(message_id), now))
+
+    def _delete_expired(self, db: sqlite3.Connection, now: float) -> int:
+        return db.execute("DELETE FROM completed WHERE message_id IN "
+                          "(SELECT message_id FROM completed WHERE completed <= ? LIMIT ?)",
+                          (now - self.ttl, self.batch_size)).rowcount
+
+    def close(self):
+        self._stop_compaction()
+        with self._lock:
+            self._db.close()
+
+
+class SqliteDedup(_Compacting, DedupBackend):
+    """Dedup backend in a SQLite database, shared by the processes of one node.
+
+    Each claim is decided in an immediate transaction, so that processes see each other's claims. Ids are forgotten
+    ``ttl`` seconds after they were last claimed or completed, and deleted every ``compact_interval`` seconds.
+    """
+
+    def __init__(self, path: str, ttl: float = 86400, compact_interval: float = 3600):
+        self.path = path
+        self.ttl = ttl
+        self.compact_interval = compact_interval
+        self._lock = threading.Lock()
+        self._db = _connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS claims "
+                         "(message_id TEXT PRIMARY KEY, attempts INTEGER NOT NULL, lease_expires REAL NOT NULL, "
+                         "completed INTEGER NOT NULL, expires REAL NOT NULL, token TEXT) WITHOUT ROWID")
+        self._db.execute("CREATE INDEX IF NOT EXISTS claims_expires ON claims (expires)")
+        self._start_compaction()
+
+    def claim(self, message_id, lease: float) -> Claim:
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute("SELECT attempts, lease_expires, completed FROM claims "
+                                       "WHERE message_id = ? AND expires > ?", (str(message_id), now)).fetchone()
+                attempts, lease_expires, completed = row if row is not None else (0, 0.0, False)
+                if completed:
+                    claim = Claim(COMPLETED, attempts)
+                elif lease_expires > now:
+                    claim = Claim(IN_PROGRESS, attempts)
+                else:
+                    claim = Claim(CLAIMED, attempts + 1, uuid.uuid4().hex)
+                    self._db.execute("INSERT OR REPLACE INTO claims "
+                                     "(message_id, attempts, lease_expires, completed, expires, token) "
+                                     "VALUES (?, ?, ?, 0, ?, ?)", (str(message_id), claim.attempts, now + lease,
+                                                                   now + self.ttl, claim.token))
+                self._db.execute("COMMIT")
+            except:
+                self._db.execute("ROLLBACK")
+                raise
+        return claim
+
+    def complete(self, message_id, token) -> bool:
+        now = time.time()
+        with self._lock:
+            return self._db.execute("UPDATE claims SET completed = 1, lease_expires = 0, expires = ?, token = NULL "
+                                    "WHERE message_id = ? AND token = ?",
+                                    (now + self.ttl, str(message_id), token)).rowcount == 1
+
+    def fail(self, message_id, token) -> bool:
+        with self._lock:
+            return self._db.execute("UPDATE claims SET lease_expires = 0, token = NULL "
+                                    "WHERE message_id = ? AND token = ?", (str(message_id), token)).rowcount == 1
+
+    def _delete_expired(self, db: sqlite3.Connection, now: float) -> int:
+        return db.execute("DELETE FROM claims WHERE message_id IN "
+                          "(SELECT message_id FROM claims WHERE expires <= ? LIMIT ?)",
+                          (now, self.batch_size)).rowcount
+
+    def close(self):
+        self._stop_compaction()
+        with self._lock:
+            self._db.close()
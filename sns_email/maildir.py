@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+import errno
+import itertools
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+from typing import Dict, List, Optional
+
+from sns_email import logger, _counter_errors
+from sns_email.deliver import encoding_writer, _counter_received
+
+_logger = logger.getChild('maildir')
+
+_sequence = itertools.count()
+
+
+def load_mapping(path: str) -> Dict[str, str]:
+    """Loads a file of "recipient maildir" lines, ignoring empty lines and comments starting with #. """
+    mapping = {}
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                recipient, maildir = line.split(None, 1)
+                mapping[recipient.lower()] = maildir.strip()
+    return mapping
+
+
+def _fsync_directory(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _safe_path_part(value: str) -> bool:
+    return value != "" and not value.startswith(".") and "/" not in value and "\0" not in value
+
+
+class _DirectorySyncer:
+    """Group commit of directory fsyncs: callers wait for the next sync, run at most every ``interval`` seconds. """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._condition = threading.Condition()
+        self._pending = set()
+        self._generation = 0
+        self._syncing = False
+        self._thread = None
+
+    def sync(self, directories):
+        with self._condition:
+            self._pending.update(directories)
+            # a batch being synced was taken before these directories were added, wait for the next one
+            generation = self._generation + (2 if self._syncing else 1)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="maildir-sync", daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+            while self._generation < generation:
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+            time.sleep(self.interval)
+            with self._condition:
+                pending, self._pending = self._pending, set()
+                self._syncing = True
+            for directory in pending:
+                try:
+                    _fsync_directory(directory)
+                except OSError:
+                    _logger.warning("failed syncing directory. directory=%s", directory, exc_info=True)
+            with self._condition:
+                self._generation += 1
+                self._syncing = False
+                self._condition.notify_all()
+
+
+class MaildirDelivery:
+    """Delivers emails directly into Maildir directories.
+
+    Each recipient is looked up in ``mapping``, or else the match of ``rex`` is expanded with ``template``,
+    e.g. ``/srv/mail/\\g<user>/Maildir``. Recipients are ignored when a matched group is empty, starts with "."
+    or contains "/", so that they cannot escape the directories of the template. Messages are written to ``tmp/``
+    and then linked into ``new/`` of each recipient's Maildir. With ``fsync``, the file is synced before linking and
+    the directories after, batching directory syncs of concurrent deliveries every ``fsync_interval`` seconds when
+    it is positive.
+    """
+
+    def __init__(self, template: Optional[str] = None, rex: Optional[re.Pattern] = None,
+                 mapping: Optional[Dict[str, str]] = None, fsync: bool = True, fsync_interval: float = 0):
+        self.template = template
+        self.rex = rex if rex is not None else re.compile(".*")
+        self.mapping = mapping or {}
+        self.fsync = fsync
+        self._syncer = _DirectorySyncer(fsync_interval) if fsync and fsync_interval > 0 else None
+        self._created = set()
+        self._hostname = socket.gethostname().replace("/", "\\057").replace(":", "\\072")
+
+    def __call__(self, source: str, recipients: List[str]):
+        return maildir_deliver(self, source, recipients)
+
+    def maildir(self, recipient: str) -> Optional[str]:
+        try:
+            return self.mapping[recipient.lower()]
+        except KeyError:
+            pass
+        if self.template is not None:
+            match = self.rex.match(recipient)
+            if match:
+                groups = (match.group(0),) + match.groups()
+                if not all(_safe_path_part(group) for group in groups if group is not None):
+                    _logger.warning("ignoring recipient unsafe in a path. recipient=%s", recipient)
+                    return None
+                return match.expand(self.template)
+        return None
+
+    def prepare(self, maildir: str):
+        if maildir not in self._created:
+            for name in ("tmp", "new", "cur"):
+                os.makedirs(os.path.join(maildir, name), mode=0o700, exist_ok=True)
+            self._created.add(maildir)
+
+    def unique_name(self) -> str:
+        now = time.time()
+        return "%d.M%dP%dQ%d.%s" % (now, (now % 1) * 1000000, os.getpid(), next(_sequence), self._hostname)
+
+    def sync_directories(self, directories):
+        if not self.fsync:
+            return
+        if self._syncer is not None:
+            self._syncer.sync(directories)
+        else:
+            for directory in directories:
+                _fsync_directory(directory)
+
+
+class maildir_deliver:
+    def __init__(self, delivery: MaildirDelivery, source: str, recipients: List[str]):
+        self.delivery = delivery
+        self.maildirs = []
+        for recipient in recipients:
+            maildir = delivery.maildir(recipient)
+            if maildir is None:
+                _logger.warning("ignoring recipient without maildir. recipient=%s", recipient)
+                _counter_errors.labels('maildir').inc()
+            elif maildir not in self.maildirs:
+                self.maildirs.append(maildir)
+        if not self.maildirs:
+            raise Exception("no maildir for recipients. recipients=%s" % recipients)
+
+        for maildir in self.maildirs:
+            delivery.prepare(maildir)
+        self.name = delivery.unique_name()
+        self.tmp_path = os.path.join(self.maildirs[0], "tmp", self.name)
+
+    def __enter__(self):
+        fd = os.open(self.tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        self.f = os.fdopen(fd, "wb")
+        return encoding_writer(self.f)
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        try:
+            if exc_value:
+                _logger.info("exception during delivery, aborting.")
+                self.f.close()
+                return
+            with self.f:
+                self.f.flush()
+                if self.delivery.fsync:
+                    os.fsync(self.f.fileno())
+            for maildir in self.maildirs:
+                self._link(maildir)
+            self.delivery.sync_directories([os.path.join(maildir, "new") for maildir in self.maildirs])
+            _counter_received.inc()
+        finally:
+            try:
+                os.unlink(self.tmp_path)
+            except FileNotFoundError:
+                pass
+
+    def _link(self, maildir: str):
+        new_path = os.path.join(maildir, "new", self.name)
+        try:
+            os.link(self.tmp_path, new_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # different filesystem, copy to its own tmp/ first
+            tmp_path = os.path.join(maildir, "tmp", self.name)
+            shutil.copyfile(self.tmp_path, tmp_path)
+            try:
+                if self.delivery.fsync:
+                    with open(tmp_path, "rb") as f:
+                        os.fsync(f.fileno())
+                os.link(tmp_path, new_path)
+            finally:
+                os.unlink(tmp_path)
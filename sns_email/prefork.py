@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+import glob
+import os
+import shutil
+import signal
+import time
+from typing import Callable
+
+import prometheus_client
+from prometheus_client import multiprocess
+
+from sns_email import logger
+
+_logger = logger.getChild('prefork')
+
+_counter_restarts = prometheus_client.Counter('sns_email_worker_restarts_total', 'Worker processes restarted total',
+                                              ['reason'])
+
+MULTIPROC_DIR = "PROMETHEUS_MULTIPROC_DIR"
+# set to the metrics directory when sns-email created it
+CREATED_MULTIPROC_DIR = "_SNS_EMAIL_CREATED_MULTIPROC_DIR"
+
+
+def metrics_registry() -> prometheus_client.CollectorRegistry:
+    """Returns a registry collecting the metrics of all the processes sharing ``PROMETHEUS_MULTIPROC_DIR``. """
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+class Supervisor:
+    """Forks ``processes`` workers calling ``target(index)``, and forks again the workers that exit.
+
+    Workers that exit are restarted with the same index after ``restart_delay`` seconds. ``stop``, SIGTERM or SIGINT
+    interrupt the workers with SIGINT, and kill those still running after ``stop_timeout`` seconds. The metrics
+    directory is removed once the workers are stopped when ``remove_multiproc_dir`` is true.
+    """
+
+    def __init__(self, target: Callable[[int], None], processes: int, restart_delay: float = 1,
+                 stop_timeout: float = 30, remove_multiproc_dir: bool = False):
+        self.target = target
+        self.processes = processes
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+        self.remove_multiproc_dir = remove_multiproc_dir
+        self._children = {}
+        self._stopping = False
+
+    def _spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self.target(index)
+                code = 0
+            except KeyboardInterrupt:
+                code = 0
+            except SystemExit as e:
+                code = 0 if e.code is None else e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                _logger.exception("worker failed. index=%d", index)
+            finally:
+                os._exit(code)
+        _logger.info("started worker. index=%d, pid=%d", index, pid)
+        self._children[pid] = index
+
+    def _signal(self, signum, frame):
+        self.stop()
+
+    def stop(self):
+        self._stopping = True
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        multiproc_dir = os.environ.get(MULTIPROC_DIR)
+        if multiproc_dir:
+            # metrics left by a previous run, keeping the files of this process
+            for path in glob.glob(os.path.join(multiproc_dir, "*.db")):
+                if not path.endswith("_%d.db" % os.getpid()):
+                    os.unlink(path)
+        handlers = {signum: signal.signal(signum, self._signal) for signum in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            for index in range(self.processes):
+                self._spawn(index)
+            while self._children:
+                if self._stopping:
+                    self._reap(time.monotonic() + self.stop_timeout)
+                    break
+                pid, status = os.wait()
+                index = self._exited(pid)
+                if index is None or self._stopping:
+                    continue
+                code = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status
+                if code == 0:
+                    _logger.info("worker exited, restarting it. index=%d, pid=%d", index, pid)
+                else:
+                    _logger.warning("worker failed, restarting it. index=%d, pid=%d, status=%d", index, pid, code)
+                _counter_restarts.labels('exited' if code == 0 else 'failed').inc()
+                time.sleep(self.restart_delay)
+                if not self._stopping:
+                    self._spawn(index)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            if self.remove_multiproc_dir and multiproc_dir and not self._children:
+                shutil.rmtree(multiproc_dir, ignore_errors=True)
+
+    def _exited(self, pid: int):
+        index = self._children.pop(pid, None)
+        multiproc_dir = os.environ.get(MULTIPROC_DIR)
+        if index is not None and multiproc_dir:
+            multiprocess.mark_process_dead(pid, multiproc_dir)
+        return index
+
+    def _reap(self, deadline: float):
+        while self._children:
+            for pid in list(self._children):
+                if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                    self._exited(pid)
+            if not self._children:
+                break
+            if time.monotonic() >= deadline:
+                for pid in list(self._children):
+                    _logger.warning("killing worker. pid=%d", pid)
+                    os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                    self._exited(pid)
+                break
+            time.sleep(0.1)
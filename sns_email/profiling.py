@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+import collections
+import linecache
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+from sns_email import logger
+
+_logger = logger.getChild('profiling')
+
+
+class ProfilerBusyException(Exception):
+    pass
+
+
+class Profiler:
+    """Samples the stacks of all threads on demand, and snapshots allocations with ``tracemalloc``.
+
+    ``sample`` records the stack of every other thread each ``interval`` seconds, returning how many times each
+    stack was seen. Only one sampling runs at a time. ``snapshot`` keeps the snapshot it returns, as the base of the
+    next ``diff``.
+    """
+
+    def __init__(self, interval: float = 0.005, max_seconds: float = 300):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self._sampling = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._snapshot = None
+
+    def sample(self, seconds: float) -> collections.Counter:
+        if not self._sampling.acquire(blocking=False):
+            raise ProfilerBusyException("already sampling")
+        try:
+            _logger.info("sampling stacks. seconds=%s", seconds)
+            counts = collections.Counter()
+            me = threading.get_ident()
+            deadline = time.monotonic() + min(seconds, self.max_seconds)
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    counts[tuple(reversed(stack))] += 1
+                time.sleep(self.interval)
+            return counts
+        finally:
+            self._sampling.release()
+
+    @staticmethod
+    def collapsed(counts: collections.Counter) -> str:
+        """Formats samples as collapsed stacks, as read by flame graph tools. """
+        return "".join("%s %d\n" % (";".join(stack), n) for stack, n in counts.most_common())
+
+    @staticmethod
+    def top(counts: collections.Counter, limit: int = 30) -> str:
+        """Formats the functions seen most often on top of the stacks, and anywhere in them. """
+        total = sum(counts.values())
+        own = collections.Counter()
+        cumulative = collections.Counter()
+        for stack, n in counts.items():
+            own[stack[-1]] += n
+            for function in set(stack[1:]):
+                cumulative[function] += n
+        lines = ["samples=%d" % total, "", "%8s %8s  function" % ("own", "total")]
+        for function, n in own.most_common(limit):
+            lines.append("%8d %8d  %s" % (n, cumulative[function], function))
+        lines.extend(["", "%8s  function" % "total"])
+        for function, n in cumulative.most_common(limit):
+            lines.append("%8d  %s" % (n, function))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def start_tracing(frames: int = 1):
+        if not tracemalloc.is_tracing():
+            _logger.info("starting tracemalloc. frames=%d", frames)
+            tracemalloc.start(frames)
+
+    def stop_tracing(self):
+        with self._snapshot_lock:
+            self._snapshot = None
+        if tracemalloc.is_tracing():
+            _logger.info("stopping tracemalloc.")
+            tracemalloc.stop()
+
+    def snapshot(self, limit: int = 30, key_type: str = "lineno") -> str:
+        snapshot = self._take_snapshot()
+        with self._snapshot_lock:
+            self._snapshot = snapshot
+        stats = snapshot.statistics(key_type)
+        return self._format(stats[:limit], "size=%d, count=%d" % (sum(s.size for s in stats),
+                                                                  sum(s.count for s in stats)))
+
+    def diff(self, limit: int = 30, key_type: str = "lineno") -> str:
+        snapshot = self._take_snapshot()
+        with self._snapshot_lock:
+            base = self._snapshot
+        if base is None:
+            raise ValueError("no snapshot to compare to")
+        stats = snapshot.compare_to(base, key_type)
+        return self._format(stats[:limit], "size_diff=%d" % sum(s.size_diff for s in stats))
+
+    @staticmethod
+    def _take_snapshot() -> tracemalloc.Snapshot:
+        if not tracemalloc.is_tracing():
+            raise ValueError("tracemalloc is not tracing")
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, linecache.__file__),
+        ))
+
+    @staticmethod
+    def _format(stats, summary: str) -> str:
+        return summary + "\n\n" + "".join("%s\n" % stat for stat in stats)
@@ -1,37 +1,99 @@
 #!/usr/bin/env python
 import json
 import re
+import threading
 
 import prometheus_client
 
 import sns_email.deliver
-from sns_email import logger, _counter_errors
-from sns_email.counter import count
+from sns_email import logger, _counter_errors, stages
+from sns_email.counter import count, DuplicateInProgressException
+from sns_email.s3 import S3Fetcher
 
 _receive_time = prometheus_client.Histogram('sns_email_receive_seconds', 'Time spent processing receive')
+_gauge_in_flight = prometheus_client.Gauge('sns_email_receive_in_flight', 'Mails being delivered')
 
 _logger = logger.getChild('receive')
 
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+
+def deliveries_in_flight() -> int:
+    """Returns the number of mails being delivered by this process. """
+    return _in_flight
+
+
+def _track_in_flight(delta: int):
+    global _in_flight
+    with _in_flight_lock:
+        _in_flight += delta
+    _gauge_in_flight.inc(delta)
+
 
 class MessageReceiver:
+    """Delivers the mails of SES notifications.
+
+    Mails stored in S3 are fetched with ``s3_fetcher``, or else with a fetcher created on the first such mail and
+    shut down by ``close``.
+    """
+
     def __init__(self, rex=re.compile(".*"), deliver=sns_email.deliver.sendmail_deliver,
-                 boto_session=sns_email.boto_session):
+                 boto_session=None, max_attempts=2, s3_fetcher: S3Fetcher = None):
         self.deliver = deliver
         self.boto_session = boto_session
         self.rex = rex
+        self.max_attempts = max_attempts
+        self._s3_fetcher = s3_fetcher
+        self._own_s3_fetcher = None
+        self._lock = threading.Lock()
+
+    @property
+    def s3_fetcher(self) -> S3Fetcher:
+        if self._s3_fetcher is not None:
+            return self._s3_fetcher
+        with self._lock:
+            if self._own_s3_fetcher is None:
+                self._own_s3_fetcher = S3Fetcher(boto_session=self.boto_session)
+            return self._own_s3_fetcher
+
+    def close(self):
+        with self._lock:
+            if self._own_s3_fetcher is not None:
+                self._own_s3_fetcher.close()
+                self._own_s3_fetcher = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
 
     @_receive_time.time()
     def receive_mail(self, message):
+        _track_in_flight(1)
+        try:
+            self._receive_mail(message)
+        finally:
+            _track_in_flight(-1)
+
+    def _receive_mail(self, message):
         mail = message['mail']
 
         message_id = mail['messageId']
+        stages.annotate(message_id=message_id)
         with count(message_id) as dup_check:
             if dup_check:
                 _logger.info("ignoring duplicate message that was fully processed. message_id=%s", message_id)
                 return
+            if dup_check.in_progress:
+                _logger.warning("aborting receiving a duplicate message that is being delivered. message_id=%s",
+                                message_id)
+                _counter_errors.labels('receive_duplicate').inc()
+                raise DuplicateInProgressException("duplicate message in progress")
 
             dup_count = dup_check.value
-            if dup_count > 2:
+            if self.max_attempts and dup_count > self.max_attempts:
                 _logger.warning(
                     "aborting receiving a duplicate message that already failed. message_id=%s, dup_count=%s",
                     message_id, dup_count)
@@ -53,13 +115,18 @@ class MessageReceiver:
                 mail_from = mail['commonHeaders']['from']
 
             if 'content' in message:
-                with self.deliver(source, recipients) as f:
+                with stages.stage("deliver"), self.deliver(source, recipients) as f:
                     f.write(message['content'])
             elif 'action' in receipt and 'type' in receipt['action']:
                 if 'S3' == receipt['action']['type']:
-                    with self.deliver(source, recipients) as f:
-                        self.boto_session().client('s3').download_fileobj(receipt['action']['bucketName'],
-                                                                          receipt['action']['objectKey'], f)
+                    download = self.s3_fetcher.fetch(receipt['action']['bucketName'],
+                                                     receipt['action']['objectKey'])
+                    try:
+                        with stages.stage("deliver"), self.deliver(source, recipients) as f:
+                            with stages.stage("s3_fetch"):
+                                download.write_to(f)
+                    finally:
+                        download.cancel()
                 else:
                     _logger.info("ignoring unknown receipt type. message=%s", message)
                     _counter_errors.labels('receive').inc()
@@ -71,9 +138,14 @@ class MessageReceiver:
                          source, mail_from, recipients, message_id)
 
     def receive(self, body: dict):
+        with stages.trace():
+            self._receive(body)
+
+    def _receive(self, body: dict):
         if body['Type'] == 'Notification':
             try:
-                message = json.loads(body['Message'])
+                with stages.stage("parse_message"):
+                    message = json.loads(body['Message'])
             except (json.decoder.JSONDecodeError, KeyError):
                 _logger.info("ignoring invalid notification. content=%s", body, exc_info=True)
                 _counter_errors.labels('receive').inc()
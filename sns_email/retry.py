@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+import heapq
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+import prometheus_client
+
+from sns_email import logger, _counter_errors
+from sns_email.counter import DuplicateInProgressException
+from sns_email.receive import MessageReceiver
+
+_logger = logger.getChild('retry')
+
+_counter_attempts = prometheus_client.Counter('sns_email_retry_attempts_total', 'Delivery retries total', ['outcome'])
+_counter_dead_letter = prometheus_client.Counter('sns_email_retry_dead_letter_total',
+                                                 'Notifications moved to the dead letter directory total')
+_gauge_queued = prometheus_client.Gauge('sns_email_retry_messages', 'Notifications waiting for a delivery retry')
+_gauge_age = prometheus_client.Gauge('sns_email_retry_oldest_seconds',
+                                     'Seconds since the first failure of the oldest notification waiting for a retry')
+
+
+class RetryQueue:
+    """Receiver retrying failed deliveries locally, instead of failing the notification.
+
+    Failed notifications are written to ``path`` and retried after a random delay, doubling from ``backoff_min`` up
+    to ``backoff_max`` seconds with each attempt. After ``max_attempts`` failed attempts they are moved to
+    ``dead_letter_dir``, by default ``dead-letter`` in ``path``. Waiting notifications are loaded again at startup.
+    """
+
+    def __init__(self, receiver: MessageReceiver, path: str, dead_letter_dir: str = None, max_attempts: int = 10,
+                 backoff_min: float = 30, backoff_max: float = 3600):
+        self.receiver = receiver
+        self.path = path
+        self.dead_letter_dir = dead_letter_dir or os.path.join(path, "dead-letter")
+        self.max_attempts = max_attempts
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+
+        self._condition = threading.Condition()
+        self._heap = []
+        self._first_failures = {}
+        self._sequence = itertools.count()
+        self._closing = False
+        self._thread = None
+
+        os.makedirs(path, exist_ok=True)
+        os.makedirs(self.dead_letter_dir, exist_ok=True)
+        for name in os.listdir(path):
+            if name.startswith("."):
+                # partially written by _write
+                os.unlink(os.path.join(path, name))
+            elif os.path.isfile(os.path.join(path, name)):
+                entry = self._read(name)
+                self._push(entry['due'], name, entry['first'])
+        if self._heap:
+            _logger.info("loaded notifications waiting for a retry. count=%d", len(self._heap))
+        _gauge_age.set_function(self._age)
+
+    def _age(self) -> float:
+        with self._condition:
+            first = min(self._first_failures.values(), default=None)
+        return time.time() - first if first is not None else 0.0
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.backoff_max, self.backoff_min * 2 ** min(attempts - 1, 32))
+        return random.uniform(delay / 2, delay)
+
+    def receive(self, body: dict):
+        try:
+            self.receiver.receive(body)
+        except Exception:
+            _logger.warning("delivery failed, scheduling a retry.", exc_info=True)
+            _counter_errors.labels('retry').inc()
+            now = time.time()
+            name = "%020d-%d-%d" % (time.time_ns(), os.getpid(), next(self._sequence))
+            self._schedule(name, {'attempts': 1, 'first': now, 'due': now + self.backoff(1), 'body': body})
+
+    def _read(self, name: str) -> dict:
+        with open(os.path.join(self.path, name), "rb") as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write(path: str, name: str, entry: dict):
+        # written next to its destination, which may be on another filesystem
+        with tempfile.NamedTemporaryFile(dir=path, prefix=".", suffix=".tmp", delete=False) as f:
+            f.write(json.dumps(entry).encode())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f.name, os.path.join(path, name))
+
+    def _schedule(self, name: str, entry: dict):
+        self._write(self.path, name, entry)
+        self._push(entry['due'], name, entry['first'])
+
+    def _push(self, due: float, name: str, first: float):
+        with self._condition:
+            heapq.heappush(self._heap, (due, name))
+            self._first_failures[name] = first
+            _gauge_queued.set(len(self._heap))
+            self._condition.notify()
+
+    def _next(self):
+        with self._condition:
+            while not self._closing:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    _, name = heapq.heappop(self._heap)
+                    self._first_failures.pop(name, None)
+                    _gauge_queued.set(len(self._heap))
+                    return name
+                self._condition.wait(self._heap[0][0] - now if self._heap else None)
+            return None
+
+    def _run(self):
+        while True:
+            name = self._next()
+            if name is None:
+                return
+            try:
+                self._retry(name)
+            except Exception:
+                _logger.warning("unexpected error retrying delivery. name=%s", name, exc_info=True)
+                _counter_errors.labels('retry').inc()
+
+    def _retry(self, name: str):
+        entry = self._read(name)
+        try:
+            self.receiver.receive(entry['body'])
+        except DuplicateInProgressException:
+            _logger.info("message is being delivered elsewhere, scheduling a retry. name=%s, attempts=%d", name,
+                         entry['attempts'])
+            entry['due'] = time.time() + self.backoff(entry['attempts'])
+            self._schedule(name, entry)
+        except Exception:
+            _counter_attempts.labels('failed').inc()
+            entry['attempts'] += 1
+            if entry['attempts'] >= self.max_attempts:
+                _logger.warning("delivery failed too many times, moving to dead letter. name=%s, attempts=%d",
+                                name, entry['attempts'], exc_info=True)
+                _counter_dead_letter.inc()
+                self._write(self.dead_letter_dir, name, entry)
+                os.unlink(os.path.join(self.path, name))
+            else:
+                _logger.info("delivery failed, scheduling a retry. name=%s, attempts=%d", name, entry['attempts'],
+                             exc_info=True)
+                entry['due'] = time.time() + self.backoff(entry['attempts'])
+                self._schedule(name, entry)
+        else:
+            _logger.info("delivered after retrying. name=%s, attempts=%d", name, entry['attempts'] + 1)
+            _counter_attempts.labels('delivered').inc()
+            os.unlink(os.path.join(self.path, name))
+
+    def close(self):
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name="retry")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
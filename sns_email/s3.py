@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+
+import botocore.exceptions
+import prometheus_client
+
+import sns_email
+from sns_email import logger
+
+_logger = logger.getChild('s3')
+
+_counter_bytes = prometheus_client.Counter('sns_email_s3_received_bytes_total', 'Bytes fetched from S3 total')
+_counter_spilled = prometheus_client.Counter('sns_email_s3_spilled_bytes_total',
+                                             'Bytes fetched from S3 buffered on disk total')
+_gauge_memory = prometheus_client.Gauge('sns_email_s3_buffer_memory_bytes',
+                                        'Memory reserved for buffering parts fetched from S3')
+_first_byte_time = prometheus_client.Histogram('sns_email_s3_first_byte_seconds',
+                                               'Time from the start of a S3 fetch to its first byte')
+_fetch_time = prometheus_client.Histogram('sns_email_s3_fetch_seconds', 'Time spent fetching S3 objects')
+
+_content_range = re.compile(r"bytes \d+-\d+/(\d+)")
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class _MemoryBudget:
+    """Bytes of memory shared by the buffers of all downloads, unlimited when ``limit`` is 0. """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def take(self, size: int) -> int:
+        """Reserves up to ``size`` bytes, returning how many were reserved. """
+        with self._lock:
+            if self.limit:
+                size = max(0, min(size, self.limit - self.used))
+            self.used += size
+        _gauge_memory.inc(size)
+        return size
+
+    def give(self, size: int):
+        with self._lock:
+            self.used -= size
+        _gauge_memory.dec(size)
+
+
+class S3Fetcher:
+    """Fetches S3 objects with concurrent ranged GETs of ``part_size`` bytes, on a pool of ``workers`` threads.
+
+    ``fetch`` requests the first part right away, before the delivery is ready, and the returned ``S3Download``
+    keeps up to ``window`` GETs in flight until the whole object is fetched, while ``write_to`` writes the parts
+    in order.
+
+    Parts waiting to be written are buffered in memory up to ``message_memory`` bytes for each download, and up to
+    ``max_memory`` bytes for all downloads together, 0 for no limit. Beyond that they spill to temporary files, so
+    that a slow delivery neither stalls the GETs nor grows the memory.
+    """
+
+    def __init__(self, part_size: int = 8 * 1024 * 1024, window: int = 4, workers: int = 8,
+                 message_memory: int = 32 * 1024 * 1024, max_memory: int = 256 * 1024 * 1024, boto_session=None):
+        self.part_size = part_size
+        self.window = max(window, 1)
+        self.workers = workers
+        self.message_memory = message_memory
+        self.boto_session = boto_session
+        self._memory = _MemoryBudget(max_memory)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="s3-fetch")
+
+    def client(self):
+        if self.boto_session is not None:
+            return self.boto_session().client('s3')
+        return sns_email.boto_client('s3', max_pool_connections=self.workers)
+
+    def fetch(self, bucket: str, key: str) -> 'S3Download':
+        return S3Download(self, self.client(), bucket, key)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        try:
+            self.client()
+        except Exception:
+            _logger.warning("failed creating s3 client.", exc_info=True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+class _Part:
+    __slots__ = ('buffer', 'memory', 'size')
+
+    def __init__(self, buffer, memory: int):
+        self.buffer = buffer
+        self.memory = memory
+        self.size = 0
+
+
+class S3Download:
+    """Ranged GETs of one object, started on creation and written in order by ``write_to``. """
+
+    def __init__(self, fetcher: S3Fetcher, s3, bucket: str, key: str):
+        self.fetcher = fetcher
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.size = None
+        self._start = time.perf_counter()
+        self._first_byte = None
+        self._lock = threading.RLock()
+        self._submitted = threading.Condition(self._lock)
+        self._parts = []
+        self._next = 0
+        self._in_flight = 0
+        self._memory = 0
+        self._cancelled = False
+        # the first part tells the size of the object
+        with self._lock:
+            self._submit()
+
+    def _submit(self):
+        start = self._next * self.fetcher.part_size
+        self._next += 1
+        self._in_flight += 1
+        future = self.fetcher._executor.submit(self._get, start, start + self.fetcher.part_size - 1)
+        self._parts.append(future)
+        future.add_done_callback(self._fetched)
+
+    def _fetched(self, future):
+        # read ahead of write_to, the parts it did not take yet spill to disk past the memory budget
+        with self._lock:
+            self._in_flight -= 1
+            if future.cancelled() or future.exception() is not None or self._cancelled:
+                return
+            while self._remaining() and self._in_flight < self.fetcher.window:
+                self._submit()
+            self._submitted.notify_all()
+
+    def _reserve(self) -> int:
+        with self._lock:
+            memory = self.fetcher._memory.take(
+                max(0, min(self.fetcher.part_size, self.fetcher.message_memory - self._memory)))
+            self._memory += memory
+        return memory
+
+    def _get(self, first: int, last: int) -> _Part:
+        memory = self._reserve()
+        part = _Part(tempfile.SpooledTemporaryFile(max_size=memory) if memory else tempfile.TemporaryFile(), memory)
+        try:
+            try:
+                response = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range="bytes=%d-%d" % (first, last))
+            except botocore.exceptions.ClientError as e:
+                if first == 0 and e.response.get('Error', {}).get('Code') == 'InvalidRange':
+                    # empty object
+                    self.size = 0
+                    return part
+                raise
+            if first == 0:
+                match = _content_range.match(response.get('ContentRange', ""))
+                self.size = int(match.group(1)) if match else response['ContentLength']
+            body = response['Body']
+            try:
+                for chunk in body.iter_chunks(_CHUNK_SIZE):
+                    if self._first_byte is None:
+                        self._first_byte = time.perf_counter() - self._start
+                    part.buffer.write(chunk)
+                    part.size += len(chunk)
+            finally:
+                body.close()
+            if part.size > memory:
+                _counter_spilled.inc(part.size)
+            return part
+        except:
+            self._discard(part)
+            raise
+
+    def _discard(self, part: _Part):
+        part.buffer.close()
+        with self._lock:
+            self._memory -= part.memory
+        self.fetcher._memory.give(part.memory)
+
+    def _discard_future(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self._discard(future.result())
+
+    def _remaining(self) -> bool:
+        return self.size is not None and self._next * self.fetcher.part_size < self.size
+
+    def _take(self):
+        with self._lock:
+            # the part written last is done, but its callback may not have requested the next ones yet
+            self._submitted.wait_for(lambda: self._parts or not self._remaining())
+            return self._parts.pop(0) if self._parts else None
+
+    def write_to(self, f):
+        """Writes the object to ``f`` as its parts arrive, returning its size. """
+        written = 0
+        with _fetch_time.time():
+            while True:
+                future = self._take()
+                if future is None:
+                    break
+                part = future.result()
+                try:
+                    if written == 0:
+                        _first_byte_time.observe(self._first_byte or 0.0)
+                    part.buffer.seek(0)
+                    while True:
+                        chunk = part.buffer.read(_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                    written += part.size
+                    _counter_bytes.inc(part.size)
+                finally:
+                    self._discard(part)
+        if written != self.size:
+            raise IOError("incomplete S3 object. key=%s, size=%s, written=%d" % (self.key, self.size, written))
+        elapsed = time.perf_counter() - self._start
+        _logger.debug("fetched s3 object. key=%s, size=%d, seconds=%.3f, bytes_per_second=%.0f",
+                      self.key, written, elapsed, written / elapsed if elapsed > 0 else 0.0)
+        return written
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            parts, self._parts = self._parts, []
+        for part in parts:
+            if not part.cancel():
+                part.add_done_callback(self._discard_future)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+import os
+import queue
+import selectors
+import smtplib
+import subprocess
+import tempfile
+import threading
+from typing import List
+
+import prometheus_client
+
+from sns_email import logger, _counter_errors
+from sns_email.deliver import encoding_writer, _counter_received
+
+_logger = logger.getChild('smtp')
+
+_gauge_connections = prometheus_client.Gauge('sns_email_smtp_connections', 'SMTP pool connections', ['state'])
+_counter_connects = prometheus_client.Counter('sns_email_smtp_connects_total', 'SMTP connections opened total')
+_counter_broken = prometheus_client.Counter('sns_email_smtp_broken_total', 'SMTP broken connections total')
+_counter_recycled = prometheus_client.Counter('sns_email_smtp_recycled_total', 'SMTP connections recycled total')
+
+_SPOOL_SIZE = 1024 * 1024
+_CHUNK_SIZE = 64 * 1024
+
+
+def _send_data(connection: smtplib.SMTP, f):
+    """Sends the content of the binary file f as DATA payload, with dot-stuffing and CRLF line endings. """
+    chunk = bytearray()
+    for line in f:
+        if line.endswith(b"\r\n"):
+            line = line[:-2]
+        elif line.endswith(b"\n"):
+            line = line[:-1]
+        if line.startswith(b"."):
+            chunk.extend(b".")
+        chunk.extend(line)
+        chunk.extend(b"\r\n")
+        if len(chunk) >= _CHUNK_SIZE:
+            connection.send(bytes(chunk))
+            chunk.clear()
+    chunk.extend(b".\r\n")
+    connection.send(bytes(chunk))
+
+
+class _PipeReader:
+    """Line reader of a process output, failing with TimeoutError like a socket. """
+
+    def __init__(self, f, timeout: float):
+        self.f = f
+        self.timeout = timeout
+        self.buffer = bytearray()
+
+    def readline(self, limit: int = -1) -> bytes:
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.f, selectors.EVENT_READ)
+            while True:
+                end = self.buffer.find(b"\n") + 1
+                if 0 <= limit < (end or len(self.buffer) + 1):
+                    end = limit
+                if end:
+                    line = bytes(self.buffer[:end])
+                    del self.buffer[:end]
+                    return line
+                if not selector.select(self.timeout):
+                    raise TimeoutError("timed out reading from process")
+                data = os.read(self.f.fileno(), 4096)
+                if not data:
+                    line = bytes(self.buffer)
+                    self.buffer.clear()
+                    return line
+                self.buffer.extend(data)
+
+    def close(self):
+        pass
+
+
+class _PipeSocket:
+    """Socket-like connection to a ``sendmail -bs`` process, speaking SMTP on its stdin and stdout. """
+
+    def __init__(self, args: List[str], timeout: float):
+        self.p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.timeout = timeout
+
+    def sendall(self, data: bytes):
+        self.p.stdin.write(data)
+        self.p.stdin.flush()
+
+    def makefile(self, mode: str):
+        return _PipeReader(self.p.stdout, self.timeout)
+
+    def close(self):
+        try:
+            self.p.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.p.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            self.p.kill()
+            self.p.wait()
+        self.p.stdout.close()
+
+
+class SendmailSession(smtplib.SMTP):
+    """SMTP session with a ``sendmail -bs`` process. """
+
+    def __init__(self, sendmail_path: str, timeout: float):
+        self.sendmail_path = sendmail_path
+        super().__init__(timeout=timeout)
+
+    def _get_socket(self, host, port, timeout):
+        return _PipeSocket([self.sendmail_path, "-bs"], timeout)
+
+
+class SmtpPool:
+    """Pool of persistent SMTP or LMTP sessions to the local MTA.
+
+    Calling the pool returns a context manager delivering a message, as expected by ``MessageReceiver``.
+    Sessions are checked with RSET before reuse, broken ones are replaced by new connections, and all are
+    replaced after sending ``max_messages`` messages. LMTP also accepts an absolute path of a unix socket as
+    ``host``. Recipients refused with a permanent 5xx reply are logged and dropped, a temporary 4xx reply fails the
+    delivery so that the notification is retried.
+    """
+    reuse_after_error = True
+
+    def __init__(self, host: str = "localhost", port: int = 0, size: int = 4, lmtp: bool = False,
+                 timeout: float = 30, max_messages: int = 0):
+        self.host = host
+        self.port = port or (smtplib.LMTP_PORT if lmtp else smtplib.SMTP_PORT)
+        self.lmtp = lmtp
+        self.timeout = timeout
+        self.max_messages = max_messages
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def __call__(self, source: str, recipients: List[str]):
+        return smtp_deliver(self, source, recipients)
+
+    def close(self):
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            _gauge_connections.labels('idle').dec()
+            self._close(connection, quit=True)
+
+    def _connect(self) -> smtplib.SMTP:
+        connection = smtplib.LMTP() if self.lmtp else smtplib.SMTP()
+        connection.timeout = self.timeout
+        connection.connect(self.host, self.port)
+        connection.ehlo_or_helo_if_needed()
+        _logger.debug("connected. host=%s, port=%s", self.host, self.port)
+        return connection
+
+    @staticmethod
+    def _close(connection: smtplib.SMTP, quit: bool = False):
+        try:
+            if quit:
+                connection.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        finally:
+            connection.close()
+
+    def acquire(self) -> smtplib.SMTP:
+        if not self._slots.acquire(timeout=self.timeout):
+            raise Exception("no SMTP connection available. host=%s, port=%s" % (self.host, self.port))
+        try:
+            while True:
+                try:
+                    connection = self._idle.get_nowait()
+                except queue.Empty:
+                    connection = self._connect()
+                    connection.messages = 0
+                    _counter_connects.inc()
+                    break
+                _gauge_connections.labels('idle').dec()
+                try:
+                    code, _ = connection.rset()
+                except (smtplib.SMTPException, OSError):
+                    code = None
+                if code == 250:
+                    break
+                _logger.info("replacing broken connection. host=%s, port=%s", self.host, self.port)
+                _counter_broken.inc()
+                self._close(connection)
+        except:
+            self._slots.release()
+            raise
+        _gauge_connections.labels('busy').inc()
+        return connection
+
+    def release(self, connection: smtplib.SMTP, broken: bool = False):
+        _gauge_connections.labels('busy').dec()
+        if broken:
+            _counter_broken.inc()
+            self._close(connection)
+        elif self.max_messages and connection.messages >= self.max_messages:
+            _counter_recycled.inc()
+            self._close(connection, quit=True)
+        else:
+            self._idle.put(connection)
+            _gauge_connections.labels('idle').inc()
+        self._slots.release()
+
+    def send(self, source: str, recipients: List[str], f):
+        """Sends the message in binary file f, retrying once on a new connection if the session broke. """
+        for attempt in (1, 2):
+            connection = self.acquire()
+            try:
+                f.seek(0)
+                refused = self._transaction(connection, source, recipients, f)
+            except (smtplib.SMTPSenderRefused, smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError):
+                # the transaction was completed or reset, the session can be reused
+                self.release(connection, broken=not self.reuse_after_error)
+                raise
+            except OSError:
+                self.release(connection, broken=True)
+                if attempt == 2:
+                    raise
+                _logger.info("connection lost during delivery, retrying. host=%s, port=%s", self.host, self.port)
+            except:
+                self.release(connection, broken=True)
+                raise
+            else:
+                connection.messages += 1
+                self.release(connection)
+                return refused
+
+    def _transaction(self, connection: smtplib.SMTP, source: str, recipients: List[str], f) -> dict:
+        code, response = connection.mail(source)
+        if code != 250:
+            connection.rset()
+            raise smtplib.SMTPSenderRefused(code, response, source)
+        accepted, refused = [], {}
+        for recipient in recipients:
+            code, response = connection.rcpt(recipient)
+            if code in (250, 251):
+                accepted.append(recipient)
+            else:
+                refused[recipient] = (code, response)
+        if not accepted:
+            connection.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, response = connection.docmd("data")
+        if code != 354:
+            connection.rset()
+            raise smtplib.SMTPDataError(code, response)
+        _send_data(connection, f)
+
+        # LMTP answers once for each accepted recipient
+        for recipient in (accepted if self.lmtp else accepted[:1]):
+            code, response = connection.getreply()
+            if code != 250:
+                if not self.lmtp:
+                    raise smtplib.SMTPDataError(code, response)
+                refused[recipient] = (code, response)
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+
+class SendmailPool(SmtpPool):
+    """Pool of long-lived ``sendmail -bs`` processes, for hosts without a SMTP listener.
+
+    Sessions are replaced after an error or after sending ``max_messages`` messages.
+    """
+    reuse_after_error = False
+
+    def __init__(self, sendmail_path: str = "/usr/bin/sendmail", size: int = 2, timeout: float = 30,
+                 max_messages: int = 100):
+        super().__init__(host=sendmail_path, size=size, timeout=timeout, max_messages=max_messages)
+
+    def _connect(self) -> smtplib.SMTP:
+        connection = SendmailSession(self.host, timeout=self.timeout)
+        connection.connect()
+        connection.ehlo_or_helo_if_needed()
+        _logger.debug("started session. sendmail_path=%s", self.host)
+        return connection
+
+
+class smtp_deliver:
+    def __init__(self, pool: SmtpPool, source: str, recipients: List[str]):
+        self.pool = pool
+        self.source = source
+        self.recipients = recipients
+        self.f = tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+
+    def __enter__(self):
+        return encoding_writer(self.f)
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        with self.f:
+            if exc_value:
+                _logger.info("exception during delivery, aborting.")
+                return
+            refused = self.pool.send(self.source, self.recipients, self.f)
+        if refused:
+            _logger.warning("recipients refused. source=%s, refused=%s", self.source, refused)
+            _counter_errors.labels('smtp').inc()
+            # temporary failures must be retried, at the cost of delivering again to the accepted recipients
+            deferred = {recipient: reply for recipient, reply in refused.items() if 400 <= reply[0] < 500}
+            if deferred:
+                raise smtplib.SMTPRecipientsRefused(deferred)
+        _counter_received.inc()
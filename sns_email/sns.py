@@ -1,52 +1,167 @@
 #!/usr/bin/env python
 import json
+import queue
+import selectors
+import socket
+import threading
+import time
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from typing import Tuple
+from typing import Optional, Tuple
+from urllib.parse import urlparse, parse_qs
 
 import prometheus_client
+from prometheus_client.exposition import choose_encoder
 
-from sns_email import logger, _counter_errors
+from sns_email import logger, _counter_errors, stages
+from sns_email.counter import DuplicateInProgressException
 from sns_email.receive import MessageReceiver
+from sns_email.spool import SpoolFullException
 from sns_email.sns_signature import sns_verify_signature, InvalidSnsSignatureException
 
 _logger = logger.getChild('sns')
 
 _counter_sns = prometheus_client.Counter('sns_email_sns_received_total', 'SNS received total')
 _counter_sns_time = prometheus_client.Histogram('sns_email_sns_handle_seconds', 'SNS HTTP handle time')
+_counter_rejected = prometheus_client.Counter('sns_email_sns_rejected_total', 'SNS HTTP requests rejected total')
+_gauge_queued = prometheus_client.Gauge('sns_email_sns_queued_requests', 'SNS HTTP requests waiting for a worker')
+
+_RESPONSE_UNAVAILABLE = ("HTTP/1.0 %d %s\r\n"
+                         "Content-Length: 0\r\n"
+                         "Retry-After: 1\r\n"
+                         "Connection: close\r\n\r\n" % (HTTPStatus.SERVICE_UNAVAILABLE,
+                                                        HTTPStatus.SERVICE_UNAVAILABLE.phrase)).encode()
+
+
+def handle_notification(receiver: Optional[MessageReceiver], content_bytes: bytes):
+    """Verifies the signature of a SNS HTTP request body and passes the notification to the receiver.
+
+    Invalid notifications are logged and ignored, errors of the receiver are propagated.
+    """
+    with stages.trace(source="sns"):
+        _handle_notification(receiver, content_bytes)
+
+
+def _handle_notification(receiver: Optional[MessageReceiver], content_bytes: bytes):
+    try:
+        with stages.stage("parse_notification"):
+            body = json.loads(content_bytes)
+        sns_verify_signature(body)
+    except json.decoder.JSONDecodeError:
+        _logger.warning("ignoring invalid message. content=%s", content_bytes, exc_info=True)
+        _counter_errors.labels('sns').inc()
+    except InvalidSnsSignatureException:
+        _logger.warning("ignoring message with invalid signature. content=%s", content_bytes, exc_info=True)
+        _counter_errors.labels('sns').inc()
+    else:
+        if receiver is not None:
+            receiver.receive(body)
+        else:
+            _logger.info("received notification. body=%s", body)
+        _counter_sns.inc()
+
+
+def metrics_output(registry, path: str, accept_header: Optional[str]) -> Tuple[str, bytes]:
+    """Returns the content type and the exposition of the metrics in registry requested by path. """
+    encoder, content_type = choose_encoder(accept_header)
+    params = parse_qs(urlparse(path).query)
+    if 'name[]' in params:
+        registry = registry.restricted_registry(params['name[]'])
+    return content_type, encoder(registry)
+
+
+class MetricsHandler(prometheus_client.MetricsHandler):
+    """MetricsHandler sending a Content-Length, as needed by persistent connections. """
+
+    def do_GET(self):
+        content_type, output = metrics_output(self.registry, self.path, self.headers.get('Accept'))
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
 
 
 class SnsHandler(BaseHTTPRequestHandler):
+    """Handler for SNS HTTP requests.
+
+    Connections are kept open between requests for up to ``timeout`` seconds, and closed after
+    ``max_requests`` requests. Idle connections are closed early when the server is ``busy()``, so that
+    they do not keep a worker from connections waiting in the queue.
+    """
+    protocol_version = "HTTP/1.1"
     receiver: MessageReceiver = None
+    timeout = 15
+    max_requests = 100
+    poll_interval = 0.5
+
+    def handle(self):
+        self._requests = 0
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._wait_request():
+            self.handle_one_request()
+
+    def _wait_request(self) -> bool:
+        """Waits for the next request on a persistent connection, returns False if the connection should close. """
+        self.connection.setblocking(False)
+        try:
+            if self.rfile.peek(1):
+                return True
+        finally:
+            self.connection.settimeout(self.timeout)
+
+        deadline = time.monotonic() + self.timeout
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.connection, selectors.EVENT_READ)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                if selector.select(min(remaining, self.poll_interval)):
+                    return True
+                busy = getattr(self.server, "busy", None)
+                if busy is not None and busy():
+                    return False
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        self._requests += 1
+        if self._requests >= self.max_requests:
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        elif self.request_version != self.protocol_version and code < 400:
+            self.send_header('Connection', 'keep-alive')
 
     @_counter_sns_time.time()
     def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
+        try:
+            content_length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.send_error(HTTPStatus.LENGTH_REQUIRED)
+            return
+        content_bytes = b""
         try:
             content_bytes = self.rfile.read(content_length)
             _logger.debug("processing message. headers=%s, content=%s", self.headers, content_bytes)
-            try:
-                body = json.loads(content_bytes)
-                sns_verify_signature(body)
-            except json.decoder.JSONDecodeError:
-                _logger.warning("ignoring invalid message. content=%s", content_bytes, exc_info=True)
-                _counter_errors.labels('sns').inc()
-            except InvalidSnsSignatureException:
-                _logger.warning("ignoring message with invalid signature. content=%s", content_bytes, exc_info=True)
-                _counter_errors.labels('sns').inc()
-            else:
-                if self.receiver is not None:
-                    self.receiver.receive(body)
-                else:
-                    _logger.info("received notification. body=%s", body)
-                _counter_sns.inc()
+            handle_notification(self.receiver, content_bytes)
 
             self.send_response(HTTPStatus.OK)
             self.send_header('Content-Length', '0')
             self.end_headers()
+        except (DuplicateInProgressException, SpoolFullException):
+            self.send_response(HTTPStatus.SERVICE_UNAVAILABLE)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
         except:
             _logger.warning("unexpected error.", exc_info=True)
             _counter_errors.labels('sns').inc()
+            if self.server.on_error is not None:
+                self.server.on_error()
+            if len(content_bytes) != content_length:
+                self.close_connection = True
             self.send_response(HTTPStatus.INTERNAL_SERVER_ERROR)
             self.send_header('Content-Length', '0')
             self.end_headers()
@@ -55,16 +170,119 @@ class SnsHandler(BaseHTTPRequestHandler):
         _logger.debug(fmt % args)
 
     @classmethod
-    def factory(cls, receiver: MessageReceiver, extra_bases=()):
-        """Returns a dynamic SnsHandler class tied to the passed receiver. """
+    def factory(cls, receiver: MessageReceiver, extra_bases=(), **attributes):
+        """Returns a dynamic SnsHandler class tied to the passed receiver and class attributes. """
         cls_name = str(cls.__name__)
-        return type(cls_name, (cls,) + extra_bases + (object,), {"receiver": receiver})
+        return type(cls_name, (cls,) + extra_bases + (object,), dict(attributes, receiver=receiver))
 
 
 class SnsServer(HTTPServer):
-    def __init__(self, receiver: MessageReceiver, server_address: Tuple[str, int]):
-        sns_handler = SnsHandler.factory(receiver=receiver, extra_bases=(prometheus_client.MetricsHandler,))
+    """HTTP server for SNS notifications and metrics.
+
+    With ``workers == 0`` requests are handled one at a time in the thread calling ``serve_forever``, and
+    connections are closed after each response so that an idle client cannot hold the server.
+    Otherwise accepted connections wait in a queue of at most ``queue_size`` entries for one of ``workers``
+    threads, and are answered right away with 503 while the queue is full, or with 0 while all workers are busy.
+    Each connection is then kept open for up to ``max_requests`` requests, while idle for less than ``idle_timeout``
+    seconds. ``on_error`` is called without arguments when handling a notification fails. Metrics are exposed from
+    ``registry``, and ``reuse_port`` lets several processes listen on the same port.
+    """
+    on_error = None
+
+    def __init__(self, receiver: MessageReceiver, server_address: Tuple[str, int], workers: int = 0,
+                 queue_size: int = 0, idle_timeout: float = SnsHandler.timeout,
+                 max_requests: int = SnsHandler.max_requests, registry=prometheus_client.REGISTRY,
+                 reuse_port: bool = False):
+        sns_handler = SnsHandler.factory(receiver=receiver, extra_bases=(MetricsHandler,), timeout=idle_timeout,
+                                         max_requests=max_requests if workers else 1, registry=registry)
+        self.reuse_port = reuse_port
         super().__init__(server_address, sns_handler)
+        self.queue_size = max(queue_size, 0)
+        self._requests = queue.Queue()
+        self._closing = False
+        self._active = 0
+        self._active_lock = threading.Lock()
+        self._workers = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name="sns-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._workers.append(thread)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        if not self._workers:
+            self._track(1)
+            try:
+                return super().process_request(request, client_address)
+            finally:
+                self._track(-1)
+        # counted until a worker is done with it, so that a queue of 0 only accepts connections for idle workers
+        with self._active_lock:
+            accepted = self._active < len(self._workers) + self.queue_size
+            if accepted:
+                self._active += 1
+        if not accepted:
+            self._reject(request, client_address)
+            return
+        self._requests.put_nowait((request, client_address))
+        _gauge_queued.inc()
+
+    def busy(self) -> bool:
+        """Returns True when workers should close idle persistent connections. """
+        return self._closing or not self._requests.empty()
+
+    def load(self) -> Tuple[int, int]:
+        """Returns the connections being served or waiting, and how many there can be before answering 503. """
+        if not self._workers:
+            return self._active, 1
+        return self._active, len(self._workers) + self.queue_size
+
+    def _track(self, delta: int):
+        with self._active_lock:
+            self._active += delta
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+            _gauge_queued.dec()
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self._track(-1)
+
+    def _reject(self, request, client_address):
+        _logger.warning("rejecting request, all workers are busy. client_address=%s", client_address)
+        _counter_rejected.inc()
+        try:
+            request.sendall(_RESPONSE_UNAVAILABLE)
+            # discard what the client already sent, so that closing does not reset the connection
+            request.setblocking(False)
+            while request.recv(65536):
+                pass
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._closing = True
+        for _ in self._workers:
+            self._requests.put(None)
+        for thread in self._workers:
+            thread.join()
+        self._workers = []
 
     def handle_error(self, request: bytes, client_address: Tuple[str, int]) -> None:
         _logger.debug("unhandled error", exc_info=True)
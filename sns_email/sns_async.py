@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+import asyncio
+import http.client
+import io
+import socket
+import threading
+from concurrent.futures.thread import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Tuple
+
+import prometheus_client
+
+from sns_email import logger, _counter_errors
+from sns_email.counter import DuplicateInProgressException
+from sns_email.receive import MessageReceiver
+from sns_email.spool import SpoolFullException
+from sns_email.sns import SnsHandler, handle_notification, metrics_output, _counter_sns_time, _counter_rejected, \
+    _gauge_queued
+
+_logger = logger.getChild('sns.async')
+
+
+class AsyncSnsServer:
+    """asyncio HTTP server for SNS notifications and metrics.
+
+    Connections are served by the event loop, while signature verification and delivery run on a pool of
+    ``workers`` threads, handling notifications one at a time with 0 as ``SnsServer`` does. Requests exceeding
+    ``workers + queue_size`` in flight are answered with 503.
+    Connections are kept open for up to ``max_requests`` requests, while idle for less than ``idle_timeout``
+    seconds. It offers the same ``serve_forever``/``shutdown`` interface, ``on_error`` hook, ``registry`` and
+    ``reuse_port`` options as ``SnsServer``.
+    """
+    registry = prometheus_client.REGISTRY
+    on_error = None
+
+    def __init__(self, receiver: MessageReceiver, server_address: Tuple[str, int], workers: int = 0,
+                 queue_size: int = 0, idle_timeout: float = SnsHandler.timeout,
+                 max_requests: int = SnsHandler.max_requests, registry=prometheus_client.REGISTRY,
+                 reuse_port: bool = False):
+        self.receiver = receiver
+        self.registry = registry
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.socket = socket.create_server(server_address, reuse_port=reuse_port)
+        self.server_address = self.socket.getsockname()[:2]
+        workers = max(workers, 1)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sns-async")
+        self._max_pending = workers + max(queue_size, 0)
+        self._pending = 0
+
+        self._loop = None
+        self._stop = None
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+
+    def serve_forever(self):
+        self._is_shut_down.clear()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        self._shutdown_request = True
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._stop.set)
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        self.socket.close()
+        self._executor.shutdown(wait=True)
+
+    async def _serve(self):
+        self._stop = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        try:
+            server = await asyncio.start_server(self._handle, sock=self.socket)
+            async with server:
+                if not self._shutdown_request:
+                    await self._stop.wait()
+        finally:
+            self._loop = None
+            self._shutdown_request = False
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            for i in range(1, self.max_requests + 1):
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), self.idle_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    _logger.debug("connection closed before completing request.", exc_info=True)
+                    return
+                except (asyncio.LimitOverrunError, ValueError, http.client.HTTPException):
+                    _logger.debug("bad request.", exc_info=True)
+                    writer.write(self._format_response(HTTPStatus.BAD_REQUEST, [], b"", keep_alive=False))
+                    await writer.drain()
+                    return
+
+                method, target, version, headers, content_bytes = request
+                keep_alive = i < self.max_requests and self._keep_alive(version, headers)
+                status, response_headers, content = await self._respond(method, target, headers, content_bytes)
+                writer.write(self._format_response(status, response_headers, content, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            _logger.debug("connection closed before sending response.", exc_info=True)
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader):
+        head = await reader.readuntil(b"\r\n\r\n")
+        request_line, _, header_bytes = head.partition(b"\r\n")
+        method, target, version = request_line.decode("latin-1").split(" ", 2)
+        headers = http.client.parse_headers(io.BytesIO(header_bytes))
+        content_bytes = b""
+        if 'Content-Length' in headers:
+            content_bytes = await reader.readexactly(int(headers['Content-Length']))
+        elif 'Transfer-Encoding' in headers:
+            raise ValueError("Transfer-Encoding not supported")
+        return method, target, version, headers, content_bytes
+
+    @staticmethod
+    def _keep_alive(version: str, headers) -> bool:
+        connection = headers.get('Connection', "").lower()
+        if version == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+    @staticmethod
+    def _format_response(status: HTTPStatus, headers, content: bytes, keep_alive: bool) -> bytes:
+        headers = headers + [("Content-Length", str(len(content))),
+                             ("Connection", "keep-alive" if keep_alive else "close")]
+        response = bytearray(b"HTTP/1.1 %d %s\r\n" % (status, status.phrase.encode()))
+        for name, value in headers:
+            response.extend(b"%s: %s\r\n" % (name.encode("latin-1"), value.encode("latin-1")))
+        response.extend(b"\r\n")
+        response.extend(content)
+        return response
+
+    async def _respond(self, method: str, target: str, headers, content_bytes: bytes):
+        _logger.debug("%s %s", method, target)
+        if method == "GET":
+            return self._metrics(target, headers)
+        elif method == "POST":
+            if 'Content-Length' not in headers:
+                return HTTPStatus.LENGTH_REQUIRED, [], b""
+            return await self._post(headers, content_bytes)
+        else:
+            return HTTPStatus.NOT_IMPLEMENTED, [], b""
+
+    def _metrics(self, target: str, headers):
+        content_type, output = metrics_output(self.registry, target, headers.get('Accept'))
+        return HTTPStatus.OK, [('Content-Type', content_type)], output
+
+    async def _post(self, headers, content_bytes: bytes):
+        if self._pending >= self._max_pending:
+            _logger.warning("rejecting request, all workers are busy.")
+            _counter_rejected.inc()
+            return HTTPStatus.SERVICE_UNAVAILABLE, [("Retry-After", "1")], b""
+
+        self._pending += 1
+        _gauge_queued.inc()
+        try:
+            with _counter_sns_time.time():
+                _logger.debug("processing message. headers=%s, content=%s", headers, content_bytes)
+                await self._loop.run_in_executor(self._executor, self._handle_notification, content_bytes)
+        except (DuplicateInProgressException, SpoolFullException):
+            return HTTPStatus.SERVICE_UNAVAILABLE, [("Retry-After", "1")], b""
+        except Exception:
+            _logger.warning("unexpected error.", exc_info=True)
+            _counter_errors.labels('sns').inc()
+            if self.on_error is not None:
+                self.on_error()
+            return HTTPStatus.INTERNAL_SERVER_ERROR, [], b""
+        finally:
+            self._pending -= 1
+        return HTTPStatus.OK, [], b""
+
+    def load(self) -> Tuple[int, int]:
+        """Returns the notifications being handled or waiting, and how many there can be before answering 503. """
+        return self._pending, self._max_pending
+
+    def _handle_notification(self, content_bytes: bytes):
+        _gauge_queued.dec()
+        handle_notification(self.receiver, content_bytes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.server_close()
@@ -1,8 +1,20 @@
 #!/usr/bin/env python
 import base64
 import binascii
-import functools
+import collections
+import datetime
+import hashlib
+import multiprocessing
+import os
 import re
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool, ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
 
 import prometheus_client
 import requests
@@ -10,9 +22,10 @@ from cryptography import x509
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
 from cryptography.hazmat.primitives.hashes import SHA1
+from cryptography.hazmat.primitives.serialization import Encoding
 from cryptography.x509 import Certificate
 
-from sns_email import logger
+from sns_email import logger, stages
 
 _logger = logger.getChild("sns.signature")
 
@@ -22,22 +35,178 @@ _certificate_time = prometheus_client.Histogram('sns_email_sns_signature_certifi
                                                 'Time spent loading certificate')
 _signature_time = prometheus_client.Histogram('sns_email_sns_signature_seconds', 'Time spent computing signature')
 _verify_time = prometheus_client.Histogram('sns_email_sns_verify_seconds', 'Time spent verifying signature')
+_counter_verify_hits = prometheus_client.Counter('sns_email_sns_verify_cache_hits_total',
+                                                 'Signatures found already verified')
+_counter_verify_misses = prometheus_client.Counter('sns_email_sns_verify_cache_misses_total',
+                                                   'Signatures not found already verified')
 
 
 class InvalidSnsSignatureException(Exception):
     pass
 
 
-@functools.lru_cache(maxsize=5)
-@_certificate_time.time()
-def _load_certificate(url) -> Certificate:
-    with requests.get(url, timeout=30) as r:
-        r.raise_for_status()
-        return x509.load_pem_x509_certificate(r.content)
+def _not_valid_before(certificate: Certificate) -> datetime.datetime:
+    try:
+        return certificate.not_valid_before_utc
+    except AttributeError:
+        return certificate.not_valid_before.replace(tzinfo=datetime.timezone.utc)
 
 
-@_signature_time.time()
-def sns_verify_signature(body):
+def _not_valid_after(certificate: Certificate) -> datetime.datetime:
+    try:
+        return certificate.not_valid_after_utc
+    except AttributeError:
+        return certificate.not_valid_after.replace(tzinfo=datetime.timezone.utc)
+
+
+class _UrlLock:
+    """Lock of the fetch of one URL, removed with its last user. """
+    __slots__ = ('lock', 'users')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = 0
+
+
+class CertificateCache:
+    """Signing certificates by URL, kept in memory and in the optional ``cache_dir``.
+
+    Files in ``cache_dir`` are named after the host and path of their URL, e.g.
+    ``sns.eu-west-1.amazonaws.com_SimpleNotificationService-0123.pem``, so that the directory can be seeded
+    beforehand. Certificates outside their validity period are fetched again, or rejected when ``offline``.
+    Concurrent misses of the same URL wait for a single fetch.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, offline: bool = False, timeout: float = 30):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.timeout = timeout
+        self._certificates: Dict[str, Certificate] = {}
+        self._pems: Dict[str, Tuple[Certificate, bytes]] = {}
+        self._lock = threading.Lock()
+        self._url_locks: Dict[str, _UrlLock] = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def file_name(url: str) -> str:
+        parsed = urlparse(url)
+        return (parsed.netloc + parsed.path).replace("/", "_")
+
+    @staticmethod
+    def valid(certificate: Certificate) -> bool:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return _not_valid_before(certificate) <= now <= _not_valid_after(certificate)
+
+    def get(self, url: str) -> Certificate:
+        certificate = self._certificates.get(url)
+        if certificate is not None and self.valid(certificate):
+            return certificate
+
+        # only held while fetching, any client can send notifications with made up URLs
+        with self._lock:
+            url_lock = self._url_locks.setdefault(url, _UrlLock())
+            url_lock.users += 1
+        try:
+            with url_lock.lock:
+                certificate = self._certificates.get(url)
+                if certificate is None or not self.valid(certificate):
+                    certificate = self._load(url)
+                    self._certificates[url] = certificate
+        finally:
+            with self._lock:
+                url_lock.users -= 1
+                if not url_lock.users:
+                    del self._url_locks[url]
+        return certificate
+
+    def pem(self, url: str) -> bytes:
+        """Returns the PEM encoding of the certificate of ``url``, serialized once for each certificate. """
+        certificate = self.get(url)
+        cached = self._pems.get(url)
+        if cached is None or cached[0] is not certificate:
+            cached = self._pems[url] = (certificate, certificate.public_bytes(Encoding.PEM))
+        return cached[1]
+
+    def pems(self) -> Dict[str, bytes]:
+        return {url: self.pem(url) for url in list(self._certificates)}
+
+    def prefetch(self, urls: Iterable[str]):
+        for url in urls:
+            try:
+                self.get(url)
+            except Exception:
+                _logger.warning("failed loading certificate. url=%s", url, exc_info=True)
+
+    def _load(self, url: str) -> Certificate:
+        path = os.path.join(self.cache_dir, self.file_name(url)) if self.cache_dir is not None else None
+        if path is not None:
+            try:
+                with open(path, "rb") as f:
+                    certificate = x509.load_pem_x509_certificate(f.read())
+            except (OSError, ValueError):
+                _logger.debug("no cached certificate. path=%s", path, exc_info=True)
+            else:
+                if self.valid(certificate):
+                    return certificate
+                _logger.info("cached certificate is not valid. path=%s", path)
+                if self.offline:
+                    raise InvalidSnsSignatureException("Certificate not valid. url=%s" % url)
+
+        if self.offline:
+            raise InvalidSnsSignatureException("Certificate not available offline. url=%s" % url)
+        content = self._fetch(url)
+        certificate = x509.load_pem_x509_certificate(content)
+        if not self.valid(certificate):
+            raise InvalidSnsSignatureException("Certificate not valid. url=%s" % url)
+        if path is not None:
+            with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix=".tmp", delete=False) as f:
+                f.write(content)
+            os.replace(f.name, path)
+        return certificate
+
+    @_certificate_time.time()
+    def _fetch(self, url: str) -> bytes:
+        _logger.info("fetching certificate. url=%s", url)
+        with requests.get(url, timeout=self.timeout) as r:
+            r.raise_for_status()
+            return r.content
+
+
+class VerifiedCache:
+    """Digests of the last ``size`` verified signatures, so that retried notifications skip the RSA verification. """
+
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self._lock = threading.Lock()
+        self._digests = collections.OrderedDict()
+
+    @staticmethod
+    def digest(url: str, signature: bytes, data: bytes) -> bytes:
+        h = hashlib.sha256(url.encode())
+        h.update(b"\n")
+        h.update(signature)
+        h.update(b"\n")
+        h.update(data)
+        return h.digest()
+
+    def __contains__(self, digest: bytes) -> bool:
+        with self._lock:
+            if digest in self._digests:
+                self._digests.move_to_end(digest)
+                return True
+            return False
+
+    def add(self, digest: bytes):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._digests[digest] = None
+            while len(self._digests) > self.size:
+                self._digests.popitem(last=False)
+
+
+def _signing_cert_url(body) -> str:
     for name in ('Type', 'Signature', 'SigningCertURL', 'SignatureVersion'):
         if name not in body:
             raise InvalidSnsSignatureException("Missing key. name=%s" % name)
@@ -49,7 +218,11 @@ def sns_verify_signature(body):
     if not _valid_sns_url.match(signing_cert_url):
         raise InvalidSnsSignatureException(
             "Invalid signing cert url. url=%s, rex=%s" % (signing_cert_url, _valid_sns_url))
+    return signing_cert_url
+
 
+def _signed_data(body) -> Tuple[bytes, bytes]:
+    """Returns the signature and the canonical string of a SNS message. """
     sns_type = body["Type"]
     try:
         signature = base64.b64decode(body["Signature"])
@@ -73,10 +246,215 @@ def sns_verify_signature(body):
         except (KeyError, AttributeError):
             raise InvalidSnsSignatureException("Missing key. name=%s" % name)
         data.extend("\n".encode())
+    return signature, bytes(data)
+
+
+class _VerifyStats:
+    """Verified cache hits and misses and verification times, observed in the metrics of the main process. """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.seconds = []
 
-    public_key = _load_certificate(signing_cert_url).public_key()
+    def observe(self):
+        if self.hits:
+            _counter_verify_hits.inc(self.hits)
+        if self.misses:
+            _counter_verify_misses.inc(self.misses)
+        for seconds in self.seconds:
+            _verify_time.observe(seconds)
+
+
+def _verify(signing_cert_url: str, signature: bytes, data: bytes, public_key, stats: _VerifyStats):
+    digest = _verified.digest(signing_cert_url, signature, data)
+    if digest in _verified:
+        stats.hits += 1
+        return
+    stats.misses += 1
+
+    start = time.perf_counter()
     try:
-        with _verify_time.time():
-            public_key.verify(signature=signature, data=data, algorithm=SHA1(), padding=PKCS1v15())
+        public_key.verify(signature=signature, data=data, algorithm=SHA1(), padding=PKCS1v15())
     except InvalidSignature as e:
         raise InvalidSnsSignatureException("Invalid signature", e)
+    finally:
+        stats.seconds.append(time.perf_counter() - start)
+    _verified.add(digest)
+
+
+_worker_keys = {}
+
+
+def _init_worker(pems: Dict[str, bytes], verified_size: int):
+    global _verified
+    _verified = VerifiedCache(size=verified_size)
+    for url, pem in pems.items():
+        _worker_keys[url] = (pem, x509.load_pem_x509_certificate(pem).public_key())
+
+
+def _verify_batch(items) -> Tuple[List[Optional[Exception]], _VerifyStats]:
+    """Verifies a batch of (url, certificate pem, body) in a worker process, returning the error of each. """
+    errors = []
+    stats = _VerifyStats()
+    for url, pem, body in items:
+        try:
+            cached = _worker_keys.get(url)
+            if cached is None or cached[0] != pem:
+                cached = _worker_keys[url] = (pem, x509.load_pem_x509_certificate(pem).public_key())
+            _verify(url, *_signed_data(body), public_key=cached[1], stats=stats)
+        except Exception as e:
+            errors.append(e)
+        else:
+            errors.append(None)
+    return errors, stats
+
+
+class ProcessPoolVerifier:
+    """Verifies signatures in a pool of ``processes``, to use more than one core.
+
+    Certificates are still loaded in this process and sent along with each message, the workers keep the parsed
+    public keys and their own cache of the last ``verified_size`` verified signatures. Messages waiting while all
+    workers are busy are sent together, in batches of up to ``batch_size``. The pool is started again when a worker
+    dies, retrying its batch once, and ``verify`` gives up on a worker not answering within ``timeout`` seconds.
+    """
+
+    def __init__(self, processes: int, batch_size: int = 16, certificates: Optional[Dict[str, bytes]] = None,
+                 timeout: float = 30, verified_size: int = 1024):
+        self.processes = processes
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.verified_size = verified_size
+        self._certificates = certificates or {}
+        self._executor_lock = threading.Lock()
+        self._executor = self._start_executor()
+        self._slots = threading.BoundedSemaphore(processes)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._dispatch, name="sns-verify", daemon=True)
+        self._thread.start()
+
+    def verify(self, body):
+        signing_cert_url = _signing_cert_url(body)
+        pem = _certificates.pem(signing_cert_url)
+        future = Future()
+        self._queue.put((signing_cert_url, pem, body, future))
+        error = future.result(timeout=self.timeout)
+        if error is not None:
+            raise error
+
+    def _dispatch(self):
+        while True:
+            self._slots.acquire()
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                self._submit(batch)
+                return
+            self._submit(batch)
+
+    def _start_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_worker, initargs=(self._certificates, self.verified_size))
+
+    def _restart(self, executor: ProcessPoolExecutor):
+        with self._executor_lock:
+            if self._executor is executor:
+                _logger.warning("verification process pool is broken, starting it again.")
+                executor.shutdown(wait=False)
+                self._executor = self._start_executor()
+
+    def _submit(self, batch, retry: bool = True):
+        if not batch:
+            self._slots.release()
+            return
+        executor = self._executor
+        try:
+            f = executor.submit(_verify_batch, [item[:3] for item in batch])
+        except BrokenProcessPool as e:
+            self._retry(executor, batch, retry, e)
+        except Exception as e:
+            self._resolve(batch, e)
+        else:
+            f.add_done_callback(lambda done: self._done(executor, batch, retry, done))
+
+    def _done(self, executor: ProcessPoolExecutor, batch, retry: bool, done: Future):
+        error = done.exception()
+        if isinstance(error, BrokenProcessPool):
+            self._retry(executor, batch, retry, error)
+        else:
+            self._resolve(batch, error or done.result())
+
+    def _retry(self, executor: ProcessPoolExecutor, batch, retry: bool, error: Exception):
+        self._restart(executor)
+        if retry:
+            self._submit(batch, retry=False)
+        else:
+            self._resolve(batch, error)
+
+    def _resolve(self, batch, result):
+        self._slots.release()
+        if isinstance(result, tuple):
+            errors, stats = result
+            stats.observe()
+        else:
+            errors = [result] * len(batch)
+        for item, error in zip(batch, errors):
+            item[3].set_result(error)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        with self._executor_lock:
+            self._executor.shutdown(wait=True)
+
+
+_certificates = CertificateCache()
+_verified = VerifiedCache()
+_verifier: Optional[ProcessPoolVerifier] = None
+
+
+def configure(cache_dir: Optional[str] = None, offline: bool = False, prefetch: Iterable[str] = (),
+              verified_size: int = 1024, processes: int = 0, batch_size: int = 16):
+    """Replaces the caches used by ``sns_verify_signature``, verifying in a pool of ``processes`` if not 0. """
+    global _certificates, _verified, _verifier
+    close()
+    _certificates = CertificateCache(cache_dir=cache_dir, offline=offline)
+    _certificates.prefetch(prefetch)
+    _verified = VerifiedCache(size=verified_size)
+    if processes:
+        _verifier = ProcessPoolVerifier(processes, batch_size=batch_size, certificates=_certificates.pems(),
+                                        verified_size=verified_size)
+
+
+def close():
+    global _verifier
+    if _verifier is not None:
+        _verifier.close()
+        _verifier = None
+
+
+def _load_certificate(url) -> Certificate:
+    return _certificates.get(url)
+
+
+@_signature_time.time()
+def sns_verify_signature(body):
+    if _verifier is not None:
+        with stages.stage("verify"):
+            _verifier.verify(body)
+        return
+    signing_cert_url = _signing_cert_url(body)
+    signature, data = _signed_data(body)
+    with stages.stage("certificate"):
+        public_key = _load_certificate(signing_cert_url).public_key()
+    stats = _VerifyStats()
+    try:
+        with stages.stage("verify"):
+            _verify(signing_cert_url, signature, data, public_key, stats)
+    finally:
+        stats.observe()
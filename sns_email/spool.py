@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+import collections
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+import prometheus_client
+
+from sns_email import logger, _counter_errors
+from sns_email.counter import DuplicateInProgressException
+from sns_email.receive import MessageReceiver
+
+_logger = logger.getChild('spool')
+
+_gauge_depth = prometheus_client.Gauge('sns_email_spool_messages', 'Notifications waiting in the spool')
+_counter_spooled = prometheus_client.Counter('sns_email_spool_received_total', 'Notifications spooled total')
+_counter_dead_letter = prometheus_client.Counter('sns_email_spool_dead_letter_total',
+                                                 'Spooled notifications moved to the dead letter directory total')
+
+
+class SpoolFullException(Exception):
+    pass
+
+
+def _fsync_directory(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Spool:
+    """Durable queue of notifications, acknowledged once written and delivered by ``workers`` threads.
+
+    ``receive`` writes the notification to ``tmp/`` and renames it into ``new/`` of ``path``, syncing both to disk
+    unless ``fsync`` is false, and fails with ``SpoolFullException`` when ``max_size`` notifications are waiting.
+    Workers move the oldest notification to ``cur/`` and pass it to the receiver, deleting it once delivered. A failed
+    notification is held back for a random delay, doubling from ``retry_interval`` up to ``max_retry_interval``
+    seconds with each attempt. The attempts are counted in the file name, and after ``max_attempts`` failed attempts
+    the notification is moved to ``dead-letter/``, 0 retrying forever. A message being delivered elsewhere is retried
+    after ``retry_interval`` seconds without counting an attempt. Notifications left in ``cur/`` by a crash are
+    delivered again at startup.
+    """
+
+    def __init__(self, receiver: MessageReceiver, path: str, workers: int = 2, max_size: int = 10000,
+                 fsync: bool = True, retry_interval: float = 10, max_attempts: int = 10,
+                 max_retry_interval: float = 600):
+        self.receiver = receiver
+        self.path = path
+        self.workers = workers
+        self.max_size = max_size
+        self.fsync = fsync
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.max_retry_interval = max_retry_interval
+
+        self._condition = threading.Condition()
+        self._queue = collections.deque()
+        self._delayed = []
+        self._pending = 0
+        self._sequence = itertools.count()
+        self._closing = False
+        self._threads = []
+        self._recover()
+
+    def _dir(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _recover(self):
+        for name in ("tmp", "new", "cur", "dead-letter"):
+            os.makedirs(self._dir(name), exist_ok=True)
+        for name in os.listdir(self._dir("tmp")):
+            os.unlink(os.path.join(self._dir("tmp"), name))
+        for name in os.listdir(self._dir("cur")):
+            _logger.info("recovering interrupted delivery. name=%s", name)
+            os.rename(os.path.join(self._dir("cur"), name), os.path.join(self._dir("new"), name))
+        self._queue.extend(sorted(os.listdir(self._dir("new"))))
+        self._pending = len(self._queue)
+        _gauge_depth.set(self._pending)
+        if self._queue:
+            _logger.info("recovered spooled notifications. count=%d", len(self._queue))
+
+    def receive(self, body: dict):
+        with self._condition:
+            if self._pending >= self.max_size:
+                raise SpoolFullException("spool is full. size=%d" % self._pending)
+            self._pending += 1
+            _gauge_depth.inc()
+        try:
+            name = "%020d-%d-%d" % (time.time_ns(), os.getpid(), next(self._sequence))
+            tmp_path = os.path.join(self._dir("tmp"), name)
+            with open(tmp_path, "wb") as f:
+                f.write(json.dumps(body).encode())
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            os.rename(tmp_path, os.path.join(self._dir("new"), name))
+            if self.fsync:
+                _fsync_directory(self._dir("new"))
+        except:
+            with self._condition:
+                self._pending -= 1
+                _gauge_depth.dec()
+            raise
+        _counter_spooled.inc()
+        with self._condition:
+            self._queue.append(name)
+            self._condition.notify()
+
+    def _take(self):
+        with self._condition:
+            while not self._closing:
+                now = time.monotonic()
+                # retries that are due go first, they were spooled before the queued notifications
+                if self._delayed and self._delayed[0][0] <= now:
+                    return heapq.heappop(self._delayed)[1]
+                if self._queue:
+                    return self._queue.popleft()
+                self._condition.wait(self._delayed[0][0] - now if self._delayed else None)
+            return None
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.max_retry_interval, self.retry_interval * 2 ** min(attempts - 1, 32))
+        return random.uniform(delay / 2, delay)
+
+    @staticmethod
+    def attempts(name: str) -> int:
+        """Returns the failed attempts counted in the name of a spooled notification. """
+        _, _, attempts = name.partition(".")
+        return int(attempts) if attempts.isdigit() else 0
+
+    def _work(self):
+        while True:
+            name = self._take()
+            if name is None:
+                return
+            try:
+                self._deliver(name)
+            except OSError:
+                # left in the spool directories, the notification is queued again at the next startup
+                _logger.warning("failed moving spooled notification. name=%s", name, exc_info=True)
+                _counter_errors.labels('spool').inc()
+                self._forget()
+
+    def _deliver(self, name: str):
+        cur_path = os.path.join(self._dir("cur"), name)
+        try:
+            os.rename(os.path.join(self._dir("new"), name), cur_path)
+        except FileNotFoundError:
+            _logger.warning("spooled notification disappeared. name=%s", name)
+            _counter_errors.labels('spool').inc()
+            self._forget()
+            return
+        except OSError:
+            _logger.warning("failed taking spooled notification, retrying later. name=%s", name, exc_info=True)
+            _counter_errors.labels('spool').inc()
+            self._requeue(name, self.retry_interval)
+            return
+        try:
+            with open(cur_path, "rb") as f:
+                body = json.load(f)
+        except ValueError:
+            _logger.warning("discarding invalid spooled notification. name=%s", name, exc_info=True)
+            _counter_errors.labels('spool').inc()
+            self._done(cur_path)
+            return
+        try:
+            self.receiver.receive(body)
+        except DuplicateInProgressException:
+            _logger.info("message is being delivered elsewhere, retrying later. name=%s", name)
+            os.rename(cur_path, os.path.join(self._dir("new"), name))
+            self._requeue(name, self.retry_interval)
+        except Exception:
+            _counter_errors.labels('spool').inc()
+            attempts = self.attempts(name) + 1
+            retry_name = "%s.%d" % (name.partition(".")[0], attempts)
+            if self.max_attempts and attempts >= self.max_attempts:
+                _logger.warning("delivery failed too many times, moving to dead letter. name=%s, attempts=%d",
+                                name, attempts, exc_info=True)
+                _counter_dead_letter.inc()
+                os.rename(cur_path, os.path.join(self._dir("dead-letter"), retry_name))
+                self._forget()
+                return
+            _logger.warning("failed delivering spooled notification, retrying later. name=%s, attempts=%d", name,
+                            attempts, exc_info=True)
+            os.rename(cur_path, os.path.join(self._dir("new"), retry_name))
+            self._requeue(retry_name, self.backoff(attempts))
+        else:
+            self._done(cur_path)
+
+    def _requeue(self, name: str, delay: float):
+        with self._condition:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, name))
+            # a waiting worker has to wake up when it is due
+            self._condition.notify()
+
+    def _done(self, cur_path: str):
+        os.unlink(cur_path)
+        self._forget()
+
+    def _forget(self):
+        with self._condition:
+            self._pending -= 1
+            _gauge_depth.dec()
+
+    def close(self):
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+    def __enter__(self):
+        self._closing = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name="spool-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
@@ -1,33 +1,65 @@
 #!/usr/bin/env python
 import json
+import random
 import threading
-import time
+from concurrent.futures import wait
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import List
 
 import prometheus_client
 
-from sns_email import boto_session, _counter_errors, logger
+from sns_email import boto_client, _counter_errors, logger, stages
 from sns_email.receive import MessageReceiver
 
 _logger = logger.getChild('sqs')
 
 _counter_sqs_poll = prometheus_client.Counter('sns_email_sqs_poll_total', 'SQS poll total')
 _counter_sqs = prometheus_client.Counter('sns_email_sqs_received_total', 'SQS received total')
+_counter_sqs_extended = prometheus_client.Counter('sns_email_sqs_visibility_extended_total',
+                                                  'SQS messages with visibility extended total')
 
 
 class SqsPoller:
-    def __init__(self, receiver: MessageReceiver, queue_url: str, region: str):
+    """Polls a SQS queue of SNS notifications with ``pollers`` long-poll loops.
+
+    The messages of each batch are processed on a pool of ``workers`` threads, and deleted together once processed.
+    Messages still processing after half of ``visibility_timeout`` are hidden for another ``visibility_timeout``
+    seconds, while messages failing delivery are not deleted and reappear in the queue when their visibility expires.
+
+    The queue is polled again right away while it returns messages, otherwise after a random delay doubling from
+    ``backoff_min`` up to ``backoff_max`` seconds with each empty poll or error. ``trigger`` ends the delay early.
+    """
+
+    def __init__(self, receiver: MessageReceiver, queue_url: str, region: str, workers: int = 4, pollers: int = 1,
+                 visibility_timeout: int = 60, backoff_min: float = 10, backoff_max: float = 10 * 60):
         self.receiver = receiver
         self.queue_url = queue_url
         self.region = region
-
-        self.poll_wait_empty = 10 * 60
-        self.poll_wait = 10
+        self.pollers = pollers
+        self.visibility_timeout = visibility_timeout
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.wait_time = 10
 
         self._close = threading.Event()
+        self._wake = threading.Condition()
+        self._triggered = False
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sqs-worker")
+
+    def client(self):
+        return boto_client('sqs', region=self.region, max_pool_connections=self.pollers)
 
     def close(self):
         _logger.info("closing.")
         self._close.set()
+        with self._wake:
+            self._wake.notify_all()
+
+    def trigger(self):
+        """Polls right away, if waiting after empty polls or errors, or skips the next wait. """
+        with self._wake:
+            self._triggered = True
+            self._wake.notify_all()
 
     def run(self):
         try:
@@ -37,28 +69,22 @@ class SqsPoller:
             _counter_errors.labels('sqs').inc()
 
     def poll_forever(self):
-        sqs = boto_session().client('sqs', region_name=self.region)
+        sqs = self.client()
         _logger.info("begin polling.")
+        empty_polls = 0
         while not self._close.is_set():
             try:
-                response = sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=10)
+                with stages.stage("sqs_receive"):
+                    response = sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10,
+                                                   WaitTimeSeconds=self.wait_time,
+                                                   VisibilityTimeout=self.visibility_timeout)
                 _counter_sqs_poll.inc()
                 if 'Messages' in response:
                     messages = response['Messages']
                     _logger.debug("processing sqs messages. messages=%s", messages)
-                    for message in messages:
-                        try:
-                            body = json.loads(message['Body'])
-                        except (json.decoder.JSONDecodeError, KeyError):
-                            _logger.warning("deleting invalid message. message=%s", message, exc_info=True)
-                            _counter_errors.labels('sqs').inc()
-                        else:
-                            self.receiver.receive(body)
-                            _logger.info("processed sqs message. message_id=%s", message['MessageId'])
-                            _counter_sqs.inc()
-                        sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'])
+                    self._process_batch(sqs, messages)
                     if messages:
-                        self._sleep(self.poll_wait)
+                        empty_polls = 0
                         continue
             except KeyboardInterrupt:
                 self.close()
@@ -66,24 +92,93 @@ class SqsPoller:
             except:
                 _logger.warning("uncaught exception.", exc_info=True)
                 _counter_errors.labels('sqs').inc()
+            empty_polls += 1
             try:
-                self._sleep(self.poll_wait_empty)
+                self._sleep(self._backoff(empty_polls))
             except KeyboardInterrupt:
                 self.close()
                 break
         _logger.info("closed.")
 
-    def _sleep(self, seconds: int):
-        for i in range(seconds):
-            if self._close.is_set():
-                break
-            time.sleep(1)
+    def _backoff(self, empty_polls: int) -> float:
+        delay = min(self.backoff_max, self.backoff_min * 2 ** min(empty_polls - 1, 32))
+        return random.uniform(delay / 2, delay)
+
+    def _process_batch(self, sqs, messages: List[dict]):
+        futures = {self._executor.submit(self._process, message): message for message in messages}
+        pending = set(futures)
+        while pending:
+            _, pending = wait(pending, timeout=self.visibility_timeout / 2)
+            if pending:
+                self._extend_visibility(sqs, [futures[f] for f in pending])
+        self._delete(sqs, [message for f, message in futures.items() if f.result()])
+
+    def _process(self, message: dict) -> bool:
+        """Passes a message to the receiver, returning whether it can be deleted. """
+        with stages.trace(source="sqs", sqs_message_id=message.get('MessageId')):
+            return self._process_message(message)
+
+    def _process_message(self, message: dict) -> bool:
+        try:
+            with stages.stage("parse_notification"):
+                body = json.loads(message['Body'])
+        except (json.decoder.JSONDecodeError, KeyError):
+            _logger.warning("deleting invalid message. message=%s", message, exc_info=True)
+            _counter_errors.labels('sqs').inc()
+            return True
+        try:
+            self.receiver.receive(body)
+        except Exception:
+            _logger.warning("failed processing sqs message, leaving it in the queue. message_id=%s",
+                            message['MessageId'], exc_info=True)
+            _counter_errors.labels('sqs').inc()
+            return False
+        _logger.info("processed sqs message. message_id=%s", message['MessageId'])
+        _counter_sqs.inc()
+        return True
+
+    def _extend_visibility(self, sqs, messages: List[dict]):
+        _logger.debug("extending visibility of sqs messages. count=%d", len(messages))
+        try:
+            with stages.stage("sqs_extend_visibility"):
+                response = sqs.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=[
+                    {'Id': str(i), 'ReceiptHandle': message['ReceiptHandle'],
+                     'VisibilityTimeout': self.visibility_timeout} for i, message in enumerate(messages)])
+        except Exception:
+            _logger.warning("failed extending visibility of sqs messages.", exc_info=True)
+            _counter_errors.labels('sqs').inc()
+            return
+        _counter_sqs_extended.inc(len(response.get('Successful', [])))
+        for failed in response.get('Failed', []):
+            _logger.warning("failed extending visibility of sqs message. failed=%s", failed)
+            _counter_errors.labels('sqs').inc()
+
+    def _delete(self, sqs, messages: List[dict]):
+        if not messages:
+            return
+        with stages.stage("sqs_delete"):
+            response = sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=[
+                {'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']} for i, message in enumerate(messages)])
+        for failed in response.get('Failed', []):
+            _logger.warning("failed deleting sqs message. failed=%s", failed)
+            _counter_errors.labels('sqs').inc()
+
+    def _sleep(self, seconds: float):
+        with self._wake:
+            self._wake.wait_for(lambda: self._triggered or self._close.is_set(), seconds)
+            self._triggered = False
 
     def __enter__(self):
-        thread = threading.Thread(target=self.run)
-        thread.daemon = True
-        thread.start()
+        try:
+            self.client()
+        except Exception:
+            _logger.warning("failed creating sqs client.", exc_info=True)
+        for i in range(self.pollers):
+            thread = threading.Thread(target=self.run, name="sqs-poller-%d" % i)
+            thread.daemon = True
+            thread.start()
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
         self.close()
+        self._executor.shutdown(wait=False)
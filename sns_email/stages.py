@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+import threading
+import time
+
+import prometheus_client
+
+from sns_email import logger
+
+_logger = logger.getChild('trace')
+
+_stage_time = prometheus_client.Histogram('sns_email_stage_seconds', 'Time spent in each stage of receiving a mail',
+                                          ['stage'])
+
+_local = threading.local()
+_enabled = False
+_histograms = {}
+
+
+def configure(trace: bool = False):
+    """Enables logging one line with the time of each stage, for every notification. """
+    global _enabled
+    _enabled = trace
+
+
+class _Stage:
+    __slots__ = ('_name', '_histogram', '_start')
+
+    def __init__(self, name: str, histogram):
+        self._name = name
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.perf_counter() - self._start
+        self._histogram.observe(elapsed)
+        if _enabled:
+            spans = getattr(_local, 'spans', None)
+            if spans is not None:
+                spans.append((self._name, elapsed))
+
+
+def stage(name: str) -> _Stage:
+    """Returns a context manager timing the stage ``name`` in ``sns_email_stage_seconds`` and the current trace. """
+    histogram = _histograms.get(name)
+    if histogram is None:
+        histogram = _histograms[name] = _stage_time.labels(name)
+    return _Stage(name, histogram)
+
+
+class _Trace:
+    __slots__ = ('_fields', '_start')
+
+    def __init__(self, fields: dict):
+        self._fields = fields
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        _local.spans = []
+        _local.fields = self._fields
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.perf_counter() - self._start
+        spans = _local.spans
+        _local.spans = None
+        _local.fields = None
+        parts = ["%s=%s" % item for item in self._fields.items()]
+        parts.append("total=%.6f" % elapsed)
+        parts.extend("%s=%.6f" % span for span in spans)
+        if exc_type is not None:
+            parts.append("error=%s" % exc_type.__name__)
+        _logger.info("trace. %s", ", ".join(parts))
+
+
+class _NoTrace:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_no_trace = _NoTrace()
+
+
+def trace(**fields):
+    """Returns a context manager logging the stages run inside it by this thread, unless already tracing. """
+    if not _enabled or getattr(_local, 'spans', None) is not None:
+        return _no_trace
+    return _Trace(fields)
+
+
+def annotate(**fields):
+    """Adds fields to the line of the current trace. """
+    if _enabled:
+        current = getattr(_local, 'fields', None)
+        if current is not None:
+            current.update(fields)
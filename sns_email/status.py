@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+import json
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Tuple
+from urllib.parse import urlparse, parse_qs
+
+import prometheus_client
+
+from sns_email import logger
+from sns_email.profiling import Profiler, ProfilerBusyException
+from sns_email.receive import deliveries_in_flight
+from sns_email.sns import metrics_output
+
+_logger = logger.getChild('status')
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """Handler for ``/metrics``, ``/health``, ``/ready`` and the ``/admin/`` profiling endpoints if enabled. """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path
+        if path.startswith("/admin/") and self.server.profiler is not None:
+            self._admin(path, parse_qs(url.query))
+        elif path in ("/", "/metrics"):
+            content_type, output = metrics_output(self.server.registry, self.path, self.headers.get('Accept'))
+            self._send(HTTPStatus.OK, content_type, output)
+        elif path == "/health":
+            self._send(HTTPStatus.OK, "text/plain", b"ok\n")
+        elif path == "/ready":
+            status = self.server.status()
+            self._send(HTTPStatus.OK if status['ready'] else HTTPStatus.SERVICE_UNAVAILABLE, "application/json",
+                       json.dumps(status).encode())
+        else:
+            self._send(HTTPStatus.NOT_FOUND, "text/plain", b"")
+
+    def _admin(self, path: str, params: dict):
+        profiler = self.server.profiler
+
+        def param(name, default, convert=str):
+            return convert(params[name][0]) if name in params else default
+
+        try:
+            if path == "/admin/profile":
+                counts = profiler.sample(param("seconds", 10.0, float))
+                if param("format", "top") == "collapsed":
+                    output = profiler.collapsed(counts)
+                else:
+                    output = profiler.top(counts, param("limit", 30, int))
+            elif path == "/admin/tracemalloc/start":
+                profiler.start_tracing(param("frames", 1, int))
+                output = "started\n"
+            elif path == "/admin/tracemalloc/stop":
+                profiler.stop_tracing()
+                output = "stopped\n"
+            elif path == "/admin/tracemalloc/snapshot":
+                output = profiler.snapshot(param("limit", 30, int), param("key", "lineno"))
+            elif path == "/admin/tracemalloc/diff":
+                output = profiler.diff(param("limit", 30, int), param("key", "lineno"))
+            else:
+                self._send(HTTPStatus.NOT_FOUND, "text/plain", b"")
+                return
+        except ProfilerBusyException as e:
+            self._send(HTTPStatus.CONFLICT, "text/plain", ("%s\n" % e).encode())
+        except ValueError as e:
+            self._send(HTTPStatus.BAD_REQUEST, "text/plain", ("%s\n" % e).encode())
+        else:
+            self._send(HTTPStatus.OK, "text/plain", output.encode())
+
+    def _send(self, status: HTTPStatus, content_type: str, content: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, fmt, *args):
+        _logger.debug(fmt % args)
+
+
+class StatusServer(ThreadingHTTPServer):
+    """HTTP server for metrics, health and readiness, on its own port and threads.
+
+    ``/ready`` answers 503 when the requests reported by ``load``, a callable returning the requests in flight and
+    the capacity of the SNS server, reach ``saturation`` of its capacity, so that busy replicas can be avoided.
+    With ``admin``, ``/admin/profile`` samples the stacks of all threads, and ``/admin/tracemalloc/`` starts, stops,
+    snapshots and diffs allocation tracing.
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address: Tuple[str, int], load: Callable[[], Tuple[int, int]] = None,
+                 registry=prometheus_client.REGISTRY, saturation: float = 1.0, admin: bool = False):
+        self.load = load
+        self.profiler = Profiler() if admin else None
+        self.registry = registry
+        self.saturation = saturation
+        self._thread = None
+        super().__init__(server_address, StatusHandler)
+
+    def status(self) -> dict:
+        in_flight, capacity = self.load() if self.load is not None else (0, 0)
+        saturation = in_flight / capacity if capacity else 0.0
+        return {'ready': saturation < self.saturation, 'in_flight': in_flight, 'capacity': capacity,
+                'saturation': saturation, 'deliveries': deliveries_in_flight()}
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="status")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
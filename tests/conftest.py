@@ -1,17 +1,23 @@
 import io
 import re
+import sys
+import threading
+import time
 from pathlib import Path
 from unittest import mock
 
 import pytest
 
+from fake_smtp import FakeSmtpServer
+import sns_email
 from sns_email import counter
 from sns_email.deliver import sendmail_deliver
 
 
 @pytest.fixture(autouse=True)
 def reset():
-    counter._counter.cache_clear()
+    counter.configure()
+    sns_email.clear_clients()
 
 
 @pytest.fixture(autouse=True, scope="session")
@@ -45,6 +51,38 @@ def mock_deliver():
     return mock_deliver
 
 
+@pytest.fixture
+def recording_receiver():
+    class recording_receiver:
+        """Receiver recording the ``n`` of each body delivered, setting ``done`` once ``expected`` were delivered.
+
+        Bodies numbered in ``fail_numbers`` and the first ``fail`` other attempts raise ``exception``. ``attempts``
+        holds the monotonic time of every call.
+        """
+
+        def __init__(self, expected=1, fail=0, fail_numbers=(), exception=ValueError):
+            self.received = []
+            self.attempts = []
+            self.expected = expected
+            self.fail = fail
+            self.fail_numbers = fail_numbers
+            self.exception = exception
+            self.done = threading.Event()
+
+        def receive(self, body):
+            self.attempts.append(time.monotonic())
+            if body['n'] in self.fail_numbers:
+                raise self.exception()
+            if self.fail:
+                self.fail -= 1
+                raise self.exception()
+            self.received.append(body['n'])
+            if len(self.received) >= self.expected:
+                self.done.set()
+
+    return recording_receiver
+
+
 @pytest.fixture
 def mock_sendmail_deliver(tmp_path):
     path = tmp_path / "sendmail"
@@ -59,12 +97,39 @@ cat > '{tmp_path}'/out/rec
         out_path = tmp_path / "out"
 
         def __init__(self, source, recipients):
-            super().__init__(source, recipients, sendmail_path=str(path))
             self.out_path.mkdir(parents=True, exist_ok=True)
+            super().__init__(source, recipients, sendmail_path=str(path))
 
     return mock_sendmail_deliver
 
 
+@pytest.fixture
+def mock_sendmail_bs(tmp_path):
+    """Path of a fake ``sendmail -bs`` storing messages in the ``out`` directory next to it. """
+    path = tmp_path / "sendmail"
+    out_path = tmp_path / "out"
+    out_path.mkdir()
+    with path.open("w") as f:
+        f.write(f"""#!/bin/sh
+[ "$1" = "-bs" ] || exit 1
+exec '{sys.executable}' '{Path(__file__).parent / "fake_smtp.py"}' '{out_path}'
+""")
+    path.chmod(0o777)
+    return path
+
+
+@pytest.fixture
+def smtp_server():
+    with FakeSmtpServer() as server:
+        yield server
+
+
+@pytest.fixture
+def lmtp_server():
+    with FakeSmtpServer(lmtp=True, reject=("unknown@example.com",)) as server:
+        yield server
+
+
 @pytest.fixture(scope="session")
 def test_data_dir() -> Path:
     return Path(__file__).parent / "test-data"
@@ -0,0 +1,124 @@
+"""Minimal SMTP/LMTP server standing in for the local MTA in tests.
+
+Run as a script it speaks SMTP on stdin/stdout like ``sendmail -bs``, storing each message as a json file in the
+directory passed as first argument.
+"""
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+from pathlib import Path
+
+
+def serve_session(rfile, wfile, deliver, lmtp=False, reject=(), defer=()):
+    def reply(line):
+        wfile.write(line.encode() + b"\r\n")
+        wfile.flush()
+
+    mail_from, recipients = None, []
+    reply("220 localhost fake ready")
+    while True:
+        line = rfile.readline()
+        if not line:
+            return
+        command, _, argument = line.decode().rstrip("\r\n").partition(" ")
+        command = command.upper()
+        if command in ("EHLO", "HELO", "LHLO"):
+            if (command == "LHLO") != lmtp:
+                reply("500 unexpected greeting")
+            else:
+                reply("250 localhost")
+        elif command == "MAIL":
+            mail_from, recipients = argument.partition(":")[2].strip("<>"), []
+            reply("250 ok")
+        elif command == "RCPT":
+            recipient = argument.partition(":")[2].strip("<>")
+            if recipient in reject:
+                reply("550 no such user")
+            elif recipient in defer:
+                reply("451 try again later")
+            else:
+                recipients.append(recipient)
+                reply("250 ok")
+        elif command == "DATA":
+            reply("354 go ahead")
+            data = bytearray()
+            while True:
+                line = rfile.readline()
+                if line in (b".\r\n", b""):
+                    break
+                data.extend(line[1:] if line.startswith(b".") else line)
+            deliver(mail_from, recipients, bytes(data))
+            for _ in (recipients if lmtp else [None]):
+                reply("250 delivered")
+            mail_from, recipients = None, []
+        elif command == "RSET":
+            mail_from, recipients = None, []
+            reply("250 ok")
+        elif command == "NOOP":
+            reply("250 ok")
+        elif command == "QUIT":
+            reply("221 bye")
+            return
+        else:
+            reply("502 not implemented")
+
+
+class FakeSmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, lmtp=False, reject=(), defer=()):
+        self.lmtp = lmtp
+        self.reject = reject
+        self.defer = defer
+        self.messages = []
+        self.sessions = 0
+        self._connections = []
+        super().__init__(("127.0.0.1", 0), FakeSmtpHandler)
+
+    def deliver(self, mail_from, recipients, data):
+        self.messages.append((mail_from, recipients, data))
+
+    def disconnect_all(self):
+        for connection in self._connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._connections.clear()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.1})
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self._thread.join()
+        self.disconnect_all()
+        self.server_close()
+
+
+class FakeSmtpHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.sessions += 1
+        self.server._connections.append(self.request)
+        try:
+            serve_session(self.rfile, self.wfile, self.server.deliver, self.server.lmtp, self.server.reject,
+                          self.server.defer)
+        except (OSError, ValueError):
+            pass
+
+
+if __name__ == '__main__':
+    out_path = Path(sys.argv[1])
+
+    def store(mail_from, recipients, data):
+        name = "%d-%d" % (os.getpid(), len(list(out_path.iterdir())))
+        with open(out_path / name, "w") as f:
+            json.dump({"from": mail_from, "recipients": recipients, "data": data.decode()}, f)
+
+    serve_session(sys.stdin.buffer, sys.stdout.buffer, store)
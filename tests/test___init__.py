@@ -1,6 +1,6 @@
 from concurrent.futures.thread import ThreadPoolExecutor
 
-from sns_email import boto_session
+from sns_email import boto_session, boto_client, clear_clients
 
 
 def test_boto_session():
@@ -24,3 +24,19 @@ def test_boto_session():
         assert executor.submit(lambda: get_it() is get_it()).result()
 
     assert 2 <= len(r) <= count + 1
+
+
+def test_boto_client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        clients = set(executor.map(lambda _: boto_client('sqs', region="eu-west-1"), range(8)))
+    assert len(clients) == 1
+    client = clients.pop()
+    assert client.meta.region_name == "eu-west-1"
+    assert boto_client('sqs', region="eu-central-1") is not client
+    assert boto_client('sqs', region="eu-west-1", max_pool_connections=20).meta.config.max_pool_connections == 20
+
+    clear_clients()
+    assert boto_client('sqs', region="eu-west-1") is not client
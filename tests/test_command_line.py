@@ -3,9 +3,13 @@ import os
 import re
 from unittest import mock
 
+import prometheus_client
 import pytest
 
 from sns_email import command_line
+from sns_email.deliver import sendmail_deliver
+from sns_email.maildir import MaildirDelivery
+from sns_email.smtp import SmtpPool, SendmailPool
 
 
 @pytest.fixture(autouse=True)
@@ -21,6 +25,25 @@ def mock_sns():
         yield m
 
 
+@pytest.fixture(autouse=True)
+def mock_async_sns():
+    with mock.patch('sns_email.command_line.AsyncSnsServer', spec=True) as m:
+        m.__call__().server_address = ("localhost", 10000)
+        yield m
+
+
+@pytest.fixture(autouse=True)
+def mock_smtp_pool():
+    with mock.patch('sns_email.command_line.SmtpPool', spec=SmtpPool) as m:
+        yield m
+
+
+@pytest.fixture(autouse=True)
+def mock_sendmail_pool():
+    with mock.patch('sns_email.command_line.SendmailPool', spec=SendmailPool) as m:
+        yield m
+
+
 @pytest.fixture(autouse=True)
 def mock_logging():
     with mock.patch('sns_email.command_line.logging') as m:
@@ -29,25 +52,80 @@ def mock_logging():
         yield m
 
 
+@pytest.fixture(autouse=True)
+def mock_dynamodb():
+    with mock.patch('sns_email.command_line.DynamoDbDedup') as m:
+        yield m
+
+
+@pytest.fixture(autouse=True)
+def mock_sns_signature():
+    with mock.patch('sns_email.command_line.sns_signature') as m:
+        yield m
+
+
+@pytest.fixture(autouse=True)
+def mock_counter():
+    with mock.patch('sns_email.command_line.counter') as m:
+        yield m
+
+
+@pytest.fixture(autouse=True)
+def mock_spool():
+    with mock.patch('sns_email.command_line.Spool') as m:
+        yield m
+
+
+@pytest.fixture(autouse=True)
+def mock_s3_fetcher():
+    with mock.patch('sns_email.command_line.S3Fetcher') as m:
+        yield m
+
+
+@pytest.fixture(autouse=True)
+def mock_status():
+    with mock.patch('sns_email.command_line.StatusServer') as m:
+        yield m
+
+
+@pytest.fixture(autouse=True)
+def mock_retry_queue():
+    with mock.patch('sns_email.command_line.RetryQueue') as m:
+        yield m
+
+
 @pytest.fixture(autouse=True)
 def mock_message_receiver():
     with mock.patch('sns_email.command_line.MessageReceiver') as m:
         yield m
 
 
-def test_defaults(mock_sqs, mock_sns, mock_logging, mock_message_receiver):
+def test_defaults(mock_sqs, mock_sns, mock_logging, mock_message_receiver, mock_counter):
     command_line.main([])
 
     mock_logging.basicConfig.assert_called_with(level=logging.INFO, format=mock.ANY, datefmt=mock.ANY)
-    mock_sns.assert_called_with(receiver=mock.ANY, server_address=("localhost", 10000))
+    mock_sns.assert_called_with(receiver=mock.ANY, server_address=("localhost", 10000),
+                                workers=0, queue_size=32, idle_timeout=15, max_requests=100,
+                                registry=prometheus_client.REGISTRY, reuse_port=False)
     mock_sqs.assert_not_called()
-    mock_message_receiver.assert_called_with(rex=re.compile(r".*"))
+    mock_message_receiver.assert_called_with(rex=re.compile(r".*"), deliver=mock.ANY, max_attempts=2,
+                                             s3_fetcher=mock.ANY)
+    mock_counter.configure.assert_called_with(size=10000, ttl=86400, journal=None, backend=None, lease=600, wait=0)
+
+
+def test_sendmail_delivery(mock_message_receiver):
+    command_line.main(["--sendmail-path=/usr/sbin/sendmail"])
+
+    deliver = mock_message_receiver.call_args.kwargs["deliver"]
+    assert deliver.func is sendmail_deliver
+    assert deliver.keywords == {"sendmail_path": "/usr/sbin/sendmail"}
 
 
 def test_destination_from_env(mock_logging, mock_message_receiver):
     with mock.patch.dict(os.environ, {"SNS_EMAIL_ACCEPT_DESTINATION": "[ab]+@test\\.com"}):
         command_line.main([])
-    mock_message_receiver.assert_called_with(rex=re.compile(r"[ab]+@test\.com"))
+    mock_message_receiver.assert_called_with(rex=re.compile(r"[ab]+@test\.com"), deliver=mock.ANY, max_attempts=2,
+                                             s3_fetcher=mock.ANY)
 
 
 def test_destination_from_config(tmp_path, mock_logging, mock_message_receiver):
@@ -55,22 +133,42 @@ def test_destination_from_config(tmp_path, mock_logging, mock_message_receiver):
     with open(config_file, "wt") as f:
         f.write("accept-destination=[ac]+@test\\.com")
     command_line.main(["-c", config_file])
-    mock_message_receiver.assert_called_with(rex=re.compile(r"[ac]+@test\.com"))
+    mock_message_receiver.assert_called_with(rex=re.compile(r"[ac]+@test\.com"), deliver=mock.ANY, max_attempts=2,
+                                             s3_fetcher=mock.ANY)
 
 
 def test_sqs_url(mock_sqs, mock_sns, mock_logging):
     command_line.main(["--sqs-queue-url=test", "--sqs-region=eu-west-1"])
 
     mock_logging.basicConfig.assert_called_with(level=logging.INFO, format=mock.ANY, datefmt=mock.ANY)
-    mock_sns.assert_called_with(receiver=mock.ANY, server_address=("localhost", 10000))
-    mock_sqs.assert_called_with(receiver=mock.ANY, queue_url="test", region="eu-west-1")
+    mock_sns.assert_called_with(receiver=mock.ANY, server_address=("localhost", 10000),
+                                workers=0, queue_size=32, idle_timeout=15, max_requests=100,
+                                registry=prometheus_client.REGISTRY, reuse_port=False)
+    mock_sqs.assert_called_with(receiver=mock.ANY, queue_url="test", region="eu-west-1", workers=4, pollers=1,
+                                visibility_timeout=60, backoff_max=600)
+
+
+def test_sqs_concurrency(mock_sqs):
+    command_line.main(["--sqs-queue-url=test", "--sqs-workers=16", "--sqs-pollers=2", "--sqs-visibility-timeout=30",
+                       "--sqs-max-backoff=60"])
+
+    mock_sqs.assert_called_with(receiver=mock.ANY, queue_url="test", region=None, workers=16, pollers=2,
+                                visibility_timeout=30, backoff_max=60)
+
+
+def test_sqs_poll_on_error(mock_sqs, mock_sns):
+    command_line.main(["--sqs-queue-url=test", "--sqs-poll-on-error"])
+
+    assert mock_sns.return_value.on_error == mock_sqs.return_value.__enter__.return_value.trigger
 
 
 def test_custom_address(mock_sqs, mock_sns, mock_logging):
     command_line.main(["--address=dns.name", "--port=1000"])
 
     mock_logging.basicConfig.assert_called_with(level=logging.INFO, format=mock.ANY, datefmt=mock.ANY)
-    mock_sns.assert_called_with(receiver=mock.ANY, server_address=("dns.name", 1000))
+    mock_sns.assert_called_with(receiver=mock.ANY, server_address=("dns.name", 1000),
+                                workers=0, queue_size=32, idle_timeout=15, max_requests=100,
+                                registry=prometheus_client.REGISTRY, reuse_port=False)
 
 
 def test_one_verbose(mock_logging):
@@ -86,3 +184,216 @@ def test_two_verbose(mock_logging):
 
     mock_logging.basicConfig.assert_called_with(level=logging.INFO, format=mock.ANY, datefmt=mock.ANY)
     mock_logging.root.setLevel.assert_called_with(logging.DEBUG)
+
+
+def test_workers(mock_sns, mock_logging):
+    command_line.main(["--workers=8", "--queue-size=100"])
+
+    mock_sns.assert_called_with(receiver=mock.ANY, server_address=("localhost", 10000), workers=8, queue_size=100,
+                                idle_timeout=15, max_requests=100,
+                                registry=prometheus_client.REGISTRY, reuse_port=False)
+
+
+def test_asyncio_engine(mock_sns, mock_async_sns, mock_logging):
+    command_line.main(["--engine=asyncio", "--workers=8"])
+
+    mock_sns.return_value.serve_forever.assert_not_called()
+    mock_async_sns.assert_called_with(receiver=mock.ANY, server_address=("localhost", 10000), workers=8,
+                                      queue_size=32, idle_timeout=15, max_requests=100,
+                                      registry=prometheus_client.REGISTRY, reuse_port=False)
+
+
+def test_keep_alive(mock_sns, mock_logging):
+    command_line.main(["--keep-alive-timeout=2.5", "--keep-alive-requests=10"])
+
+    mock_sns.assert_called_with(receiver=mock.ANY, server_address=("localhost", 10000), workers=0, queue_size=32,
+                                idle_timeout=2.5, max_requests=10,
+                                registry=prometheus_client.REGISTRY, reuse_port=False)
+
+
+def test_lmtp_delivery(mock_smtp_pool, mock_message_receiver):
+    command_line.main(["--delivery=lmtp", "--smtp-host=/run/lmtp", "--smtp-pool-size=8"])
+
+    mock_smtp_pool.assert_called_with(host="/run/lmtp", port=0, size=8, lmtp=True, max_messages=100)
+    mock_message_receiver.assert_called_with(rex=mock.ANY, deliver=mock_smtp_pool.return_value, max_attempts=2,
+                                             s3_fetcher=mock.ANY)
+    mock_smtp_pool.return_value.close.assert_called_once()
+
+
+def test_sendmail_bs_delivery(mock_sendmail_pool, mock_message_receiver):
+    command_line.main(["--delivery=sendmail-bs", "--smtp-pool-size=2", "--smtp-session-messages=10"])
+
+    mock_sendmail_pool.assert_called_with(sendmail_path="/usr/bin/sendmail", size=2, max_messages=10)
+    mock_message_receiver.assert_called_with(rex=mock.ANY, deliver=mock_sendmail_pool.return_value,
+                                             max_attempts=2, s3_fetcher=mock.ANY)
+    mock_sendmail_pool.return_value.close.assert_called_once()
+
+
+def test_maildir_delivery(tmp_path, mock_message_receiver):
+    mapping_file = tmp_path / "mapping"
+    mapping_file.write_text("a@example.com /srv/a\n")
+    command_line.main(["--delivery=maildir", "--accept-destination=(.*)@example\\.com",
+                       "--maildir-path=/srv/mail/\\1", "--maildir-map=%s" % mapping_file])
+
+    deliver = mock_message_receiver.call_args.kwargs["deliver"]
+    assert isinstance(deliver, MaildirDelivery)
+    assert deliver.maildir("a@example.com") == "/srv/a"
+    assert deliver.maildir("b@example.com") == "/srv/mail/b"
+    assert deliver.fsync and deliver._syncer is None
+
+
+def test_dedup(mock_counter):
+    command_line.main(["--dedup-size=100", "--dedup-ttl=60"])
+
+    mock_counter.configure.assert_called_with(size=100, ttl=60, journal=None, backend=None, lease=600, wait=0)
+
+
+def test_state_dir(tmp_path, mock_counter, mock_sns_signature):
+    command_line.main(["--state-dir=%s" % (tmp_path / "state")])
+
+    journal = mock_counter.configure.call_args.kwargs["journal"]
+    assert journal.path == str(tmp_path / "state" / "dedup.sqlite")
+    mock_sns_signature.configure.assert_called_with(cache_dir=str(tmp_path / "state" / "certificates"),
+                                                    offline=False, prefetch=[], verified_size=1024, processes=0,
+                                                    batch_size=16)
+
+
+def test_dedup_dynamodb(mock_counter, mock_dynamodb):
+    command_line.main(["--dedup-dynamodb-table=dedup", "--dedup-dynamodb-region=eu-west-1", "--dedup-lease=60",
+                       "--dedup-wait=5"])
+
+    mock_dynamodb.assert_called_with(table_name="dedup", region="eu-west-1", ttl=86400)
+    mock_counter.configure.assert_called_with(size=10000, ttl=86400, journal=None,
+                                              backend=mock_dynamodb.return_value, lease=60, wait=5)
+
+
+def test_dedup_dynamodb_state_dir(tmp_path, mock_counter, mock_dynamodb):
+    command_line.main(["--dedup-dynamodb-table=dedup", "--state-dir=%s" % tmp_path])
+
+    mock_counter.configure.assert_called_with(size=10000, ttl=86400, journal=None,
+                                              backend=mock_dynamodb.return_value, lease=600, wait=0)
+    assert not (tmp_path / "dedup.sqlite").exists()
+
+
+def test_certificates(mock_sns_signature):
+    command_line.main(["--certificate-dir=/var/lib/certs", "--offline-certificates", "--verified-cache-size=10",
+                       "--certificate-url=https://a/1.pem", "--certificate-url=https://b/2.pem"])
+
+    mock_sns_signature.configure.assert_called_with(cache_dir="/var/lib/certs", offline=True,
+                                                    prefetch=["https://a/1.pem", "https://b/2.pem"],
+                                                    verified_size=10, processes=0, batch_size=16)
+
+
+def test_verify_processes(mock_sns_signature):
+    command_line.main(["--verify-processes=4", "--verify-batch-size=8"])
+
+    mock_sns_signature.configure.assert_called_with(cache_dir=None, offline=False, prefetch=[], verified_size=1024,
+                                                    processes=4, batch_size=8)
+    mock_sns_signature.close.assert_called_once()
+
+
+def test_spool(mock_spool, mock_sns, mock_message_receiver):
+    command_line.main(["--spool-dir=/var/spool/sns-email", "--spool-workers=4", "--spool-max-attempts=3"])
+
+    mock_spool.assert_called_with(receiver=mock_message_receiver.return_value, path="/var/spool/sns-email",
+                                  workers=4, max_size=10000, max_attempts=3)
+    assert mock_sns.call_args.kwargs["receiver"] is mock_spool.return_value.__enter__.return_value
+
+
+def test_retry(mock_retry_queue, mock_spool, mock_message_receiver):
+    command_line.main(["--retry-dir=/var/lib/retry", "--retry-max-attempts=5", "--spool-dir=/var/spool/sns-email"])
+
+    mock_message_receiver.assert_called_with(rex=mock.ANY, deliver=mock.ANY, max_attempts=0,
+                                             s3_fetcher=mock.ANY)
+    mock_retry_queue.assert_called_with(receiver=mock_message_receiver.return_value, path="/var/lib/retry",
+                                        dead_letter_dir=None, max_attempts=5, backoff_min=30, backoff_max=3600)
+    assert mock_spool.call_args.kwargs["receiver"] is mock_retry_queue.return_value.__enter__.return_value
+
+
+def test_s3(mock_s3_fetcher, mock_message_receiver):
+    command_line.main(["--s3-part-size=1048576", "--s3-window=2"])
+
+    mock_s3_fetcher.assert_called_with(part_size=1048576, window=2, workers=8, message_memory=32 * 1024 * 1024,
+                                       max_memory=256 * 1024 * 1024)
+    assert mock_message_receiver.call_args.kwargs["s3_fetcher"] is mock_s3_fetcher.return_value.__enter__.return_value
+
+
+@pytest.fixture
+def mock_supervisor():
+    with mock.patch('sns_email.command_line.Supervisor') as m:
+        yield m
+
+
+def test_processes(mock_supervisor, monkeypatch, tmp_path):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    with mock.patch('sns_email.command_line.os.execv') as mock_execv:
+        command_line.main(["--processes=2", "--state-dir=%s" % tmp_path])
+    mock_execv.assert_not_called()
+    mock_supervisor.assert_called_with(mock.ANY, processes=2, remove_multiproc_dir=False)
+    mock_supervisor.return_value.run.assert_called_once()
+
+
+def test_processes_multiprocess_metrics(mock_supervisor, tmp_path):
+    with mock.patch.dict(os.environ), mock.patch('sns_email.command_line.os.execv', side_effect=SystemExit) as \
+            mock_execv:
+        os.environ.pop("PROMETHEUS_MULTIPROC_DIR", None)
+        with pytest.raises(SystemExit):
+            command_line.main(["--processes=2", "--state-dir=%s" % tmp_path])
+        assert os.path.isdir(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+        # started again
+        command_line.main(["--processes=2", "--state-dir=%s" % tmp_path])
+        os.rmdir(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+    assert mock_execv.call_args.args[1][-2:] == ["--processes=2", "--state-dir=%s" % tmp_path]
+    mock_supervisor.assert_called_once_with(mock.ANY, processes=2, remove_multiproc_dir=True)
+
+
+def test_processes_need_shared_state(mock_supervisor):
+    with pytest.raises(SystemExit):
+        command_line.main(["--processes=2"])
+    mock_supervisor.assert_not_called()
+
+
+@pytest.mark.parametrize("index", [0, 1])
+def test_serve_worker(index, mock_sqs, mock_sns, mock_spool, mock_counter, mock_status, monkeypatch, tmp_path):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    args = command_line.argument_parser.parse_args(["--processes=2", "--state-dir=%s" % tmp_path,
+                                                    "--spool-dir=/var/spool/sns-email", "--sqs-queue-url=queue",
+                                                    "--metrics-port=9100"])
+    command_line.serve(args, index=index)
+
+    backend = mock_counter.configure.call_args.kwargs["backend"]
+    assert type(backend).__name__ == "SqliteDedup"
+    assert mock_counter.configure.call_args.kwargs["journal"] is None
+    assert mock_spool.call_args.kwargs["path"] == "/var/spool/sns-email/%d" % index
+    assert mock_sqs.called == (index == 0)
+    assert mock_sns.call_args.kwargs["reuse_port"]
+    assert mock_sns.call_args.kwargs["registry"] is not prometheus_client.REGISTRY
+    assert mock_status.call_args.kwargs["server_address"] == ("localhost", 9100 + index)
+
+
+def test_status(mock_status, mock_sns):
+    command_line.main(["--metrics-port=9100", "--ready-saturation=0.8"])
+
+    mock_status.assert_called_with(server_address=("localhost", 9100), load=mock_sns.return_value.load,
+                                   registry=prometheus_client.REGISTRY, saturation=0.8, admin=False)
+
+
+def test_no_status(mock_status):
+    command_line.main([])
+
+    mock_status.assert_not_called()
+
+
+def test_trace():
+    with mock.patch('sns_email.command_line.stages') as mock_stages:
+        command_line.main(["--trace"])
+    mock_stages.configure.assert_called_with(trace=True)
+
+
+def test_admin(mock_status):
+    command_line.main(["--metrics-port=9100", "--admin"])
+    assert mock_status.call_args.kwargs["admin"]
+
+    with pytest.raises(SystemExit):
+        command_line.main(["--admin"])
@@ -1,4 +1,10 @@
-from sns_email.counter import count
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from sns_email.counter import count, Counter, DedupBackend, DedupTable, CLAIMED, COMPLETED, IN_PROGRESS
 
 
 class TestCounter:
@@ -6,15 +12,17 @@ class TestCounter:
         with count(2) as c:
             assert c.value == 1
             assert not c
+            assert not c.in_progress
             with count(2) as c2:
-                assert c2.value == 2
+                assert c2.value == 1
                 assert not c2
-            assert c
+                assert c2.in_progress
 
         with count(3) as c:
             assert c.value == 1
         with count(2) as c:
             assert c
+            assert not c.in_progress
 
     def test_count_failure(self):
         try:
@@ -27,6 +35,7 @@ class TestCounter:
 
         with count(2) as c:
             assert not c
+            assert not c.in_progress
             assert c.value == 2
         with count(2) as c:
             assert c
@@ -36,8 +45,124 @@ class TestCounter:
             assert c1 is not c2
             assert c1.value == 1
             assert c2.value == 1
+            assert not c2.in_progress
 
         with count(1) as c1, count(2) as c2:
             assert c1 is not c2
             assert c1
             assert c2
+
+    def test_wait_completed(self):
+        table = DedupTable()
+        entered = threading.Event()
+        release = threading.Event()
+
+        def first():
+            with Counter(table, "a", 60):
+                entered.set()
+                release.wait(timeout=10)
+
+        thread = threading.Thread(target=first)
+        thread.start()
+        assert entered.wait(timeout=10)
+        threading.Timer(0.1, release.set).start()
+        with Counter(table, "a", 60, wait=10) as c:
+            assert c
+            assert not c.in_progress
+        thread.join(timeout=10)
+
+    def test_wait_failed(self):
+        table = DedupTable()
+        entered = threading.Event()
+        release = threading.Event()
+
+        def first():
+            try:
+                with Counter(table, "a", 60):
+                    entered.set()
+                    release.wait(timeout=10)
+                    raise ValueError()
+            except ValueError:
+                pass
+
+        thread = threading.Thread(target=first)
+        thread.start()
+        assert entered.wait(timeout=10)
+        with Counter(table, "a", 60, wait=0.05) as c:
+            assert c.in_progress
+        threading.Timer(0.1, release.set).start()
+        with Counter(table, "a", 60, wait=10) as c:
+            assert not c
+            assert not c.in_progress
+            assert c.value == 2
+        thread.join(timeout=10)
+
+    def test_lease_taken_over(self):
+        table = DedupTable()
+        first = Counter(table, "a", 0.05).__enter__()
+        time.sleep(0.1)
+        second = Counter(table, "a", 60).__enter__()
+        assert second.value == 2
+        first.__exit__(ValueError, ValueError(), None)
+        with Counter(table, "a", 60) as third:
+            assert third.in_progress
+        second.__exit__(None, None, None)
+        with Counter(table, "a", 60) as c:
+            assert c
+
+
+class TestDedupTable:
+    def test_capacity(self):
+        table = DedupTable(size=4, stripes=1)
+        for i in range(10):
+            table.complete(i, table.claim(i, 60).token)
+        assert len(table) == 4
+        assert table.claim(0, 60).state == CLAIMED
+        assert table.claim(9, 60).state == COMPLETED
+
+    def test_recently_used_kept(self):
+        table = DedupTable(size=2, stripes=1)
+        table.complete(1, table.claim(1, 60).token)
+        table.claim(2, 60)
+        table.claim(1, 60)
+        table.claim(3, 60)
+        assert table.claim(1, 60).state == COMPLETED
+        assert len(table) == 2
+
+    def test_lease(self):
+        table = DedupTable()
+        with mock.patch("sns_email.counter.time.monotonic", return_value=100):
+            assert table.claim("a", 10)[:2] == (CLAIMED, 1)
+            assert table.claim("a", 10)[:2] == (IN_PROGRESS, 1)
+        with mock.patch("sns_email.counter.time.monotonic", return_value=111):
+            claim = table.claim("a", 10)
+            assert claim[:2] == (CLAIMED, 2)
+            assert table.fail("a", claim.token)
+            assert table.claim("a", 10)[:2] == (CLAIMED, 3)
+
+    def test_lease_taken_over(self):
+        table = DedupTable()
+        with mock.patch("sns_email.counter.time.monotonic", return_value=100):
+            expired = table.claim("a", 10)
+        with mock.patch("sns_email.counter.time.monotonic", return_value=111):
+            assert table.claim("a", 10)[:2] == (CLAIMED, 2)
+            assert not table.fail("a", expired.token)
+            assert not table.complete("a", expired.token)
+            assert table.claim("a", 10)[:2] == (IN_PROGRESS, 2)
+
+    def test_ttl(self):
+        table = DedupTable(ttl=10)
+        with mock.patch("sns_email.counter.time.monotonic", return_value=100):
+            table.complete("a", table.claim("a", 1).token)
+            assert table.claim("a", 1).state == COMPLETED
+        with mock.patch("sns_email.counter.time.monotonic", return_value=120):
+            assert table.claim("a", 1)[:2] == (CLAIMED, 1)
+
+
+def test_dedup_backend_incomplete():
+    class ClaimOnly(DedupBackend):
+        def claim(self, message_id, lease: float):
+            pass
+
+    with pytest.raises(TypeError):
+        ClaimOnly()
@@ -3,3 +3,10 @@ def test_sendmail_deliver(mock_sendmail_deliver):
         a.write("test".encode("utf-8"))
     for f in mock_sendmail_deliver.out_path.iterdir():
         print(f)
+
+
+def test_sendmail_deliver_str(mock_sendmail_deliver):
+    with mock_sendmail_deliver("a@example.com", []) as a:
+        a.write("test è")
+    with open(mock_sendmail_deliver.out_path / "rec", "rb") as f:
+        assert f.read() == "test è".encode("utf-8")
@@ -0,0 +1,59 @@
+from unittest import mock
+
+import boto3
+import pytest
+
+from sns_email.counter import Counter, CLAIMED, COMPLETED, IN_PROGRESS
+from sns_email.dynamodb import DynamoDbDedup
+
+moto = pytest.importorskip("moto")
+
+
+@pytest.fixture
+def dedup(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with moto.mock_aws():
+        session = boto3.session.Session(region_name="eu-west-1")
+        session.client('dynamodb').create_table(
+            TableName="dedup", BillingMode="PAY_PER_REQUEST",
+            KeySchema=[{'AttributeName': 'message_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'message_id', 'AttributeType': 'S'}])
+        yield DynamoDbDedup("dedup", boto_session=lambda: session)
+
+
+def test_claim_complete(dedup):
+    claim = dedup.claim("a", 60)
+    assert claim[:2] == (CLAIMED, 1)
+    assert dedup.claim("a", 60)[:2] == (IN_PROGRESS, 1)
+    assert dedup.complete("a", claim.token)
+    assert dedup.claim("a", 60)[:2] == (COMPLETED, 1)
+
+
+def test_claim_fail(dedup):
+    claim = dedup.claim("a", 60)
+    assert claim[:2] == (CLAIMED, 1)
+    assert dedup.fail("a", claim.token)
+    assert dedup.claim("a", 60)[:2] == (CLAIMED, 2)
+
+
+def test_lease_expired(dedup):
+    with mock.patch("sns_email.dynamodb.time.time", return_value=1000):
+        expired = dedup.claim("a", 60)
+        assert expired[:2] == (CLAIMED, 1)
+    with mock.patch("sns_email.dynamodb.time.time", return_value=1030):
+        assert dedup.claim("a", 60)[:2] == (IN_PROGRESS, 1)
+    with mock.patch("sns_email.dynamodb.time.time", return_value=1061):
+        assert dedup.claim("a", 60)[:2] == (CLAIMED, 2)
+        assert not dedup.fail("a", expired.token)
+        assert not dedup.complete("a", expired.token)
+        assert dedup.claim("a", 60)[:2] == (IN_PROGRESS, 2)
+
+
+def test_counter(dedup):
+    with Counter(dedup, "a", 60) as c:
+        assert not c
+        with Counter(dedup, "a", 60) as c2:
+            assert c2.in_progress
+    with Counter(dedup, "a", 60) as c:
+        assert c
@@ -0,0 +1,107 @@
+import time
+from unittest import mock
+
+from sns_email.counter import DedupTable, CLAIMED, COMPLETED, IN_PROGRESS
+from sns_email.journal import DedupJournal, SqliteDedup
+
+
+def test_journal(tmp_path):
+    journal = DedupJournal(str(tmp_path / "dedup.sqlite"))
+    journal.add("a")
+    assert "a" in journal
+    assert "b" not in journal
+    journal.close()
+
+    journal = DedupJournal(str(tmp_path / "dedup.sqlite"))
+    assert "a" in journal
+    journal.close()
+
+
+def test_journal_compaction(tmp_path):
+    journal = DedupJournal(str(tmp_path / "dedup.sqlite"), ttl=10, compact_interval=0)
+    with mock.patch("sns_email.journal.time.time", return_value=100):
+        journal.add("a")
+    with mock.patch("sns_email.journal.time.time", return_value=108):
+        journal.add("b")
+        journal.compact()
+        assert "a" in journal
+    with mock.patch("sns_email.journal.time.time", return_value=114):
+        assert "a" not in journal
+        journal.add("c")
+        journal.compact()
+    assert journal._db.execute("SELECT message_id FROM completed ORDER BY message_id").fetchall() == \
+        [("b",), ("c",)]
+    journal.close()
+
+
+def test_table_survives_restart(tmp_path):
+    journal = DedupJournal(str(tmp_path / "dedup.sqlite"))
+    table = DedupTable(journal=journal)
+    table.complete("a", table.claim("a", 60).token)
+    table.fail("b", table.claim("b", 60).token)
+
+    table = DedupTable(journal=journal)
+    assert table.claim("a", 60).state == COMPLETED
+    assert table.claim("b", 60).state == CLAIMED
+    journal.close()
+
+
+def test_sqlite_dedup_shared(tmp_path):
+    first = SqliteDedup(str(tmp_path / "dedup.sqlite"))
+    second = SqliteDedup(str(tmp_path / "dedup.sqlite"))
+    with mock.patch("sns_email.journal.time.time", return_value=100):
+        claim = first.claim("a", 10)
+        assert claim[:2] == (CLAIMED, 1)
+        assert second.claim("a", 10)[:2] == (IN_PROGRESS, 1)
+        assert first.fail("a", claim.token)
+        assert second.claim("a", 10)[:2] == (CLAIMED, 2)
+    with mock.patch("sns_email.journal.time.time", return_value=111):
+        claim = first.claim("a", 10)
+        assert claim[:2] == (CLAIMED, 3)
+        assert first.complete("a", claim.token)
+        assert second.claim("a", 10)[:2] == (COMPLETED, 3)
+    first.close()
+    second.close()
+
+
+def test_sqlite_dedup_taken_over(tmp_path):
+    first = SqliteDedup(str(tmp_path / "dedup.sqlite"), compact_interval=0)
+    second = SqliteDedup(str(tmp_path / "dedup.sqlite"), compact_interval=0)
+    with mock.patch("sns_email.journal.time.time", return_value=100):
+        expired = first.claim("a", 10)
+    with mock.patch("sns_email.journal.time.time", return_value=111):
+        assert second.claim("a", 10)[:2] == (CLAIMED, 2)
+        assert not first.fail("a", expired.token)
+        assert not first.complete("a", expired.token)
+        assert first.claim("a", 10)[:2] == (IN_PROGRESS, 2)
+    first.close()
+    second.close()
+
+
+def test_sqlite_dedup_ttl(tmp_path):
+    dedup = SqliteDedup(str(tmp_path / "dedup.sqlite"), ttl=10, compact_interval=0)
+    with mock.patch("sns_email.journal.time.time", return_value=100):
+        dedup.complete("a", dedup.claim("a", 1).token)
+        assert dedup.claim("a", 1).state == COMPLETED
+    with mock.patch("sns_email.journal.time.time", return_value=111):
+        assert dedup.claim("a", 1)[:2] == (CLAIMED, 1)
+        dedup.complete("b", dedup.claim("b", 1).token)
+    with mock.patch("sns_email.journal.time.time", return_value=125):
+        dedup.complete("c", dedup.claim("c", 1).token)
+        dedup.compact()
+    assert dedup._db.execute("SELECT message_id FROM claims").fetchall() == [("c",)]
+    dedup.close()
+
+
+def test_journal_compaction_thread(tmp_path):
+    journal = DedupJournal(str(tmp_path / "dedup.sqlite"), ttl=0.05, compact_interval=0.01)
+    journal.batch_size = 2
+    for message_id in "abcde":
+        journal.add(message_id)
+    for _ in range(500):
+        if not journal._db.execute("SELECT message_id FROM completed").fetchall():
+            break
+        time.sleep(0.01)
+    assert journal._db.execute("SELECT message_id FROM completed").fetchall() == []
+    journal.close()
+    assert journal._compactor is None
@@ -0,0 +1,108 @@
+import re
+import threading
+
+import pytest
+
+from sns_email.maildir import MaildirDelivery, load_mapping
+
+
+def test_deliver_template(tmp_path):
+    deliver = MaildirDelivery(template=str(tmp_path / r"\g<user>" / "Maildir"),
+                              rex=re.compile(r"(?P<user>[a-z]+)@example\.com"))
+    with deliver("source@example.com", ["a@example.com", "b@example.com"]) as f:
+        f.write("Subject: test è\n\n")
+        f.write(b"body\n")
+
+    for user in ("a", "b"):
+        maildir = tmp_path / user / "Maildir"
+        messages = list((maildir / "new").iterdir())
+        assert len(messages) == 1
+        assert messages[0].read_bytes() == "Subject: test è\n\nbody\n".encode("utf-8")
+        assert list((maildir / "tmp").iterdir()) == []
+        assert (maildir / "cur").is_dir()
+
+
+def test_deliver_mapping(tmp_path):
+    mapping_file = tmp_path / "mapping"
+    mapping_file.write_text("# comment\nA@example.com %s\n\n" % (tmp_path / "a"))
+    deliver = MaildirDelivery(mapping=load_mapping(str(mapping_file)))
+
+    with deliver("source@example.com", ["a@example.com", "unknown@example.com"]) as f:
+        f.write("test")
+
+    assert [m.read_text() for m in (tmp_path / "a" / "new").iterdir()] == ["test"]
+    with pytest.raises(Exception):
+        deliver("source@example.com", ["unknown@example.com"])
+
+
+def test_deliver_failure(tmp_path):
+    deliver = MaildirDelivery(template=str(tmp_path), fsync=False)
+    with pytest.raises(ValueError):
+        with deliver("source@example.com", ["a@example.com"]) as f:
+            f.write("partial")
+            raise ValueError()
+
+    assert list((tmp_path / "new").iterdir()) == []
+    assert list((tmp_path / "tmp").iterdir()) == []
+
+
+def test_deliver_batched_fsync(tmp_path):
+    deliver = MaildirDelivery(template=str(tmp_path / r"\1"), rex=re.compile(r"([a-z]+)@"), fsync_interval=0.05)
+
+    def send(i):
+        with deliver("source@example.com", ["u%s@example.com" % "abcd"[i % 4]]) as f:
+            f.write("message %d" % i)
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=10)
+
+    assert sum(len(list((tmp_path / ("u" + u) / "new").iterdir())) for u in "abcd") == 8
+
+
+@pytest.mark.parametrize("recipient", ["../../etc@example.com", "a/b@example.com", "@example.com", ".a@example.com"])
+def test_deliver_unsafe_recipient(tmp_path, recipient):
+    deliver = MaildirDelivery(template=str(tmp_path / "mail" / r"\g<user>"), rex=re.compile(r"(?P<user>.*)@"))
+    assert deliver.maildir(recipient) is None
+    with pytest.raises(Exception):
+        deliver("source@example.com", [recipient])
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_deliver_batched_fsync_in_progress(tmp_path, monkeypatch):
+    from sns_email import maildir
+
+    synced = []
+    first_started = threading.Event()
+    release_first = threading.Event()
+
+    def fsync_directory(path):
+        if not synced:
+            first_started.set()
+            release_first.wait(10)
+        synced.append(path)
+
+    monkeypatch.setattr(maildir, "_fsync_directory", fsync_directory)
+    deliver = MaildirDelivery(template=str(tmp_path / r"\1"), rex=re.compile(r"([a-z]+)@"), fsync_interval=0.01)
+
+    synced_on_return = {}
+
+    def send(user):
+        with deliver("source@example.com", ["%s@example.com" % user]) as f:
+            f.write("message")
+        synced_on_return[user] = list(synced)
+
+    first = threading.Thread(target=send, args=("a",))
+    first.start()
+    assert first_started.wait(10)
+    second = threading.Thread(target=send, args=("b",))
+    second.start()
+    second.join(timeout=0.2)
+    release_first.set()
+    first.join(timeout=10)
+    second.join(timeout=10)
+
+    assert str(tmp_path / "a" / "new") in synced_on_return["a"]
+    assert str(tmp_path / "b" / "new") in synced_on_return["b"]
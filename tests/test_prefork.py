@@ -0,0 +1,60 @@
+import os
+import sys
+import threading
+import time
+
+import prometheus_client
+
+from sns_email.prefork import Supervisor, MULTIPROC_DIR
+
+
+def test_supervisor_restarts(tmp_path):
+    def target(index):
+        (tmp_path / ("%d-%d" % (index, os.getpid()))).touch()
+        if index == 0 and not (tmp_path / "crashed").exists():
+            (tmp_path / "crashed").touch()
+            os._exit(1)
+        time.sleep(30)
+
+    supervisor = Supervisor(target, processes=2, restart_delay=0, stop_timeout=10)
+
+    def stop():
+        for _ in range(1000):
+            if len([p for p in tmp_path.iterdir() if p.name != "crashed"]) >= 3:
+                break
+            time.sleep(0.01)
+        supervisor.stop()
+
+    thread = threading.Thread(target=stop)
+    thread.start()
+    started = time.monotonic()
+    supervisor.run()
+    thread.join()
+
+    assert time.monotonic() - started < 10
+    started = sorted(p.name.split("-")[0] for p in tmp_path.iterdir() if p.name != "crashed")
+    assert started == ["0", "0", "1"]
+    assert not supervisor._children
+
+
+def test_supervisor_clean_exit(tmp_path, monkeypatch):
+    def restarts(reason):
+        return prometheus_client.REGISTRY.get_sample_value('sns_email_worker_restarts_total', {'reason': reason}) or 0
+
+    def target(index):
+        if not (tmp_path / "exited").exists():
+            (tmp_path / "exited").touch()
+            sys.exit()
+        time.sleep(30)
+
+    multiproc_dir = tmp_path / "metrics"
+    multiproc_dir.mkdir()
+    monkeypatch.setenv(MULTIPROC_DIR, str(multiproc_dir))
+    exited, failed = restarts('exited'), restarts('failed')
+    supervisor = Supervisor(target, processes=1, restart_delay=0, stop_timeout=10, remove_multiproc_dir=True)
+    threading.Timer(0.5, supervisor.stop).start()
+    supervisor.run()
+
+    assert restarts('exited') == exited + 1
+    assert restarts('failed') == failed
+    assert not multiproc_dir.exists()
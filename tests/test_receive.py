@@ -1,5 +1,8 @@
 import json
 
+import pytest
+
+from sns_email.counter import count
 from sns_email.receive import MessageReceiver
 
 
@@ -15,3 +18,58 @@ def test_mail_receive(mock_deliver, test_data_dir):
     assert mock_deliver.delivered
     with open(test_data_dir / "email", "rb") as f:
         assert mock_deliver.delivered[0] == f.read().decode("utf-8")
+
+
+def test_mail_receive_in_progress(mock_deliver, test_data_dir):
+    receiver = MessageReceiver(deliver=mock_deliver, boto_session=mock_boto_session)
+    with open(test_data_dir / "sns-notification", "rb") as f:
+        body = json.load(f)
+    message_id = json.loads(body['Message'])['mail']['messageId']
+
+    delivered = len(mock_deliver.delivered)
+    with count(message_id):
+        with pytest.raises(Exception, match="in progress"):
+            receiver.receive(body)
+    assert len(mock_deliver.delivered) == delivered
+
+
+def test_mail_receive_s3(mock_deliver, test_data_dir):
+    class fake_download:
+        def write_to(self, f):
+            f.write("stored in s3")
+
+        def cancel(self):
+            pass
+
+    class fake_fetcher:
+        def fetch(self, bucket, key):
+            self.fetched = (bucket, key)
+            return fake_download()
+
+    fetcher = fake_fetcher()
+    receiver = MessageReceiver(deliver=mock_deliver, boto_session=mock_boto_session, s3_fetcher=fetcher)
+    with open(test_data_dir / "sns-notification", "rb") as f:
+        body = json.load(f)
+    message = json.loads(body['Message'])
+    del message['content']
+    message['mail']['messageId'] = "s3-" + message['mail']['messageId']
+    message['receipt']['action'] = {'type': "S3", 'bucketName': "mail", 'objectKey': "message"}
+    body['Message'] = json.dumps(message)
+
+    receiver.receive(body)
+    assert fetcher.fetched == ("mail", "message")
+    assert mock_deliver.delivered[-1] == "stored in s3"
+
+
+def test_receiver_own_s3_fetcher():
+    receiver = MessageReceiver(boto_session=mock_boto_session)
+    assert receiver._own_s3_fetcher is None
+
+    fetcher = receiver.s3_fetcher
+    assert receiver.s3_fetcher is fetcher
+    receiver.close()
+    assert fetcher._executor._shutdown
+    assert receiver._own_s3_fetcher is None
+
+    with MessageReceiver(s3_fetcher=fetcher) as receiver:
+        assert receiver.s3_fetcher is fetcher
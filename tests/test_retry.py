@@ -0,0 +1,92 @@
+import errno
+import json
+import os
+
+from sns_email.counter import DuplicateInProgressException
+from sns_email.retry import RetryQueue
+
+
+def entries(path):
+    return [p for p in path.iterdir() if p.is_file()]
+
+
+def test_retry_delivers_directly(tmp_path, recording_receiver):
+    receiver = recording_receiver()
+    with RetryQueue(receiver, str(tmp_path)) as queue:
+        queue.receive({'n': 0})
+    assert receiver.received == [0]
+    assert entries(tmp_path) == []
+
+
+def test_retry_after_failure(tmp_path, recording_receiver):
+    receiver = recording_receiver(fail=2)
+    with RetryQueue(receiver, str(tmp_path), backoff_min=0.01, backoff_max=0.02) as queue:
+        queue.receive({'n': 0})
+        assert receiver.done.wait(timeout=10)
+    assert receiver.received == [0]
+    assert entries(tmp_path) == []
+
+
+def test_retry_dead_letter(tmp_path, recording_receiver):
+    receiver = recording_receiver(fail=3)
+    with RetryQueue(receiver, str(tmp_path), max_attempts=3, backoff_min=0.01, backoff_max=0.02) as queue:
+        queue.receive({'n': 0})
+        for _ in range(1000):
+            if not receiver.fail:
+                break
+            receiver.done.wait(timeout=0.01)
+    dead = entries(tmp_path / "dead-letter")
+    assert len(dead) == 1
+    entry = json.loads(dead[0].read_text())
+    assert entry['attempts'] == 3
+    assert entry['body'] == {'n': 0}
+    assert entries(tmp_path) == []
+    assert receiver.received == []
+
+
+def test_retry_loaded_at_startup(tmp_path, recording_receiver):
+    queue = RetryQueue(recording_receiver(fail=1), str(tmp_path), backoff_min=0.01, backoff_max=0.02)
+    queue.receive({'n': 0})
+    assert len(entries(tmp_path)) == 1
+
+    receiver = recording_receiver()
+    with RetryQueue(receiver, str(tmp_path)):
+        assert receiver.done.wait(timeout=10)
+    assert receiver.received == [0]
+    assert entries(tmp_path) == []
+
+
+def test_retry_dead_letter_other_filesystem(tmp_path, monkeypatch, recording_receiver):
+    replace = os.replace
+
+    def same_filesystem_replace(src, dst):
+        if os.path.dirname(src) != os.path.dirname(dst):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", same_filesystem_replace)
+    monkeypatch.setattr(os, "rename", same_filesystem_replace)
+    receiver = recording_receiver(fail=2)
+    queue = RetryQueue(receiver, str(tmp_path / "retry"), dead_letter_dir=str(tmp_path / "dead"), max_attempts=2)
+    queue.receive({'n': 0})
+    queue._retry(entries(tmp_path / "retry")[0].name)
+
+    assert [json.loads(p.read_text())['attempts'] for p in entries(tmp_path / "dead")] == [2]
+    assert entries(tmp_path / "retry") == []
+
+
+def test_retry_duplicate_in_progress(tmp_path, recording_receiver):
+    receiver = recording_receiver(fail=1)
+    queue = RetryQueue(receiver, str(tmp_path), max_attempts=2)
+    queue.receive({'n': 0})
+    name = entries(tmp_path)[0].name
+
+    receiver.fail, receiver.exception = 3, DuplicateInProgressException
+    for _ in range(3):
+        queue._retry(name)
+    assert json.loads((tmp_path / name).read_text())['attempts'] == 1
+    assert entries(tmp_path / "dead-letter") == []
+
+    queue._retry(name)
+    assert receiver.received == [0]
+    assert entries(tmp_path) == []
@@ -0,0 +1,105 @@
+import io
+import os
+import time
+
+import boto3
+import pytest
+
+from sns_email.s3 import S3Fetcher
+
+moto = pytest.importorskip("moto")
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name="eu-west-1")
+        client.create_bucket(Bucket="mail", CreateBucketConfiguration={'LocationConstraint': "eu-west-1"})
+        yield client
+
+
+@pytest.mark.parametrize("size", [0, 1, 999, 1000, 1001, 10000])
+def test_fetch(s3, size):
+    content = os.urandom(size)
+    s3.put_object(Bucket="mail", Key="message", Body=content)
+
+    with S3Fetcher(part_size=1000, window=3, workers=2) as fetcher:
+        f = io.BytesIO()
+        assert fetcher.fetch("mail", "message").write_to(f) == size
+    assert f.getvalue() == content
+
+
+def test_fetch_window(s3):
+    s3.put_object(Bucket="mail", Key="message", Body=b"x" * 10000)
+
+    with S3Fetcher(part_size=1000, window=3, boto_session=boto3.session.Session) as fetcher:
+        download = fetcher.fetch("mail", "message")
+
+        class window_writer(io.BytesIO):
+            def write(self, b):
+                assert download._in_flight <= 3
+                return super().write(b)
+
+        assert download.write_to(window_writer()) == 10000
+
+
+def test_fetch_read_ahead(s3):
+    content = os.urandom(10000)
+    s3.put_object(Bucket="mail", Key="message", Body=content)
+
+    with S3Fetcher(part_size=1000, window=2, message_memory=3000) as fetcher:
+        download = fetcher.fetch("mail", "message")
+        # fetched before writing, past the memory of the download
+        for _ in range(1000):
+            with download._lock:
+                if len(download._parts) == 10 and all(part.done() for part in download._parts):
+                    break
+            time.sleep(0.01)
+        parts = [part.result() for part in download._parts]
+        assert sorted(part.memory for part in parts) == [0] * 7 + [1000] * 3
+        assert fetcher._memory.used == 3000
+
+        f = io.BytesIO()
+        assert download.write_to(f) == 10000
+        assert f.getvalue() == content
+        assert fetcher._memory.used == 0
+
+
+def test_fetch_missing(s3):
+    with S3Fetcher(boto_session=boto3.session.Session) as fetcher:
+        download = fetcher.fetch("mail", "missing")
+        with pytest.raises(Exception):
+            download.write_to(io.BytesIO())
+        download.cancel()
+
+
+@pytest.mark.parametrize("message_memory, max_memory", [(1000, 0), (10000, 500), (10000, 0)])
+def test_fetch_memory(s3, message_memory, max_memory):
+    content = os.urandom(10000)
+    s3.put_object(Bucket="mail", Key="message", Body=content)
+
+    with S3Fetcher(part_size=1000, window=4, message_memory=message_memory, max_memory=max_memory) as fetcher:
+        f = io.BytesIO()
+        assert fetcher.fetch("mail", "message").write_to(f) == 10000
+        assert f.getvalue() == content
+        assert fetcher._memory.used == 0
+
+
+def test_fetch_cancel(s3):
+    s3.put_object(Bucket="mail", Key="message", Body=b"x" * 10000)
+
+    with S3Fetcher(part_size=1000, window=4) as fetcher:
+        download = fetcher.fetch("mail", "message")
+        parts = list(download._parts)
+        download.cancel()
+        for part in parts:
+            if not part.cancelled():
+                part.result()
+        for _ in range(100):
+            if fetcher._memory.used == 0:
+                break
+            time.sleep(0.01)
+        assert fetcher._memory.used == 0
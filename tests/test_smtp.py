@@ -0,0 +1,166 @@
+import json
+import smtplib
+
+import pytest
+
+from fake_smtp import FakeSmtpServer
+from sns_email.receive import MessageReceiver
+from sns_email.smtp import SmtpPool, SendmailPool
+
+
+def mock_boto_session():
+    return ""
+
+
+def test_smtp_deliver(smtp_server):
+    pool = SmtpPool(*smtp_server.server_address, size=2)
+    try:
+        with pool("a@example.com", ["b@example.com", "c@example.com"]) as f:
+            f.write("Subject: test\n\n.hidden\nbody\n")
+        with pool("d@example.com", ["e@example.com"]) as f:
+            f.write(b"Subject: second\r\n\r\nbody")
+    finally:
+        pool.close()
+
+    assert smtp_server.messages == [
+        ("a@example.com", ["b@example.com", "c@example.com"], b"Subject: test\r\n\r\n.hidden\r\nbody\r\n"),
+        ("d@example.com", ["e@example.com"], b"Subject: second\r\n\r\nbody\r\n"),
+    ]
+    assert smtp_server.sessions == 1
+
+
+def test_smtp_deliver_aborted(smtp_server):
+    pool = SmtpPool(*smtp_server.server_address)
+    with pytest.raises(ValueError):
+        with pool("a@example.com", ["b@example.com"]) as f:
+            f.write("Subject: test\n\n")
+            raise ValueError()
+    assert smtp_server.messages == []
+
+
+def test_smtp_reconnect(smtp_server):
+    pool = SmtpPool(*smtp_server.server_address)
+    with pool("a@example.com", ["b@example.com"]) as f:
+        f.write("first")
+
+    smtp_server.disconnect_all()
+    with pool("a@example.com", ["b@example.com"]) as f:
+        f.write("second")
+
+    assert [m[2] for m in smtp_server.messages] == [b"first\r\n", b"second\r\n"]
+    assert smtp_server.sessions == 2
+
+
+def test_smtp_connection_refused(smtp_server):
+    pool = SmtpPool("127.0.0.1", 1, timeout=1)
+    with pytest.raises(OSError):
+        with pool("a@example.com", ["b@example.com"]) as f:
+            f.write("first")
+    # the slot of the failed connection is released
+    with pytest.raises(OSError):
+        with pool("a@example.com", ["b@example.com"]) as f:
+            f.write("second")
+
+
+def test_lmtp_deliver(lmtp_server):
+    pool = SmtpPool(*lmtp_server.server_address, lmtp=True)
+    with pool("a@example.com", ["b@example.com", "unknown@example.com", "c@example.com"]) as f:
+        f.write("body")
+    with pool("a@example.com", ["d@example.com"]) as f:
+        f.write("other")
+
+    assert lmtp_server.messages == [
+        ("a@example.com", ["b@example.com", "c@example.com"], b"body\r\n"),
+        ("a@example.com", ["d@example.com"], b"other\r\n"),
+    ]
+    assert lmtp_server.sessions == 1
+
+
+def test_lmtp_recipients_refused(lmtp_server):
+    pool = SmtpPool(*lmtp_server.server_address, lmtp=True)
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        with pool("a@example.com", ["unknown@example.com"]) as f:
+            f.write("body")
+    with pool("a@example.com", ["b@example.com"]) as f:
+        f.write("body")
+    assert len(lmtp_server.messages) == 1
+    assert lmtp_server.sessions == 1
+
+
+def test_mail_receive(smtp_server, test_data_dir):
+    receiver = MessageReceiver(deliver=SmtpPool(*smtp_server.server_address), boto_session=mock_boto_session)
+    with open(test_data_dir / "sns-notification", "rb") as f:
+        receiver.receive(json.load(f))
+
+    assert len(smtp_server.messages) == 1
+    with open(test_data_dir / "email", "rb") as f:
+        assert smtp_server.messages[0][2] == f.read()
+
+
+def sent_messages(out_path):
+    messages = []
+    for path in sorted(out_path.iterdir(), key=lambda p: p.stat().st_mtime_ns):
+        with open(path) as f:
+            messages.append((path.name.split("-")[0], json.load(f)))
+    return messages
+
+
+def test_sendmail_session_deliver(mock_sendmail_bs):
+    pool = SendmailPool(str(mock_sendmail_bs), size=1, max_messages=2)
+    try:
+        for i in range(3):
+            with pool("a@example.com", ["b@example.com"]) as f:
+                f.write("message %d\n" % i)
+    finally:
+        pool.close()
+
+    messages = sent_messages(mock_sendmail_bs.parent / "out")
+    assert [m[1]["data"] for m in messages] == ["message 0\r\n", "message 1\r\n", "message 2\r\n"]
+    assert messages[0][1]["recipients"] == ["b@example.com"]
+    # the session is recycled after 2 messages
+    assert messages[0][0] == messages[1][0] != messages[2][0]
+
+
+def test_sendmail_session_recycled_on_error(mock_sendmail_bs):
+    pool = SendmailPool(str(mock_sendmail_bs), size=1)
+    try:
+        with pool("a@example.com", ["b@example.com"]) as f:
+            f.write("message 0\n")
+        with pytest.raises(smtplib.SMTPRecipientsRefused):
+            with pool("a@example.com", []) as f:
+                f.write("message 1\n")
+        with pool("a@example.com", ["b@example.com"]) as f:
+            f.write("message 2\n")
+    finally:
+        pool.close()
+
+    messages = sent_messages(mock_sendmail_bs.parent / "out")
+    assert [m[1]["data"] for m in messages] == ["message 0\r\n", "message 2\r\n"]
+    assert messages[0][0] != messages[1][0]
+
+
+def test_sendmail_session_failed_process():
+    pool = SendmailPool("/bin/false", timeout=1)
+    with pytest.raises(smtplib.SMTPServerDisconnected):
+        with pool("a@example.com", ["b@example.com"]) as f:
+            f.write("message\n")
+
+
+def test_smtp_recipient_deferred():
+    with FakeSmtpServer(defer=("c@example.com",)) as server:
+        pool = SmtpPool(*server.server_address)
+        with pytest.raises(smtplib.SMTPRecipientsRefused) as e:
+            with pool("a@example.com", ["b@example.com", "c@example.com"]) as f:
+                f.write("body")
+        assert list(e.value.recipients) == ["c@example.com"]
+        assert e.value.recipients["c@example.com"][0] == 451
+
+        with pool("a@example.com", ["b@example.com"]) as f:
+            f.write("other")
+        pool.close()
+
+    assert server.messages == [
+        ("a@example.com", ["b@example.com"], b"body\r\n"),
+        ("a@example.com", ["b@example.com"], b"other\r\n"),
+    ]
+    assert server.sessions == 1
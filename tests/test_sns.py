@@ -1,4 +1,8 @@
+import http.client
+import socket
 import threading
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
 from unittest import mock
 
 import prometheus_client
@@ -7,6 +11,7 @@ import pytest
 import requests
 
 import sns_email
+from sns_email.counter import DuplicateInProgressException
 from sns_email.receive import MessageReceiver
 from sns_email.sns import SnsServer
 
@@ -14,9 +19,9 @@ _logger = sns_email.logger.getChild("test")
 
 
 class test_server:
-    def __init__(self, receiver, address):
+    def __init__(self, receiver, address, **kwargs):
         self._receiver = receiver
-        self._server = SnsServer(self, address)
+        self._server = SnsServer(self, address, **kwargs)
 
     def receive(self, body):
         try:
@@ -118,3 +123,145 @@ def test_request_and_deliver_failure(mock_delivering_test_server, mock_deliver,
     with open(test_data_dir / "sns-notification", "rb") as f:
         with requests.post(mock_delivering_test_server.server_url, data=f) as response:
             assert not response.ok, "status=%d, text=%s" % (response.status_code, response.text)
+
+
+def test_request_failure_calls_on_error(test_data_dir):
+    def failing_receive(body):
+        raise ValueError()
+
+    with open(test_data_dir / "sns-notification", "rb") as f:
+        data = f.read()
+
+    with test_server(failing_receive, ("127.0.0.1", 0)) as server:
+        server.on_error = mock.Mock()
+        with requests.post("http://%s:%d/" % server.server_address, data=data) as response:
+            assert response.status_code == 500, "status=%d, text=%s" % (response.status_code, response.text)
+        server.on_error.assert_called_once_with()
+
+
+def test_request_duplicate_in_progress(test_data_dir):
+    def in_progress_receive(body):
+        raise DuplicateInProgressException()
+
+    with open(test_data_dir / "sns-notification", "rb") as f:
+        data = f.read()
+
+    with test_server(in_progress_receive, ("127.0.0.1", 0)) as server:
+        with requests.post("http://%s:%d/" % server.server_address, data=data) as response:
+            assert response.status_code == 503, "status=%d, text=%s" % (response.status_code, response.text)
+            assert response.headers["Retry-After"] == "1"
+
+
+def test_concurrent_request_rejected_when_queue_full(test_data_dir):
+    entered = threading.Event()
+    release = threading.Event()
+
+    def blocking_receive(body):
+        entered.set()
+        release.wait(timeout=10)
+
+    with open(test_data_dir / "sns-notification", "rb") as f:
+        data = f.read()
+
+    with test_server(blocking_receive, ("127.0.0.1", 0), workers=1, queue_size=1) as server:
+        server_url = "http://%s:%d/" % server.server_address
+        assert server.load() == (0, 2)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            first = executor.submit(requests.post, server_url, data=data)
+            assert entered.wait(timeout=10)
+            second = executor.submit(requests.post, server_url, data=data)
+            for i in range(100):
+                if server.load()[0] == 2:
+                    break
+                time.sleep(0.05)
+
+            with requests.post(server_url, data=data) as response:
+                assert response.status_code == 503, "status=%d, text=%s" % (response.status_code, response.text)
+            assert server.load() == (2, 2)
+
+            release.set()
+            assert first.result().ok
+            assert second.result().ok
+
+
+def test_concurrent_request_rejected_without_queue(test_data_dir):
+    entered = threading.Event()
+    release = threading.Event()
+
+    def blocking_receive(body):
+        entered.set()
+        release.wait(timeout=10)
+
+    with open(test_data_dir / "sns-notification", "rb") as f:
+        data = f.read()
+
+    with test_server(blocking_receive, ("127.0.0.1", 0), workers=1, queue_size=0) as server:
+        server_url = "http://%s:%d/" % server.server_address
+        assert server.load() == (0, 1)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            first = executor.submit(requests.post, server_url, data=data)
+            assert entered.wait(timeout=10)
+            with requests.post(server_url, data=data) as response:
+                assert response.status_code == 503, "status=%d, text=%s" % (response.status_code, response.text)
+            assert server.load() == (1, 1)
+
+            release.set()
+            assert first.result().ok
+
+
+def test_concurrent_metrics():
+    with test_server(lambda body: None, ("127.0.0.1", 0), workers=2, queue_size=2) as server:
+        with requests.get("http://%s:%d/" % server.server_address) as response:
+            assert response.ok, "status=%d, text=%s" % (response.status_code, response.text)
+            assert "sns_email_sns_queued_requests" in response.text
+
+
+def test_keep_alive(test_data_dir):
+    with open(test_data_dir / "sns-notification", "rb") as f:
+        data = f.read()
+
+    with test_server(lambda body: None, ("127.0.0.1", 0), workers=1, max_requests=3) as server:
+        connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+        try:
+            connection.request("POST", "/", body=data)
+            response = connection.getresponse()
+            response.read()
+            assert response.status == 200
+            assert response.getheader("Connection") is None
+            sock = connection.sock
+
+            connection.request("GET", "/")
+            response = connection.getresponse()
+            assert "sns_email_sns_handle_seconds" in response.read().decode()
+            assert connection.sock is sock
+
+            connection.request("POST", "/", body=b"{}")
+            response = connection.getresponse()
+            response.read()
+            assert response.status == 200
+            assert response.getheader("Connection") == "close"
+            assert connection.sock is None
+        finally:
+            connection.close()
+
+
+def test_keep_alive_disabled_without_workers():
+    with test_server(lambda body: None, ("127.0.0.1", 0)) as server:
+        with requests.post("http://%s:%d/" % server.server_address, json={}) as response:
+            assert response.ok, "status=%d, text=%s" % (response.status_code, response.text)
+            assert response.headers["Connection"] == "close"
+
+
+def test_keep_alive_idle_timeout():
+    with test_server(lambda body: None, ("127.0.0.1", 0), workers=1, idle_timeout=0.2) as server:
+        with socket.create_connection(server.server_address, timeout=10) as s:
+            s.sendall(b"POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: 2\r\n\r\n{}")
+            assert s.recv(1024).startswith(b"HTTP/1.1 200 ")
+            assert s.recv(1024) == b""
+
+
+def test_request_without_content_length():
+    with test_server(lambda body: None, ("127.0.0.1", 0), workers=1) as server:
+        with socket.create_connection(server.server_address, timeout=10) as s:
+            s.sendall(b"POST / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            assert s.recv(1024).startswith(b"HTTP/1.1 411 ")
@@ -0,0 +1,168 @@
+import http.client
+import socket
+import threading
+from unittest import mock
+
+import prometheus_client.parser
+import pytest
+import requests
+
+from sns_email.receive import MessageReceiver
+from sns_email.sns_async import AsyncSnsServer
+
+
+class test_server:
+    def __init__(self, receiver, address, **kwargs):
+        self._server = AsyncSnsServer(receiver, address, **kwargs)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+        return self._server
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._thread.join(timeout=10)
+        self._server.server_close()
+
+
+class capturing_receiver:
+    def __init__(self):
+        self.received = []
+
+    def receive(self, body):
+        self.received.append(body)
+
+
+@pytest.fixture
+def capturing_test_server():
+    receiver = capturing_receiver()
+    with test_server(receiver, ("127.0.0.1", 0)) as t:
+        t.server_url = "http://%s:%d/" % t.server_address
+        yield t
+
+
+def test_metrics(capturing_test_server):
+    with requests.get(capturing_test_server.server_url) as response:
+        response_text = response.text
+        assert response.ok, "status=%d, text=%s" % (response.status_code, response_text)
+
+    metric_names = set([
+        metric.name for metric in prometheus_client.parser.text_string_to_metric_families(response_text)
+        if metric.name.startswith("sns_")
+    ])
+
+    assert {'sns_email_errors', 'sns_email_receive_seconds', 'sns_email_received', 'sns_email_sns_received',
+            'sns_email_sns_handle_seconds'}.issubset(metric_names)
+
+
+def test_request(capturing_test_server, test_data_dir):
+    with open(test_data_dir / "sns-notification", "rb") as f:
+        with requests.post(capturing_test_server.server_url, data=f) as response:
+            assert response.ok, "status=%d, text=%s" % (response.status_code, response.text)
+
+    assert len(capturing_test_server.receiver.received) == 1
+
+
+def test_request_ignores_bad_signature(capturing_test_server):
+    with mock.patch("sns_email.sns._logger") as m:
+        with requests.post(capturing_test_server.server_url, json={}) as response:
+            assert response.ok, "status=%d, text=%s" % (response.status_code, response.text)
+        m.warning.assert_called_with("ignoring message with invalid signature. content=%s", b'{}', exc_info=True)
+
+    assert len(capturing_test_server.receiver.received) == 0
+
+
+def test_request_without_content_length(capturing_test_server):
+    with socket.create_connection(capturing_test_server.server_address, timeout=10) as s:
+        s.sendall(b"POST / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        assert s.recv(1024).startswith(b"HTTP/1.1 411 ")
+
+
+def test_request_and_deliver(mock_deliver, test_data_dir):
+    mock_deliver.failure = None
+    mock_deliver.delivered.clear()
+    with test_server(MessageReceiver(deliver=mock_deliver), ("127.0.0.1", 0)) as t:
+        server_url = "http://%s:%d/" % t.server_address
+        for i in range(3):
+            with open(test_data_dir / "sns-notification", "rb") as f:
+                with requests.post(server_url, data=f) as response:
+                    assert response.ok, "i=%d, status=%d, text=%s" % (i, response.status_code, response.text)
+
+    assert len(mock_deliver.delivered) == 1
+    with open(test_data_dir / "email", "rb") as f:
+        assert mock_deliver.delivered[0] == f.read().decode("utf-8")
+
+
+def test_request_and_deliver_failure(mock_deliver, test_data_dir):
+    mock_deliver.failure = ValueError()
+    try:
+        with test_server(MessageReceiver(deliver=mock_deliver), ("127.0.0.1", 0)) as t:
+            with open(test_data_dir / "sns-notification", "rb") as f:
+                with requests.post("http://%s:%d/" % t.server_address, data=f) as response:
+                    assert response.status_code == 500, "status=%d, text=%s" % (response.status_code, response.text)
+    finally:
+        mock_deliver.failure = None
+
+
+def test_request_rejected_when_busy(test_data_dir):
+    entered = threading.Event()
+    release = threading.Event()
+
+    class blocking_receiver:
+        def receive(self, body):
+            entered.set()
+            release.wait(timeout=10)
+
+    with open(test_data_dir / "sns-notification", "rb") as f:
+        data = f.read()
+
+    with test_server(blocking_receiver(), ("127.0.0.1", 0), workers=1, queue_size=0) as t:
+        server_url = "http://%s:%d/" % t.server_address
+        first = threading.Thread(target=requests.post, args=(server_url,), kwargs={"data": data})
+        first.start()
+        try:
+            assert entered.wait(timeout=10)
+            with requests.post(server_url, data=data) as response:
+                assert response.status_code == 503, "status=%d, text=%s" % (response.status_code, response.text)
+        finally:
+            release.set()
+            first.join(timeout=10)
+
+
+def test_one_worker_by_default():
+    with test_server(capturing_receiver(), ("127.0.0.1", 0), queue_size=0) as t:
+        assert t._executor._max_workers == 1
+        assert t.load() == (0, 1)
+
+
+def test_keep_alive(test_data_dir):
+    with open(test_data_dir / "sns-notification", "rb") as f:
+        data = f.read()
+
+    with test_server(capturing_receiver(), ("127.0.0.1", 0), max_requests=2) as t:
+        connection = http.client.HTTPConnection(*t.server_address, timeout=10)
+        try:
+            connection.request("POST", "/", body=data)
+            response = connection.getresponse()
+            response.read()
+            assert response.status == 200
+            assert response.getheader("Connection") == "keep-alive"
+            sock = connection.sock
+
+            connection.request("POST", "/", body=data)
+            response = connection.getresponse()
+            response.read()
+            assert response.status == 200
+            assert response.getheader("Connection") == "close"
+            assert sock is not None and connection.sock is None
+        finally:
+            connection.close()
+
+
+def test_keep_alive_idle_timeout():
+    with test_server(capturing_receiver(), ("127.0.0.1", 0), idle_timeout=0.2) as t:
+        with socket.create_connection(t.server_address, timeout=10) as s:
+            s.sendall(b"POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: 2\r\n\r\n{}")
+            assert s.recv(1024).startswith(b"HTTP/1.1 200 ")
+            assert s.recv(1024) == b""
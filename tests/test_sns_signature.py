@@ -1,8 +1,16 @@
 import json
-
+import os
+import signal
+import threading
+from concurrent.futures import TimeoutError
+from concurrent.futures.thread import ThreadPoolExecutor
+from unittest import mock
+
+import prometheus_client
 import pytest
 
-from sns_email.sns_signature import sns_verify_signature, InvalidSnsSignatureException
+from sns_email.sns_signature import sns_verify_signature, InvalidSnsSignatureException, CertificateCache, \
+    VerifiedCache, ProcessPoolVerifier
 
 
 @pytest.fixture(scope="session")
@@ -62,3 +70,142 @@ def test_sns_verify_signature_untrusted_signing_url(valid_body):
     body["SigningCertURL"] = "http://example.com/badcaffe"
     with pytest.raises(InvalidSnsSignatureException, match=r"Invalid signing cert url.*"):
         sns_verify_signature(body)
+
+
+def test_certificate_cache_persisted(tmp_path, valid_body):
+    url = valid_body["SigningCertURL"]
+    cache = CertificateCache(cache_dir=str(tmp_path))
+    certificate = cache.get(url)
+    assert (tmp_path / "example.com_signing-key.pem").exists()
+
+    offline = CertificateCache(cache_dir=str(tmp_path), offline=True)
+    assert offline.get(url) == certificate
+    with pytest.raises(InvalidSnsSignatureException, match="not available offline"):
+        offline.get("https://example.com/other.pem")
+
+
+def test_certificate_cache_single_fetch(valid_body):
+    cache = CertificateCache()
+    fetch = cache._fetch
+    with mock.patch.object(cache, "_fetch", side_effect=fetch) as m:
+        threads = [threading.Thread(target=cache.get, args=(valid_body["SigningCertURL"],)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=10)
+    m.assert_called_once()
+    assert cache._url_locks == {}
+
+
+def test_certificate_cache_unknown_urls(valid_body):
+    cache = CertificateCache()
+    with mock.patch.object(cache, "_fetch", side_effect=Exception("not found")):
+        for i in range(10):
+            with pytest.raises(Exception, match="not found"):
+                cache.get("https://sns.eu-west-1.amazonaws.com/made-up-%d.pem" % i)
+    assert cache._url_locks == {}
+    assert cache._certificates == {}
+
+
+def test_certificate_cache_expired(tmp_path, valid_body):
+    cache = CertificateCache(cache_dir=str(tmp_path))
+    cache.get(valid_body["SigningCertURL"])
+    with mock.patch.object(CertificateCache, "valid", return_value=False):
+        with pytest.raises(InvalidSnsSignatureException, match="not valid"):
+            cache.get(valid_body["SigningCertURL"])
+
+
+def test_certificate_cache_offline_expired(tmp_path, valid_body):
+    CertificateCache(cache_dir=str(tmp_path)).get(valid_body["SigningCertURL"])
+    offline = CertificateCache(cache_dir=str(tmp_path), offline=True)
+    with mock.patch.object(CertificateCache, "valid", return_value=False), \
+            mock.patch.object(offline, "_fetch") as fetch:
+        with pytest.raises(InvalidSnsSignatureException, match="Certificate not valid"):
+            offline.get(valid_body["SigningCertURL"])
+    fetch.assert_not_called()
+
+
+def test_sns_verify_signature_cached(valid_body):
+    with mock.patch("sns_email.sns_signature._verified", new=VerifiedCache(size=1)) as verified, \
+            mock.patch("sns_email.sns_signature._counter_verify_hits") as hits:
+        sns_verify_signature(valid_body)
+        assert len(verified._digests) == 1
+        sns_verify_signature(valid_body)
+        hits.inc.assert_called_once()
+
+        body = valid_body.copy()
+        body["Signature"] = "dGVzdAo="
+        with pytest.raises(InvalidSnsSignatureException, match="Invalid signature"):
+            sns_verify_signature(body)
+        assert len(verified._digests) == 1
+
+
+def test_process_pool_verifier(valid_body):
+    bad_body = valid_body.copy()
+    bad_body["Signature"] = "dGVzdAo="
+    verifier = ProcessPoolVerifier(2, batch_size=4)
+    misses = prometheus_client.REGISTRY.get_sample_value('sns_email_sns_verify_cache_misses_total')
+    verified = prometheus_client.REGISTRY.get_sample_value('sns_email_sns_verify_seconds_count')
+    try:
+        with mock.patch("sns_email.sns_signature._verifier", new=verifier):
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                futures = [executor.submit(sns_verify_signature, body) for body in [valid_body, bad_body] * 8]
+            for i, f in enumerate(futures):
+                if i % 2:
+                    assert isinstance(f.exception(), InvalidSnsSignatureException)
+                else:
+                    assert f.result() is None
+            # observed in this process, whichever worker verified the signatures
+            assert prometheus_client.REGISTRY.get_sample_value('sns_email_sns_verify_cache_misses_total') > misses
+            assert prometheus_client.REGISTRY.get_sample_value('sns_email_sns_verify_seconds_count') > verified
+
+            with pytest.raises(InvalidSnsSignatureException, match="Invalid signing cert url"):
+                sns_verify_signature(dict(valid_body, SigningCertURL="http://example.com/x"))
+    finally:
+        verifier.close()
+
+
+@pytest.mark.parametrize("verified_size, hits", [(0, 0), (16, 1)])
+def test_process_pool_verifier_cache_size(valid_body, verified_size, hits):
+    verifier = ProcessPoolVerifier(1, verified_size=verified_size)
+    before = prometheus_client.REGISTRY.get_sample_value('sns_email_sns_verify_cache_hits_total')
+    try:
+        verifier.verify(valid_body)
+        verifier.verify(valid_body)
+    finally:
+        verifier.close()
+    assert prometheus_client.REGISTRY.get_sample_value('sns_email_sns_verify_cache_hits_total') == before + hits
+
+
+def test_certificate_cache_pem(valid_body):
+    cache = CertificateCache()
+    pem = cache.pem(valid_body["SigningCertURL"])
+    assert pem.startswith(b"-----BEGIN CERTIFICATE-----")
+    # serialized once
+    assert cache.pem(valid_body["SigningCertURL"]) is pem
+    assert cache.pems()[valid_body["SigningCertURL"]] is pem
+
+
+def test_process_pool_verifier_broken(valid_body):
+    verifier = ProcessPoolVerifier(1)
+    try:
+        verifier.verify(valid_body)
+        executor = verifier._executor
+        for pid in list(executor._processes):
+            os.kill(pid, signal.SIGKILL)
+
+        verifier.verify(valid_body)
+        assert verifier._executor is not executor
+        verifier.verify(valid_body)
+    finally:
+        verifier.close()
+
+
+def test_process_pool_verifier_timeout(valid_body):
+    verifier = ProcessPoolVerifier(1, timeout=0.01)
+    try:
+        with mock.patch.object(verifier, "_submit"), pytest.raises(TimeoutError):
+            verifier.verify(valid_body)
+    finally:
+        verifier._slots.release()
+        verifier.close()
@@ -0,0 +1,108 @@
+import os
+import time
+
+import pytest
+
+from sns_email.counter import DuplicateInProgressException
+from sns_email.spool import Spool, SpoolFullException
+
+
+def test_spool_delivers_in_order(tmp_path, recording_receiver):
+    receiver = recording_receiver(expected=5)
+    with Spool(receiver, str(tmp_path), workers=1) as spool:
+        for i in range(5):
+            spool.receive({'n': i})
+        assert receiver.done.wait(timeout=10)
+
+    assert receiver.received == list(range(5))
+    assert list((tmp_path / "new").iterdir()) == []
+    assert list((tmp_path / "cur").iterdir()) == []
+
+
+def test_spool_full(tmp_path, recording_receiver):
+    spool = Spool(recording_receiver(), str(tmp_path), max_size=2)
+    spool.receive({'n': 0})
+    spool.receive({'n': 1})
+    with pytest.raises(SpoolFullException):
+        spool.receive({'n': 2})
+    assert len(list((tmp_path / "new").iterdir())) == 2
+
+
+def test_spool_recovers_after_crash(tmp_path, recording_receiver):
+    spool = Spool(recording_receiver(), str(tmp_path))
+    spool.receive({'n': 0})
+    spool.receive({'n': 1})
+    first = sorted((tmp_path / "new").iterdir())[0]
+    first.rename(tmp_path / "cur" / first.name)
+    (tmp_path / "tmp" / "partial").write_text("{")
+
+    receiver = recording_receiver(expected=2)
+    with Spool(receiver, str(tmp_path), workers=1):
+        assert receiver.done.wait(timeout=10)
+    assert receiver.received == [0, 1]
+    assert list((tmp_path / "tmp").iterdir()) == []
+
+
+def test_spool_retries_failure(tmp_path, recording_receiver):
+    receiver = recording_receiver(fail=1)
+    with Spool(receiver, str(tmp_path), workers=1, retry_interval=0.01) as spool:
+        spool.receive({'n': 0})
+        assert receiver.done.wait(timeout=10)
+    assert receiver.received == [0]
+
+
+def test_spool_retry_backoff(tmp_path, recording_receiver):
+    receiver = recording_receiver(fail=2)
+    with Spool(receiver, str(tmp_path), workers=2, retry_interval=0.1) as spool:
+        spool.receive({'n': 0})
+        assert receiver.done.wait(timeout=10)
+    attempts = receiver.attempts
+    assert len(attempts) == 3
+    # random delays between half and all of 0.1 then 0.2 seconds
+    assert attempts[1] - attempts[0] >= 0.05
+    assert attempts[2] - attempts[1] >= 0.1
+
+
+def test_spool_duplicate_in_progress(tmp_path, recording_receiver):
+    receiver = recording_receiver(fail=2, exception=DuplicateInProgressException)
+    with Spool(receiver, str(tmp_path), workers=1, retry_interval=0.01, max_attempts=1) as spool:
+        spool.receive({'n': 0})
+        assert receiver.done.wait(timeout=10)
+    assert receiver.received == [0]
+    assert list((tmp_path / "dead-letter").iterdir()) == []
+
+
+def test_spool_dead_letter(tmp_path, recording_receiver):
+    receiver = recording_receiver(fail_numbers=(0,))
+    with Spool(receiver, str(tmp_path), workers=1, retry_interval=0.01, max_attempts=3) as spool:
+        spool.receive({'n': 0})
+        spool.receive({'n': 1})
+        assert receiver.done.wait(timeout=10)
+        for _ in range(1000):
+            if list((tmp_path / "dead-letter").iterdir()):
+                break
+            time.sleep(0.01)
+
+    assert receiver.received == [1]
+    dead = list((tmp_path / "dead-letter").iterdir())
+    assert len(dead) == 1
+    assert Spool.attempts(dead[0].name) == 3
+    assert list((tmp_path / "new").iterdir()) == []
+    assert list((tmp_path / "cur").iterdir()) == []
+
+
+def test_spool_move_failure(tmp_path, monkeypatch, recording_receiver):
+    receiver = recording_receiver()
+    with Spool(receiver, str(tmp_path), workers=1, retry_interval=0.01) as spool:
+        rename = os.rename
+        failures = [PermissionError()]
+
+        def failing_rename(src, dst):
+            if failures and os.path.basename(os.path.dirname(src)) == "new":
+                raise failures.pop()
+            rename(src, dst)
+
+        monkeypatch.setattr(os, "rename", failing_rename)
+        spool.receive({'n': 0})
+        assert receiver.done.wait(timeout=10)
+    assert receiver.received == [0]
@@ -0,0 +1,110 @@
+import json
+import threading
+import time
+from unittest import mock
+
+import boto3
+import pytest
+
+from sns_email.sqs import SqsPoller
+
+moto = pytest.importorskip("moto")
+
+
+@pytest.fixture
+def sqs(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    with moto.mock_aws():
+        client = boto3.client('sqs', region_name="eu-west-1")
+        client.queue_url = client.create_queue(QueueName="test")['QueueUrl']
+        yield client
+
+
+def queued(sqs, attribute):
+    return int(sqs.get_queue_attributes(QueueUrl=sqs.queue_url, AttributeNames=[attribute])
+               ['Attributes'][attribute])
+
+
+def poller(receiver, sqs, **kwargs) -> SqsPoller:
+    p = SqsPoller(receiver, sqs.queue_url, "eu-west-1", backoff_min=0.01, backoff_max=0.1, **kwargs)
+    p.wait_time = 0
+    return p
+
+
+def test_poll_and_delete(sqs, recording_receiver):
+    for i in range(15):
+        sqs.send_message(QueueUrl=sqs.queue_url, MessageBody=json.dumps({'n': i}))
+    sqs.send_message(QueueUrl=sqs.queue_url, MessageBody="invalid")
+
+    receiver = recording_receiver(14, fail_numbers=(3,))
+    p = poller(receiver, sqs, workers=4, pollers=2)
+    with mock.patch.object(p, "_delete", wraps=p._delete) as delete:
+        with p:
+            assert receiver.done.wait(timeout=10)
+            for i in range(100):
+                if queued(sqs, 'ApproximateNumberOfMessagesNotVisible') == 1:
+                    break
+                time.sleep(0.1)
+    assert set(receiver.received) == set(range(15)) - {3}
+    assert any(len(call.args[1]) > 1 for call in delete.call_args_list)
+    assert queued(sqs, 'ApproximateNumberOfMessages') == 0
+    assert queued(sqs, 'ApproximateNumberOfMessagesNotVisible') == 1
+
+
+def test_extend_visibility(sqs):
+    sqs.send_message(QueueUrl=sqs.queue_url, MessageBody=json.dumps({'n': 0}))
+    release = threading.Event()
+
+    class slow_receiver:
+        def receive(self, body):
+            release.wait(timeout=10)
+
+    p = poller(slow_receiver(), sqs, visibility_timeout=1)
+    messages = sqs.receive_message(QueueUrl=sqs.queue_url, VisibilityTimeout=1)['Messages']
+    with mock.patch.object(p, "_extend_visibility", wraps=p._extend_visibility) as extend:
+        threading.Timer(1.2, release.set).start()
+        p._process_batch(sqs, messages)
+    assert extend.call_count >= 2
+    assert queued(sqs, 'ApproximateNumberOfMessages') == 0
+    assert queued(sqs, 'ApproximateNumberOfMessagesNotVisible') == 0
+
+
+def test_backoff(sqs):
+    p = SqsPoller(None, sqs.queue_url, "eu-west-1", backoff_min=10, backoff_max=600)
+    assert 5 <= p._backoff(1) <= 10
+    assert 20 <= p._backoff(3) <= 40
+    assert 300 <= p._backoff(100) <= 600
+
+
+def test_trigger_and_close(sqs, recording_receiver):
+    p = SqsPoller(recording_receiver(), sqs.queue_url, "eu-west-1", backoff_min=60, backoff_max=60)
+    p.wait_time = 0
+    with mock.patch.object(p, "_backoff", wraps=p._backoff) as backoff:
+        thread = threading.Thread(target=p.run)
+        thread.start()
+        for i in range(100):
+            if backoff.call_count:
+                break
+            time.sleep(0.05)
+        sqs.send_message(QueueUrl=sqs.queue_url, MessageBody=json.dumps({'n': 0}))
+        p.trigger()
+        assert p.receiver.done.wait(timeout=10)
+
+        p.close()
+        thread.join(timeout=1)
+        assert not thread.is_alive()
+
+
+def test_trigger_before_sleep(sqs, recording_receiver):
+    p = SqsPoller(recording_receiver(), sqs.queue_url, "eu-west-1")
+    # triggered while polling, the next wait is skipped
+    p.trigger()
+    start = time.monotonic()
+    p._sleep(60)
+    assert time.monotonic() - start < 5
+
+    start = time.monotonic()
+    p._sleep(0.05)
+    assert time.monotonic() - start >= 0.05
@@ -0,0 +1,72 @@
+import json
+import logging
+
+import prometheus_client
+import pytest
+
+from sns_email import stages
+from sns_email.receive import MessageReceiver
+
+
+@pytest.fixture
+def tracing():
+    stages.configure(trace=True)
+    yield
+    stages.configure()
+
+
+def sample(name):
+    return prometheus_client.REGISTRY.get_sample_value('sns_email_stage_seconds_count', {'stage': name}) or 0
+
+
+def test_stage():
+    before = sample("test")
+    with stages.stage("test"):
+        pass
+    assert sample("test") == before + 1
+
+
+def test_trace_disabled(caplog):
+    with caplog.at_level(logging.INFO, logger="sns-email.trace"):
+        with stages.trace(source="test"):
+            with stages.stage("test"):
+                pass
+    assert not caplog.records
+
+
+def test_trace(tracing, caplog):
+    with caplog.at_level(logging.INFO, logger="sns-email.trace"):
+        with stages.trace(source="test"):
+            with stages.trace(source="nested"):
+                stages.annotate(message_id="a")
+                with stages.stage("first"):
+                    pass
+            with stages.stage("second"):
+                pass
+    assert len(caplog.records) == 1
+    message = caplog.records[0].getMessage()
+    assert message.startswith("trace. source=test, message_id=a, total=")
+    assert ", first=" in message
+    assert ", second=" in message
+
+
+def test_trace_error(tracing, caplog):
+    with caplog.at_level(logging.INFO, logger="sns-email.trace"):
+        with pytest.raises(ValueError):
+            with stages.trace():
+                raise ValueError()
+    assert caplog.records[0].getMessage().endswith(", error=ValueError")
+
+
+def test_trace_receive(tracing, caplog, mock_deliver, test_data_dir):
+    receiver = MessageReceiver(deliver=mock_deliver)
+    with open(test_data_dir / "sns-notification", "rb") as f:
+        body = json.load(f)
+    message_id = json.loads(body['Message'])['mail']['messageId']
+
+    with caplog.at_level(logging.INFO, logger="sns-email.trace"):
+        receiver.receive(body)
+    message = caplog.records[-1].getMessage()
+    assert message.startswith("trace. message_id=%s, total=" % message_id)
+    for name in ("parse_message", "dedup", "deliver"):
+        assert ", %s=" % name in message
@@ -0,0 +1,101 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from sns_email.status import StatusServer
+
+
+@pytest.fixture
+def load():
+    value = [0, 4]
+    yield value
+
+
+@pytest.fixture
+def status_url(load):
+    with StatusServer(("localhost", 0), load=lambda: tuple(load), saturation=0.75) as server:
+        yield "http://localhost:%d" % server.server_address[1]
+
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def test_metrics(status_url):
+    status, content = get(status_url + "/metrics")
+    assert status == 200
+    assert b"sns_email_errors_total" in content
+
+
+def test_health(status_url):
+    assert get(status_url + "/health") == (200, b"ok\n")
+    assert get(status_url + "/missing")[0] == 404
+
+
+def test_ready(status_url, load):
+    status, content = get(status_url + "/ready")
+    assert status == 200
+    assert json.loads(content) == {'ready': True, 'in_flight': 0, 'capacity': 4, 'saturation': 0.0,
+                                   'deliveries': 0}
+
+    load[0] = 3
+    status, content = get(status_url + "/ready")
+    assert status == 503
+    assert json.loads(content)['saturation'] == 0.75
+
+
+@pytest.fixture
+def admin_url():
+    with StatusServer(("localhost", 0), admin=True) as server:
+        yield "http://localhost:%d/admin" % server.server_address[1]
+
+
+def test_admin_disabled(status_url):
+    assert get(status_url + "/admin/profile?seconds=0")[0] == 404
+
+
+def test_admin_profile(admin_url):
+    stop = threading.Event()
+
+    def busy_thread():
+        while not stop.is_set():
+            sum(range(1000))
+
+    thread = threading.Thread(target=busy_thread, name="busy")
+    thread.start()
+    try:
+        status, content = get(admin_url + "/profile?seconds=0.2&format=collapsed")
+        assert status == 200
+        assert any(line.startswith("busy;") and "busy_thread" in line for line in content.decode().splitlines())
+
+        status, content = get(admin_url + "/profile?seconds=0.1")
+        assert status == 200
+        assert content.startswith(b"samples=")
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_admin_tracemalloc(admin_url):
+    assert get(admin_url + "/tracemalloc/snapshot")[0] == 400
+    try:
+        assert get(admin_url + "/tracemalloc/start") == (200, b"started\n")
+        assert get(admin_url + "/tracemalloc/diff")[0] == 400
+        status, content = get(admin_url + "/tracemalloc/snapshot?limit=5")
+        assert status == 200
+        assert content.startswith(b"size=")
+        kept = [bytearray(1024) for _ in range(100)]
+        status, content = get(admin_url + "/tracemalloc/diff?limit=5")
+        assert status == 200
+        assert content.startswith(b"size_diff=")
+        assert __file__.encode() in content
+        del kept
+    finally:
+        assert get(admin_url + "/tracemalloc/stop") == (200, b"stopped\n")